@@ -2,8 +2,7 @@ import os
 import sys
 import shutil
 import logging
-import hashlib
-import functools
+from components import hashindex
 
 # Shutup vars
 folder_path = ''
@@ -101,14 +100,8 @@ def compile_file(file_path, keep=False):
         return False
 
 
-@functools.cache
 def hash_file(file_path):
-    if os.path.exists(file_path):
-        sha256 = hashlib.sha256()
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(65536):  # Read in chunks of 64 KB
-                sha256.update(chunk)
-        return sha256.hexdigest()
+    return hashindex.digest(file_path)
 
 
 def midway():
@@ -4,8 +4,7 @@ import subprocess
 import sys
 import logging
 import shutil
-import py_compile
-import tempfile
+from components.bytecode import compile_directory
 args = ''
 folder_path = ''
 plugin = ''
@@ -21,33 +20,7 @@ def compile_main(*args):
 
 
 def compile_and_replace_py_to_pyc(folder, _=""):
-    directory = os.path.join(folder, "dist", "lib")
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.py'):
-                py_file_path = os.path.join(root, file)
-
-                temp_dir = r'C:\Windows\Temp' if os.name == 'nt' else '/tmp'
-
-                temp_dir = tempfile.mkdtemp(dir=temp_dir)
-                try:
-                    temp_file_path = os.path.join(temp_dir, file)
-
-                    shutil.copy2(py_file_path, temp_file_path)
-                    pyc_file_path = py_file_path + 'c'
-
-                    try:
-                        display_file_path = os.path.relpath(py_file_path, directory)
-                        py_compile.compile(temp_file_path, cfile=pyc_file_path, dfile=display_file_path, doraise=True)
-                        os.remove(py_file_path)
-
-                    except py_compile.PyCompileError as compile_error:
-                        logging.error(f"Failed to compile {py_file_path}: {compile_error}")
-                    except Exception as e:
-                        logging.error(f"An error occurred with {py_file_path}: {e}")
-
-                finally:
-                    shutil.rmtree(temp_dir)
+    compile_directory(os.path.join(folder, "dist", "lib"))
 
 
 def init():
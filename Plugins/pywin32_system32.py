@@ -9,5 +9,5 @@ def info(*args): pass
 
 def special_case(import_name='pywin32_system32'):
     shutil.copytree(os.path.join(os.path.dirname(spec.origin), 'pywin32_system32'),
-                    os.path.join(folder_path, "lib", 'pywin32_system32'))
+                    os.path.join(folder_path, "lib", 'pywin32_system32'), dirs_exist_ok=True)
     info("Copied pywin32_system32")
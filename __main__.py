@@ -11,8 +11,14 @@ import sys
 # Ensure local imports work properly when installed in site-packages
 sys.path.append(os.path.dirname(__file__))
 
-from components import copylogic, makexe  # noqa: E402
-from components.imports import importcheck  # noqa: E402
+from components import (  # noqa: E402
+    cache, copylogic, entrypoints, exclude, hashindex, links, makexe, manifest, packager, profiler, scheduler, sizereport,
+    watch, zippolicy
+)
+from components.compress import UPX_DEFAULT_STRATEGY, UPX_EXTENSIONS, UPX_STRATEGIES  # noqa: E402
+from components.imports import importcheck, tracer  # noqa: E402
+from components.profiler import span  # noqa: E402
+from components.scheduler import Stage  # noqa: E402
 from components.plugins import (  # noqa: E402
     apply_monkey_patches,
     load_plugin,
@@ -48,15 +54,69 @@ def validate_platform():
         sys.exit(1)
 
 
-def setup_destination_folder(source_file):
+def run_cache_command(argv):
+    parser = argparse.ArgumentParser(description="Inspect and trim the PyCompyle.cache.", prog='python -m PyCompyle cache')
+    parser.add_argument('action', choices=['stats', 'prune', 'clear', 'verify'])
+    parser.add_argument('--kind', action='append', default=[], choices=sorted(set(cache.KINDS.values())),
+                        help='Only this kind of cache entry, can be given more than once')
+    parser.add_argument('--max-size', type=sizereport.parse_size, default=None, metavar='SIZE',
+                        help='prune: trim the (given kinds of) entries down to SIZE instead of the configured caps')
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    if args.action == 'stats':
+        print(cache.format_stats(cache.stats()))
+    elif args.action == 'prune':
+        removed, freed = cache.prune(args.max_size, args.kind)
+        info(f"Removed {removed} cache entries ({freed / 1048576:.2f} MB)")
+    elif args.action == 'verify':
+        entries, size = cache.verify()
+        info(f"Cache index checked against the disk: {entries} entries, {size / 1048576:.2f} MB")
+    else:
+        cache.clear(args.kind)
+        info(f"Cleared {', '.join(args.kind) if args.kind else 'the whole cache'}")
+
+
+def setup_destination_folder(source_file, incremental=None):
     destination_folder = os.path.abspath(os.path.splitext(source_file)[0]) + ".build"
+    if incremental is not None and manifest.start(destination_folder, incremental):
+        info(f"Incremental build, reusing {destination_folder}")
+        os.makedirs(destination_folder, exist_ok=True)
+        return destination_folder
     if os.path.exists(destination_folder):
         shutil.rmtree(destination_folder)
     os.makedirs(destination_folder)
     return destination_folder
 
 
+def copy_user_paths(copy_paths, folder_path):
+    for path in copy_paths:
+        name = os.path.basename(path)
+        dest_path = os.path.join(folder_path, name)
+        try:
+            if os.path.isdir(path):
+                manifest.stage_tree(path, dest_path)
+                info(f"Copied folder '{path}' to '{dest_path}'")
+            elif os.path.isfile(path):
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                manifest.stage_copy(path, dest_path)
+                info(f"Copied file '{path}' to '{dest_path}'")
+            else:
+                logging.error(f"The specified path does not exist: {path}")
+        except Exception as e:
+            logging.error(f"Failed to copy '{path}': {e}")
+
+
 def run_argument_checking(args):
+    if len({os.path.dirname(entry) for entry in args.entry_points}) > 1:
+        logging.error('All entry scripts have to be in the same folder, they share its local modules')
+        sys.exit(1)
+
+    names = [entrypoints.entry_name(entry) for entry in args.entry_points]
+    if len(set(names)) != len(names):
+        logging.error('Entry scripts need different names, every one of them gets its own executable')
+        sys.exit(1)
+
     if args.windowed and args.bat:
         logging.error('Windowed mode is not compatible with batchfile mode')
         sys.exit(1)
@@ -77,13 +137,174 @@ def run_argument_checking(args):
         logging.error("UAC is not supported on Linux")
         sys.exit(1)
 
+    if args.stream and any((args.folder, args.zip, args.bat, args.debug, args.disable_bootloader,
+                            args.disable_python_environment)):
+        logging.error('Streaming packaging only works for onefile builds')
+        sys.exit(1)
+
+    if args.stream and args.incremental:
+        logging.error('Streaming packaging is not compatible with incremental builds')
+        sys.exit(1)
+
+    if args.tree_shake and args.import_resolver != 'static':
+        logging.error('Tree shaking needs the static import resolver')
+        sys.exit(1)
+
+    if args.trace_run is not None and args.import_manifest:
+        logging.error('--trace-run writes an import manifest, it can\'t be used with --import-manifest')
+        sys.exit(1)
+
+    if args.stream and args.plugin:
+        logging.error('Streaming packaging is not compatible with plugins, they work on the staged files')
+        sys.exit(1)
+
+
+def owned(name, func):
+    # Records what the stage copies as belonging to name, for the size report
+    def run():
+        with manifest.owned_by(name):
+            func()
+    return run
+
+
+def build(args):
+    with span('setup_destination_folder'):
+        folder_path = setup_destination_folder(args.source_file,
+                                               manifest.build_fingerprint(args) if args.incremental else None)
+
+    startup_code = run_startup_code()
+    if startup_code:
+        exec('\n'.join(startup_code), globals(), locals())
+
+    if args.debug:
+        args.verbose = True
+        args.keepfiles = True
+        args.folder = True
+        args.zip = False
+        args.windowed = False
+    if any((args.zip, args.bat, args.disable_bootloader, args.disable_python_environment)):
+        args.folder = True
+    if args.stream:
+        upx_enabled = args.upx_threads not in (0, None, "0")
+        packager.start(folder_path, not args.disable_compile, not args.disable_lib_compressing,
+                       UPX_EXTENSIONS if upx_enabled else ())
+    if args.link_staging:
+        # A plain folder build hands the staged files over as the output, they must not share data with the venv
+        links.mode = 'reflink' if args.folder and not args.incremental else 'hardlink'
+
+    source_file_path = os.path.abspath(args.source_file)
+    for entry in args.entry_points:
+        info(f"Source file: {entry}")
+        if not os.path.exists(entry):
+            logging.critical(f"{entry} does not exist")
+            sys.exit(1)
+    os.chdir(os.path.dirname(source_file_path))
+
+    try:
+        exclude.configure(args.exclude, args.exclude_rules, not args.no_default_excludes, args.exclude_dev_folders)
+    except (OSError, ValueError) as e:
+        logging.critical(f"Invalid exclusion rules: {e}")
+        sys.exit(1)
+    try:
+        zippolicy.configure(args.compress_rule, args.compression_policy, args.compression_level,
+                            not args.no_default_compress_rules)
+    except (OSError, ValueError, KeyError) as e:
+        logging.critical(f"Invalid compression policy: {e}")
+        sys.exit(1)
+
+    lib_path = os.path.join(folder_path, 'lib')
+    os.makedirs(lib_path, exist_ok=True)
+    source_dir = os.path.dirname(source_file_path)
+    results = {}
+
+    manifest.owners.clear()
+
+    def process_imports():
+        if args.import_manifest:
+            results['modules'], results['reached'] = tracer.load_manifest(args.import_manifest, args.package)
+            return
+        if args.trace_run is not None:
+            results['modules'], results['reached'] = tracer.trace_imports(
+                source_file_path, args.entry_points, args.trace_run, args.trace_timeout, args.package)
+            return
+        result = importcheck.process_imports(source_file_path, args.package, args.keepfiles, args.force_refresh,
+                                             args.entry_points, args.import_resolver, args.tree_shake,
+                                             args.import_hints)
+        if args.tree_shake:
+            results['modules'], results['reached'] = result
+        else:
+            results['modules'] = result
+
+    # User copies land after the interpreter and before the dependencies, like they always have.
+    # Scripts and include only write their own folders, so they don't wait for the dependencies.
+    stages = [
+        Stage('copy_python_executable', owned('(python runtime)', lambda: copylogic.copy_python_executable(
+            folder_path, args.disable_python_environment, args.disable_dll))),
+        Stage('copy paths', owned('(--copy)', lambda: copy_user_paths(args.copy or [], folder_path)),
+              after=['copy_python_executable']),
+        Stage('process_imports', process_imports),
+        Stage('copy_dependencies', lambda: copylogic.copy_dependencies(
+            results['modules'], lib_path, folder_path, source_dir, args.disable_lib_compressing,
+            results.get('reached'), args.package),
+            after=['process_imports', 'copy paths']),
+    ]
+    if args.include_script:
+        stages.append(Stage('copy_scripts', owned('(--include-script)', lambda: copylogic.copy_scripts(
+            args.include_script, folder_path)), after=['copy paths']))
+    if args.copy_include:
+        stages.append(Stage('copy_include', owned('(--copy-include)', lambda: copylogic.copy_include(folder_path)),
+                            after=['copy paths']))
+    scheduler.run(stages, workers=1 if args.serial_stages else None)
+    cleaned_modules = results['modules']  # plugin hooks below run in this scope
+    exclude.report()
+    if args.size_report:
+        with span('import chains'):
+            sizereport.chains = sizereport.import_chains(
+                args.entry_points, cleaned_modules, args.package,
+                importcheck.load_linked_index(False, args.import_hints)[0], source_dir)
+    if results.get('reached') is not None:
+        copylogic.write_excluded_report(os.path.splitext(source_file_path)[0] + '.excluded.txt')
+
+    if manifest.active is not None:
+        with span('remove stale files'):
+            manifest.active.remove_stale()
+
+    if len(args.entry_points) > 1:
+        entrypoints.stage_entry_points(args.entry_points, folder_path)
+    else:
+        destination_file_path = os.path.join(folder_path, "__main__.py")
+        shutil.copy(source_file_path, destination_file_path)
+        info(f"{os.path.basename(source_file_path)} copied")
+    links.report()
+    info("Gathering requirements complete")
+
+    if not args.noconfirm:
+        getpass('Press Enter to continue building the EXE')
+    halfway_code = run_halfway_code()
+    if halfway_code:
+        exec('\n'.join(halfway_code), globals(), locals())
+    if args.midwaycommand:
+        info(f"Running midway command: {args.midwaycommand}")
+        with span('midway command'):
+            subprocess.run(args.midwaycommand, shell=True)
+    with span('makexe.main'):
+        makexe.main(folder_path, args)
+    with span('cache upkeep'):
+        hashindex.save()
+        cache.finish()
+
 
 def main():
     validate_platform()
+    if sys.argv[1:2] == ['cache']:
+        run_cache_command(sys.argv[2:])
+        return
 
     parser = argparse.ArgumentParser(
         description="Package a Python script into a EXE with its dependencies.", prog='python -m PyCompyle')
-    parser.add_argument('source_file', help='The Python script to package.')
+    parser.add_argument('source_files', nargs='+', metavar='source_file',
+                        help='The Python script to package. Pass several to build one executable for each of them '
+                             'around a shared runtime.')
     parser.add_argument('--noconfirm', '-nc', action='store_true',
                         help='Skip confirmation for wrapping the exe', default=False)
     parser.add_argument('--folder', '-f', action='store_true',
@@ -111,17 +332,93 @@ def main():
     parser.add_argument('--copy-include', action='store_true', help='Copy PYTHONPATH/include', default=False)
     parser.add_argument('--upx-threads', default='default',
                         help='How many threads to use when compressing with UPX. 0 will disable it.')
+    parser.add_argument('--upx-min-saving', type=float, default=5.0, metavar='PERCENT',
+                        help='Keep binaries unpacked when UPX shrinks them by less than PERCENT (default: 5). '
+                             'Files that failed or fell short before are skipped without running UPX again')
+    parser.add_argument('--upx-strategy', choices=list(UPX_STRATEGIES), default=UPX_DEFAULT_STRATEGY,
+                        help='How hard UPX tries: fast (-1), better (-9), best (--best) or brute (--brute, the default)')
+    parser.add_argument('--upx-time-budget', type=float, default=None, metavar='SECONDS',
+                        help='Fall back to faster presets for the remaining files when UPX would take longer than this')
+    parser.add_argument('--upx-benchmark', action='store_true', default=False,
+                        help='Pack the staged binaries with every preset and compare build time, size saved and unpack '
+                             'time, written to <script>.upx.json and <script>.upx.txt')
+    parser.add_argument('--upx-memory', type=sizereport.parse_size, default=None, metavar='SIZE',
+                        help='Only start another UPX run while the estimated memory of all of them fits in SIZE '
+                             '(default: 80%% of the available RAM)')
     parser.add_argument('--disable-bootloader', action='store_true', default=False,
                         help='Disable creating a bootloader executable (Automatically implies --folder)')
     parser.add_argument('--disable-python-environment', action='store_true', default=False,
                         help='Disable copying the python environment (Automatically implies --folder)')
     parser.add_argument('--disable-compile', action='store_true', help='Disable compiling lib to .pyc files', default=False)
+    parser.add_argument('--disable-pyc-cache', action='store_true', default=False,
+                        help='Disable reusing compiled .pyc files from earlier builds')
     parser.add_argument('--disable-lib-compressing', action='store_true', help='Disable compressing .pyc files', default=False)
     parser.add_argument('--disable-password', action='store_true',
                         help='Disable the password on the onefile EXE', default=False)
     parser.add_argument('--disable-dll', action='store_true', default=False,
                         help="Disable Copying the DLLs folder (Only use if you have a custom handling system for dependencies)")
-    parser.add_argument('--force-refresh', action='store_true', help='Remove the PyCompyle.cache and reinstall', default=False)
+    parser.add_argument('--link-staging', action='store_true', default=False,
+                        help='Stage dependencies as reflinks or hardlinks instead of copies where possible')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Write the onefile payload straight from the dependency locations without staging them')
+    parser.add_argument('--incremental', '-inc', action='store_true', default=False,
+                        help='Keep the build folder between runs and only rebuild files that changed')
+    parser.add_argument('--import-resolver', choices=['static', 'execute'], default='static',
+                        help='How to find the imported modules: "static" reads them from the source and bytecode '
+                             'without running anything, "execute" imports them in a separate interpreter (default: static)')
+    parser.add_argument('--tree-shake', action='store_true', default=False,
+                        help='Only copy the submodules of a package that are imported, instead of the whole package. '
+                             'The left out modules are listed in <script>.excluded.txt, use --package to keep one whole')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                        help='Leave matching files out of the copied packages and modules. Globs match the name, '
+                             'or the path inside the package if they hold a "/" (a leading one anchors to the package root), '
+                             'a trailing "/" only matches folders, "re:" starts a regex')
+    parser.add_argument('--exclude-rules', action='append', default=[], metavar='FILE',
+                        help='JSON file with "exclude" and "include" patterns and per-package ones under "packages"')
+    parser.add_argument('--no-default-excludes', action='store_true', default=False,
+                        help="Copy the type stubs and C headers that are left out by default")
+    parser.add_argument('--exclude-dev-folders', action='store_true', default=False,
+                        help='Also leave out the tests, docs, doc and examples folders at the root of every package. '
+                             'Deeper ones are kept, some packages import from them')
+    parser.add_argument('--import-hints', action='append', default=[], metavar='FILE',
+                        help='Extra linked imports in the linked_imports.json format, merged into the downloaded ones')
+    parser.add_argument('--trace-run', nargs='?', const='', default=None, metavar='COMMAND',
+                        help='Find the imports by running the script (or COMMAND, e.g. a test run) and recording what it '
+                             'loads. Only those modules are copied, the manifest is written to <script>.imports.json')
+    parser.add_argument('--trace-timeout', type=float, default=None, metavar='SECONDS',
+                        help='Stop the traced run after this many seconds')
+    parser.add_argument('--import-manifest', default=None, metavar='FILE',
+                        help='Copy the modules listed in an import manifest written by --trace-run')
+    parser.add_argument('--size-report', action='store_true', default=False,
+                        help='Attribute the payload size to the modules that pulled it in, '
+                             'written to <script>.size.json and <script>.size.txt')
+    parser.add_argument('--size-budget', type=sizereport.parse_size, default=None, metavar='SIZE',
+                        help='Fail the build when the payload (zipped for onefile builds) is bigger than SIZE, e.g. 50MB. '
+                             'Implies --size-report')
+    parser.add_argument('--compress-rule', action='append', default=[], metavar='PATTERN=CODEC[:LEVEL]',
+                        help='How to compress matching payload files, e.g. "*.dat=lzma" or "assets/*=deflate:9". '
+                             'Codecs: store, deflate, bzip2, lzma. Patterns work like --exclude, the first match wins')
+    parser.add_argument('--compression-policy', action='append', default=[], metavar='FILE',
+                        help='JSON file with a list of "rules" ({"pattern", "codec", "level"}) and the default "level"')
+    parser.add_argument('--compression-level', type=int, default=6, metavar='LEVEL',
+                        help='Deflate level for the payload files no rule matches (default: 6)')
+    parser.add_argument('--no-default-compress-rules', action='store_true', default=False,
+                        help='Also deflate archives, images and UPX packed binaries, which are stored as they are by default')
+    parser.add_argument('--compression-report', action='store_true', default=False,
+                        help='Time every codec on every file extension of the payload, '
+                             'written to <script>.compression.json and <script>.compression.txt')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Stay running and rebuild the folder build whenever the sources change')
+    parser.add_argument('--serial-stages', action='store_true', default=False,
+                        help='Run the gathering stages one after another instead of concurrently')
+    parser.add_argument('--profile-build', nargs='?', const='', default=None, metavar='TRACE_FILE',
+                        help='Time every build stage and write a Chrome trace (default: <script>.trace.json)')
+    parser.add_argument('--cache-max-size', type=sizereport.parse_size, default=None, metavar='SIZE',
+                        help='Keep the PyCompyle.cache under SIZE, the least recently used entries are evicted first '
+                             '(default: 2GB). See "python -m PyCompyle cache stats|prune|clear"')
+    parser.add_argument('--force-refresh', action='store_true', default=False,
+                        help='Download linked_imports.json again and forget the cached import results '
+                             '(use "cache clear" to empty the whole PyCompyle.cache)')
     parser.add_argument('--debug', action='store_true', default=False,
                         help='Enables: --verbose --keepfiles --folder. Disables: --windowed --zip')
 
@@ -131,83 +428,37 @@ def main():
     if platform.system() == "Linux" and args.disable_lib_compressing is False:
         args.package.append('zlib')  # needed for lib_c.zip
 
-    setup_logging(args.verbose)
-    run_argument_checking(args)
-
-    for plugin in args.plugin:
-        try:
-            load_plugin(plugin)
-        except Exception as e:
-            logging.error(f"Failed to load plugin '{plugin}': {e}")
-            sys.exit(1)
-    apply_monkey_patches()
-
-    folder_path = setup_destination_folder(args.source_file)
-
-    startup_code = run_startup_code()
-    if startup_code:
-        exec('\n'.join(startup_code), globals(), locals())
-
-    if args.debug:
-        args.verbose = True
-        args.keepfiles = True
+    if args.size_budget is not None:
+        args.size_report = True
+    if args.cache_max_size is not None:
+        cache.max_bytes = args.cache_max_size
+    if args.watch:
+        # Watching keeps the staged folder around and only restages what changed
         args.folder = True
-        args.zip = False
-        args.windowed = False
-    if any((args.zip, args.bat, args.disable_bootloader, args.disable_python_environment)):
-        args.folder = True
-
-    source_file_path = os.path.abspath(args.source_file)
-    info(f"Source file: {source_file_path}")
-    if not os.path.exists(source_file_path):
-        logging.critical(f"{source_file_path} does not exist")
-        sys.exit(1)
-    os.chdir(os.path.dirname(source_file_path))
-
-    copylogic.copy_python_executable(folder_path, args.disable_python_environment, args.disable_dll)
+        args.incremental = True
+        args.noconfirm = True
+    # The build changes into the source folder
+    args.entry_points = [os.path.abspath(source_file) for source_file in args.source_files]
+    args.source_file = args.entry_points[0]
 
-    copy_paths = (args.copy or [])
-    for path in copy_paths:
-        name = os.path.basename(path)
-        dest_path = os.path.join(folder_path, name)
-        try:
-            if os.path.isdir(path):
-                shutil.copytree(path, dest_path)
-                info(f"Copied folder '{path}' to '{dest_path}'")
-            elif os.path.isfile(path):
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                shutil.copy2(path, dest_path)
-                info(f"Copied file '{path}' to '{dest_path}'")
-            else:
-                logging.error(f"The specified path does not exist: {path}")
-        except Exception as e:
-            logging.error(f"Failed to copy '{path}': {e}")
-
-    cleaned_modules = importcheck.process_imports(source_file_path, args.package, args.keepfiles, args.force_refresh)
-    lib_path = os.path.join(folder_path, 'lib')
-    os.makedirs(lib_path, exist_ok=True)
-    source_dir = os.path.dirname(source_file_path)
-    copylogic.copy_dependencies(cleaned_modules, lib_path, folder_path, source_dir, args.disable_lib_compressing)
-
-    if args.include_script:
-        copylogic.copy_scripts(args.include_script, folder_path)
-    if args.copy_include:
-        copylogic.copy_include(folder_path)
-
-    destination_file_path = os.path.join(folder_path, "__main__.py")
-    shutil.copy(source_file_path, destination_file_path)
-    info(f"{os.path.basename(source_file_path)} copied")
-    info("Gathering requirements complete")
+    setup_logging(args.verbose)
+    run_argument_checking(args)
 
-    if not args.noconfirm:
-        getpass('Press Enter to continue building the EXE')
-    halfway_code = run_halfway_code()
-    if halfway_code:
-        exec('\n'.join(halfway_code), globals(), locals())
-    if args.midwaycommand:
-        info(f"Running midway command: {args.midwaycommand}")
-        subprocess.run(args.midwaycommand, shell=True)
-    makexe.main(folder_path, args)
+    if args.profile_build is not None:
+        profiler.start(args.profile_build or os.path.splitext(args.source_file)[0] + '.trace.json')
+
+    with span('load plugins'):
+        for plugin in args.plugin:
+            try:
+                load_plugin(plugin)
+            except Exception as e:
+                logging.error(f"Failed to load plugin '{plugin}': {e}")
+                sys.exit(1)
+        apply_monkey_patches()
+
+    build(args)
+    if args.watch:
+        watch.run(args, build)
 
 
 if __name__ == "__main__":
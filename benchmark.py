@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import shutil
+import random
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+main_folder = os.path.abspath(os.path.dirname(__file__))
+EXTENSION_SUFFIX = '.pyd' if os.name == 'nt' else '.so'
+
+
+def write_module(path, name, lines, imports=()):
+    with open(path, 'w') as f:
+        for imp in imports:
+            f.write(f'import {imp}\n')
+        f.write('\n\n')
+        for i in range(max(1, lines // 8)):
+            f.write(f'class {name.title().replace("_", "")}{i}:\n')
+            f.write(f'    """Synthetic class {i} of {name}."""\n\n')
+            f.write('    def __init__(self, value=0):\n')
+            f.write(f'        self.value = value + {i}\n\n')
+            f.write('    def compute(self, other):\n')
+            f.write(f'        return [self.value * n + {i} for n in range(other)]\n\n\n')
+
+
+def generate_project(root, config):
+    rng = random.Random(config['seed'])
+    project = os.path.join(root, 'project')
+    site_packages = os.path.join(root, 'site-packages')
+    os.makedirs(project)
+    os.makedirs(site_packages)
+
+    local_modules = [f'benchlocal_{i}' for i in range(config['modules'])]
+    for i, name in enumerate(local_modules):
+        # Chain a few local modules together so the import scanner has to recurse
+        imports = ['os', 'json'] + ([local_modules[i + 1]] if i + 1 < len(local_modules) and i % 4 else [])
+        write_module(os.path.join(project, f'{name}.py'), name, config['module_lines'], imports)
+
+    packages = [f'benchpkg_{i}' for i in range(config['packages'])]
+    for name in packages:
+        package_folder = os.path.join(site_packages, name)
+        os.makedirs(os.path.join(package_folder, 'data'))
+        submodules = [f'sub_{j}' for j in range(config['submodules'])]
+        with open(os.path.join(package_folder, '__init__.py'), 'w') as f:
+            f.write(''.join(f'from . import {sub}\n' for sub in submodules))
+        for sub in submodules:
+            write_module(os.path.join(package_folder, f'{sub}.py'), sub, config['module_lines'], ['collections'])
+        for j in range(config['blobs']):
+            # Random bytes compress like real native code at worst, which is what we want to measure
+            with open(os.path.join(package_folder, f'_native_{j}{EXTENSION_SUFFIX}'), 'wb') as f:
+                f.write(rng.randbytes(config['blob_size'] * 1024))
+        for j in range(config['data_files']):
+            with open(os.path.join(package_folder, 'data', f'table_{j}.json'), 'w') as f:
+                json.dump({f'key_{k}': [rng.random() for _ in range(8)] for k in range(64)}, f)
+
+    with open(os.path.join(project, 'app.py'), 'w') as f:
+        for name in local_modules + packages:
+            f.write(f'import {name}\n')
+        f.write('\nprint("benchmark app ok")\n')
+
+    return project, site_packages
+
+
+def seed_cache(home):
+    # Pre-seed linked_imports.json with a fresh timestamp so the build never goes online
+    base = os.path.join(home, 'AppData', 'Local') if os.name == 'nt' else os.path.join(home, '.cache')
+    cache_dir = os.path.join(base, 'PyCompyle.cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.copy2(os.path.join(main_folder, 'linked_imports.json'), os.path.join(cache_dir, 'linked_imports.json'))
+    with open(os.path.join(cache_dir, 'linked_imports.timestamp'), 'w') as f:
+        f.write(datetime.now(timezone.utc).isoformat())
+    return base, cache_dir
+
+
+def folder_size(path):
+    total = 0
+    count = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+            count += 1
+    return total, count
+
+
+def clean_outputs(project, keep_state):
+    for name in ('app', 'app.build', 'app.exe', 'app.trace.json') + (() if keep_state else ('app.buildstate',)):
+        path = os.path.join(project, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def run_build(project, env, build_args):
+    trace_path = os.path.join(project, 'app.trace.json')
+    command = [sys.executable, os.path.join(main_folder, '__main__.py'), os.path.join(project, 'app.py'),
+               '-nc', '--upx-threads', '0', '--profile-build', trace_path] + build_args
+    start = time.perf_counter()
+    result = subprocess.run(command, env=env, cwd=project, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True)
+    total_wall = time.perf_counter() - start
+    if result.returncode != 0:
+        logging.error(result.stdout)
+        raise RuntimeError(f"Build failed with exit code {result.returncode}")
+
+    with open(trace_path, 'r', encoding='utf-8') as f:
+        events = json.load(f)['traceEvents']
+
+    # Stages that run more than once (e.g. special cases) are added together
+    phases = {}
+    for event in events:
+        phase = phases.setdefault(event['name'], {'category': event['cat'], 'wall': 0.0, 'cpu': 0.0, 'calls': 0,
+                                                  'bytes_read': 0, 'bytes_written': 0, 'files': 0})
+        phase['wall'] += event['dur'] / 1e6
+        phase['calls'] += 1
+        for key in ('cpu', 'bytes_read', 'bytes_written', 'files'):
+            phase[key] += event['args'][key]
+
+    artifact = os.path.join(project, 'app')
+    if os.path.isdir(artifact):
+        artifact_bytes, artifact_files = folder_size(artifact)
+    else:
+        artifact_bytes, artifact_files = os.path.getsize(artifact + '.exe'), 1
+
+    return {
+        'total_wall': total_wall,
+        'peak_rss': max((event['args']['peak_rss'] for event in events), default=0),
+        'artifact_bytes': artifact_bytes,
+        'artifact_files': artifact_files,
+        'phases': phases,
+    }
+
+
+def summarize(runs):
+    phase_names = sorted({name for run in runs for name in run['phases']})
+    return {
+        'total_wall': statistics.median(run['total_wall'] for run in runs),
+        'artifact_bytes': statistics.median(run['artifact_bytes'] for run in runs),
+        'phases': {
+            name: statistics.median(run['phases'][name]['wall'] for run in runs if name in run['phases'])
+            for name in phase_names
+        },
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=main_folder, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['median']
+    current = result['median']
+
+    def row(name, old, new, unit):
+        change = f"{(new - old) / old * 100:+.1f}%" if old else 'n/a'
+        return f"{name[:40]:<40} {old:>12.3f}{unit} {new:>12.3f}{unit} {change:>9}"
+
+    lines = [f"{'Phase':<40} {'Baseline':>13} {'Current':>13} {'Change':>9}",
+             row('total', baseline['total_wall'], current['total_wall'], 's'),
+             row('artifact size (MB)', baseline['artifact_bytes'] / 1048576, current['artifact_bytes'] / 1048576, ' ')]
+    for name in sorted(set(baseline['phases']) | set(current['phases'])):
+        lines.append(row(name, baseline['phases'].get(name, 0.0), current['phases'].get(name, 0.0), 's'))
+    logging.info("Comparison against %s:\n%s", baseline_path, '\n'.join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PyCompyle builds of a generated project (offline)')
+    parser.add_argument('--modules', type=int, default=50, help='Number of local modules next to the script')
+    parser.add_argument('--packages', type=int, default=20, help='Number of fake site-packages packages')
+    parser.add_argument('--submodules', type=int, default=10, help='Number of submodules in each package')
+    parser.add_argument('--module-lines', type=int, default=200, help='Rough number of lines in every module')
+    parser.add_argument('--blobs', type=int, default=2, help='Number of native-extension-like blobs in each package')
+    parser.add_argument('--blob-size', type=int, default=512, help='Size of every blob in KB')
+    parser.add_argument('--data-files', type=int, default=5, help='Number of data files in each package')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the generated content')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of builds to run')
+    parser.add_argument('--cold', action='store_true',
+                        help='Clear the PyCompyle cache and build state before every build, not just the first')
+    parser.add_argument('--build-arg', action='append', default=[],
+                        help='Extra argument passed to PyCompyle, e.g. --build-arg=--folder')
+    parser.add_argument('--workdir', help='Where to generate the project (default: a temporary folder)')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated project')
+    parser.add_argument('--output', '-o', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare the results against an earlier JSON result')
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in ('modules', 'packages', 'submodules', 'module_lines', 'blobs',
+                                                  'blob_size', 'data_files', 'seed')}
+
+    root = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='pycompyle-bench-')
+    if os.path.exists(os.path.join(root, 'project')):
+        shutil.rmtree(os.path.join(root, 'project'))
+        shutil.rmtree(os.path.join(root, 'site-packages'), ignore_errors=True)
+    try:
+        logging.info(f"Generating project in {root}")
+        project, site_packages = generate_project(root, config)
+
+        # An isolated cache so results don't depend on what earlier builds left behind
+        home = os.path.join(root, 'home')
+        shutil.rmtree(home, ignore_errors=True)
+        env = dict(os.environ, PYTHONPATH=site_packages, HOME=home, PYTHONDONTWRITEBYTECODE='1')
+        cache_base, cache_dir = seed_cache(home)
+        if os.name == 'nt':
+            env['LOCALAPPDATA'] = cache_base
+
+        runs = []
+        for i in range(args.repeat):
+            if args.cold and i:
+                shutil.rmtree(cache_dir)
+                seed_cache(home)
+            clean_outputs(project, keep_state=not args.cold)
+            logging.info(f"Build {i + 1}/{args.repeat}")
+            run = run_build(project, env, args.build_arg)
+            logging.info(f"Build {i + 1} took {run['total_wall']:.2f}s, artifact {run['artifact_bytes'] / 1048576:.1f} MB")
+            runs.append(run)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    result = {
+        'revision': git_revision(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': config,
+        'build_args': args.build_arg,
+        'cold': args.cold,
+        'runs': runs,
+        'median': summarize(runs),
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        logging.info(f"Results written to {args.output}")
+    else:
+        print(json.dumps(result, indent=2))
+
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == '__main__':
+    main()
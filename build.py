@@ -69,7 +69,7 @@ def build(suffix, no_zip=False, build_linux_only=False):
         shutil.rmtree(build_folder, onexc=remove_readonly)
 
     shutil.copytree(main_folder, build_folder, ignore=shutil.ignore_patterns('bootloader', '.github',
-                    '.git', '.gitignore', 'build.py', 'execompile.py', 'readme.md', 'installer.py'))
+                    '.git', '.gitignore', 'build.py', 'execompile.py', 'benchmark.py', 'readme.md', 'installer.py'))
 
     logging.info("Cleaning build folder...")
     gitignore_path = os.path.join(main_folder, '.gitignore')
@@ -0,0 +1,185 @@
+import os
+import sys
+import marshal
+import logging
+import functools
+import py_compile
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from logging import info, error
+from components import cache, hashindex, iostats, manifest
+
+# Below this many files starting worker processes costs more than it saves
+MIN_PARALLEL_FILES = 64
+
+use_cache = True
+cache_stats = {'hits': 0, 'misses': 0}
+
+
+def get_pyc_cache_path():
+    return cache.get_cache_path('pyccache')
+
+
+def _cache_key(source, display_file_path):
+    # The display path ends up inside the code object, so it is part of the key too
+    h = hashindex.hasher(source)
+    h.update(importlib.util.MAGIC_NUMBER)
+    h.update(str(sys.flags.optimize).encode())
+    h.update(display_file_path.encode('utf-8'))
+    return h.hexdigest()
+
+
+def compile_source(source, display_file_path, st, cache_dir=None):
+    # Returns the .pyc bytes, whether they came from the cache and the cache file.
+    # This runs in worker processes, so the caller records the use with the cache index.
+    code = None
+    cached_file = None
+    if cache_dir is not None:
+        key = _cache_key(source, display_file_path)
+        cached_file = os.path.join(cache_dir, key[:2], f"{key}.bin")
+        try:
+            with open(cached_file, 'rb') as f:
+                code = f.read()
+        except OSError:
+            pass
+
+    hit = code is not None
+    if not hit:
+        try:
+            code = marshal.dumps(compile(source, display_file_path, 'exec', dont_inherit=True))
+        except Exception as err:
+            raise py_compile.PyCompileError(err.__class__, err, display_file_path)
+        if cache_dir is not None:
+            cache.write_atomic(cached_file, code)
+
+    header = (importlib.util.MAGIC_NUMBER + (0).to_bytes(4, 'little')
+              + (int(st.st_mtime) & 0xFFFFFFFF).to_bytes(4, 'little')
+              + (st.st_size & 0xFFFFFFFF).to_bytes(4, 'little'))
+    return header + code, hit, cached_file
+
+
+def _record(result):
+    # result is (hit, cache file) from compile_source
+    hit, cached_file = result
+    cache_stats['hits' if hit else 'misses'] += 1
+    if cached_file is None:
+        return
+    if hit:
+        cache.hit(cached_file)
+    else:
+        cache.miss(cached_file)
+        cache.stored(cached_file)
+
+
+def compile_cached(py_file_path, pyc_file_path, display_file_path, cache_dir=None):
+    # Returns (cache hit, cache file), raises py_compile.PyCompileError like py_compile.compile(doraise=True)
+    with open(py_file_path, 'rb') as f:
+        source = f.read()
+    data, hit, cached_file = compile_source(source, display_file_path, os.stat(py_file_path), cache_dir)
+    cache.write_atomic(pyc_file_path, data)
+    return hit, cached_file
+
+
+def compile_file(py_file_path, pyc_file_path, display_file_path):
+    _record(compile_cached(py_file_path, pyc_file_path, display_file_path,
+                           get_pyc_cache_path() if use_cache else None))
+    iostats.read(os.path.getsize(py_file_path))
+    iostats.wrote(os.path.getsize(pyc_file_path))
+
+
+def _compile_chunk(jobs, cache_dir=None):
+    results = []
+    for py_file_path, pyc_file_path, display_file_path in jobs:
+        try:
+            result = compile_cached(py_file_path, pyc_file_path, display_file_path, cache_dir)
+            results.append((py_file_path, pyc_file_path, None, result))
+        except py_compile.PyCompileError as compile_error:
+            results.append((py_file_path, pyc_file_path, 'compile', str(compile_error)))
+        except Exception as e:
+            results.append((py_file_path, pyc_file_path, 'error', str(e)))
+    return results
+
+
+def _compile_bytes_chunk(jobs, cache_dir=None):
+    results = []
+    for py_file_path, display_file_path in jobs:
+        try:
+            with open(py_file_path, 'rb') as f:
+                source = f.read()
+            data, hit, cached_file = compile_source(source, display_file_path, os.stat(py_file_path), cache_dir)
+            results.append((py_file_path, data, None, (hit, cached_file)))
+        except py_compile.PyCompileError as compile_error:
+            results.append((py_file_path, None, 'compile', str(compile_error)))
+        except Exception as e:
+            results.append((py_file_path, None, 'error', str(e)))
+    return results
+
+
+def _run_chunks(chunk_func, jobs, workers):
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    chunk_func = functools.partial(chunk_func, cache_dir=get_pyc_cache_path() if use_cache else None)
+    if workers == 1 or len(jobs) < MIN_PARALLEL_FILES:
+        return chunk_func(jobs)
+
+    # Hand out a few chunks per worker so one slow chunk doesn't hold up the rest
+    chunk_size = max(1, len(jobs) // (workers * 4))
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return [result for chunk in executor.map(chunk_func, chunks) for result in chunk]
+    except (OSError, RuntimeError) as e:
+        logging.warning(f"Parallel compilation unavailable ({e}), compiling in a single process")
+        return chunk_func(jobs)
+
+
+def compile_files(jobs, workers=None):
+    return _run_chunks(_compile_chunk, jobs, workers)
+
+
+def compile_to_bytes(jobs, workers=None):
+    # Like compile_files but hands back the .pyc contents instead of writing them
+    results = _run_chunks(_compile_bytes_chunk, jobs, workers)
+    for py_file_path, _, failure, result in results:
+        if failure is None:
+            _record(result)
+            iostats.read(os.path.getsize(py_file_path))
+        elif failure == 'compile':
+            logging.error(f"Failed to compile {py_file_path}: {result}")
+        else:
+            error(f"An error occurred with {py_file_path}: {result}")
+    return results
+
+
+def compile_directory(directory, workers=None):
+    jobs = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if file.endswith('.py'):
+                py_file_path = os.path.join(root, file)
+                jobs.append((py_file_path, py_file_path + 'c', os.path.relpath(py_file_path, directory)))
+
+    logging.debug(f"Compiling {len(jobs)} files in {directory}")
+    compiled = 0
+    for py_file_path, pyc_file_path, failure, result in compile_files(jobs, workers):
+        if failure is None:
+            iostats.read(os.path.getsize(py_file_path))
+            iostats.wrote(os.path.getsize(pyc_file_path))
+            os.remove(py_file_path)
+            manifest.renamed(py_file_path, pyc_file_path)
+            _record(result)
+            compiled += 1
+        elif failure == 'compile':
+            logging.error(f"Failed to compile {py_file_path}: {result}")
+        else:
+            error(f"An error occurred with {py_file_path}: {result}")
+
+    if manifest.active is not None:
+        manifest.active.count('compile', rebuilt=compiled)
+    return compiled
+
+
+def report_cache():
+    if not use_cache:
+        return
+    info(f"Bytecode cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
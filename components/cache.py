@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from logging import info
+
+INDEX_VERSION = 1
+INDEX_FILE = 'index.json'
+# Everything in PyCompyle.cache together stays under this, the least recently used entries go first
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Top-level cache item -> kind. The folders in ENTRY_FOLDERS hold one entry per file,
+# anything else (e.g. the resource_hacker folder) is a single entry.
+KINDS = {
+    'pyccache': 'pyc',
+    'imports': 'imports',
+    'scan': 'scan',
+    'upxcache': 'upx',
+    'linked_imports.json': 'linked_imports',
+    'linked_imports.timestamp': 'linked_imports',
+    'linked_imports.index.json': 'linked_imports',
+    'hashes.json': 'hashes',
+    'upx': 'tools',
+    'upx.exe': 'tools',
+    'resource_hacker': 'tools',
+}
+ENTRY_FOLDERS = {'pyccache', 'imports', 'upxcache'}
+# Kinds that also have a cap of their own inside the total one
+KIND_MAX_BYTES = {'pyc': 512 * 1024 * 1024, 'imports': 16 * 1024 * 1024}
+
+# Set by --cache-max-size
+max_bytes = DEFAULT_MAX_BYTES
+
+_lock = threading.Lock()
+# Recorded since the index was last saved: entry -> (size or None, last use), kind -> counters
+_used = {}
+_stats = {}
+
+
+def get_cache_path(*parts):
+    base = os.environ.get("LOCALAPPDATA") if os.name == 'nt' else os.path.expanduser('~/.cache')
+    return os.path.join(base, "PyCompyle.cache", *parts)
+
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def entry_of(path):
+    # The index key of a cached file, None when it isn't inside the cache
+    try:
+        rel_path = os.path.relpath(os.path.abspath(path), get_cache_path())
+    except ValueError:  # another drive
+        return None
+    if rel_path == '.' or rel_path.split(os.sep)[0] == '..':
+        return None
+    parts = rel_path.split(os.sep)
+    return '/'.join(parts) if parts[0] in ENTRY_FOLDERS else parts[0]
+
+
+def kind_of(entry):
+    return KINDS.get(entry.split('/')[0], 'other')
+
+
+def _count(kind, counter, amount=1):
+    counters = _stats.setdefault(kind, {})
+    counters[counter] = counters.get(counter, 0) + amount
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+def hit(path):
+    entry = entry_of(path)
+    if entry is None:
+        return
+    with _lock:
+        _count(kind_of(entry), 'hits')
+        _used[entry] = (_used.get(entry, (None,))[0], time.time())
+
+
+def miss(path):
+    entry = entry_of(path)
+    if entry is not None:
+        with _lock:
+            _count(kind_of(entry), 'misses')
+
+
+def stored(path):
+    entry = entry_of(path)
+    if entry is None:
+        return
+    try:
+        size = _size(get_cache_path(*entry.split('/')))
+    except OSError:
+        return
+    with _lock:
+        _count(kind_of(entry), 'written', size)
+        _used[entry] = (size, time.time())
+
+
+def _load_index():
+    # None when there is no usable index, the cache folder has to be scanned then
+    try:
+        with open(get_cache_path(INDEX_FILE), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def _write_index(index):
+    write_atomic(get_cache_path(INDEX_FILE), json.dumps(index).encode('utf-8'))
+
+
+def _merge_pending(index):
+    # Runs under _lock, folds what this process recorded into the index read from disk
+    entries = index['entries']
+    for entry, (size, last_used) in _used.items():
+        old_size, old_used = entries.get(entry, (None, 0))
+        entries[entry] = [size if size is not None else old_size, max(last_used, old_used)]
+    for kind, counters in _stats.items():
+        saved = index['stats'].setdefault(kind, {})
+        for counter, amount in counters.items():
+            saved[counter] = saved.get(counter, 0) + amount
+    _used.clear()
+    _stats.clear()
+
+
+def _scan():
+    # entry -> (size, mtime) of everything actually in the cache
+    root = get_cache_path()
+    found = {}
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return found
+    for name in names:
+        path = os.path.join(root, name)
+        if name == INDEX_FILE or name.endswith('.tmp'):
+            continue
+        try:
+            if name in ENTRY_FOLDERS and os.path.isdir(path):
+                for folder, _, files in os.walk(path):
+                    for file in files:
+                        if not file.endswith('.tmp'):
+                            st = os.stat(os.path.join(folder, file))
+                            found[entry_of(os.path.join(folder, file))] = (st.st_size, st.st_mtime)
+            else:
+                found[name] = (_size(path), os.stat(path).st_mtime)
+        except OSError:
+            continue
+    return found
+
+
+def _reconcile(rescan=False):
+    # The index with the pending uses merged in. Builds trust the sizes it recorded, only a missing index or
+    # rescan (cache clear and verify) walks the cache folder to drop deleted entries and add unknown ones.
+    with _lock:
+        index = _load_index()
+        if index is None:
+            index = {'version': INDEX_VERSION, 'entries': {}, 'stats': {}}
+            rescan = True
+        _merge_pending(index)
+    entries = index['entries']
+    if not rescan:
+        # Used but never stored by this version, only these are looked at
+        for entry in [entry for entry, (size, _) in entries.items() if size is None]:
+            try:
+                entries[entry][0] = _size(get_cache_path(*entry.split('/')))
+            except OSError:
+                del entries[entry]
+        return index
+    on_disk = _scan()
+    for entry in list(entries):
+        if entry not in on_disk:
+            del entries[entry]
+    for entry, (size, mtime) in on_disk.items():
+        if entry in entries:
+            entries[entry][0] = size
+        else:
+            entries[entry] = [size, mtime]  # made by an older version, its mtime is the best guess
+    return index
+
+
+def _remove(entry):
+    path = get_cache_path(*entry.split('/'))
+    if not os.path.lexists(path):
+        return True  # deleted behind the index's back
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return True
+    except OSError as e:
+        logging.debug(f"Couldn't remove {path} from the cache: {e}")
+        return False
+
+
+def _evict(index, candidates, limit):
+    # Least recently used first until the candidates fit in limit, -> (entries, bytes) removed
+    total = sum(index['entries'][entry][0] for entry in candidates)
+    removed = freed = 0
+    for entry in sorted(candidates, key=lambda entry: index['entries'][entry][1]):
+        if total <= limit:
+            break
+        size = index['entries'][entry][0]
+        if _remove(entry):
+            del index['entries'][entry]
+            stats = index['stats'].setdefault(kind_of(entry), {})
+            stats['evicted'] = stats.get('evicted', 0) + 1
+            total -= size
+            removed += 1
+            freed += size
+    return removed, freed
+
+
+def prune(limit=None, kinds=None):
+    # Enforces the per-kind caps and the total one, or only limit on the given kinds. -> (entries, bytes) removed
+    index = _reconcile()
+    entries = index['entries']
+    removed = freed = 0
+    if limit is not None:
+        removed, freed = _evict(index, [entry for entry in entries if not kinds or kind_of(entry) in kinds], limit)
+    else:
+        for kind, kind_limit in KIND_MAX_BYTES.items():
+            if not kinds or kind in kinds:
+                counts = _evict(index, [entry for entry in entries if kind_of(entry) == kind], kind_limit)
+                removed, freed = removed + counts[0], freed + counts[1]
+        # Over the total cap only the given kinds are thrown out
+        candidates = [entry for entry in entries if not kinds or kind_of(entry) in kinds]
+        over = sum(size for size, _ in entries.values()) - max_bytes
+        if over > 0:
+            counts = _evict(index, candidates, sum(entries[entry][0] for entry in candidates) - over)
+            removed, freed = removed + counts[0], freed + counts[1]
+    try:
+        _write_index(index)
+    except OSError as e:
+        logging.debug(f"Couldn't save the cache index: {e}")
+    if removed:
+        logging.debug(f"Evicted {removed} cache entries, {freed} bytes")
+    return removed, freed
+
+
+def clear(kinds=None):
+    # Everything when no kinds are given, the statistics too
+    if not kinds:
+        with _lock:
+            _used.clear()
+            _stats.clear()
+        shutil.rmtree(get_cache_path(), ignore_errors=True)
+        return
+    index = _reconcile(rescan=True)
+    for entry in [entry for entry in index['entries'] if kind_of(entry) in kinds]:
+        if _remove(entry):
+            del index['entries'][entry]
+    try:
+        _write_index(index)
+    except OSError as e:
+        logging.debug(f"Couldn't save the cache index: {e}")
+
+
+def verify():
+    # Brings the index back in line with what is actually on disk -> (entries, bytes)
+    index = _reconcile(rescan=True)
+    _write_index(index)
+    return len(index['entries']), sum(size for size, _ in index['entries'].values())
+
+
+def stats():
+    # kind -> entries, bytes, last use and the hit/miss/written/evicted counters of every build so far
+    index = _reconcile()
+    try:
+        _write_index(index)
+    except OSError:
+        pass
+    found = {}
+    for entry, (size, last_used) in index['entries'].items():
+        kind = found.setdefault(kind_of(entry), {'entries': 0, 'bytes': 0, 'last_used': 0})
+        kind['entries'] += 1
+        kind['bytes'] += size
+        kind['last_used'] = max(kind['last_used'], last_used)
+    for kind, counters in index['stats'].items():
+        found.setdefault(kind, {'entries': 0, 'bytes': 0, 'last_used': 0}).update(counters)
+    return found
+
+
+def format_stats(found):
+    mb = 1048576
+    lines = [f"{'Kind':<16} {'Entries':>8} {'Size (MB)':>10} {'Hits':>8} {'Misses':>8} {'Written (MB)':>13} "
+             f"{'Evicted':>8}  Last used"]
+    for kind, counters in sorted(found.items()):
+        last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(counters['last_used'])) if counters['last_used'] else '-'
+        lines.append(f"{kind:<16} {counters['entries']:8} {counters['bytes'] / mb:10.2f} {counters.get('hits', 0):8} "
+                     f"{counters.get('misses', 0):8} {counters.get('written', 0) / mb:13.2f} "
+                     f"{counters.get('evicted', 0):8}  {last_used}")
+    total = sum(counters['bytes'] for counters in found.values())
+    lines.append(f"Total {total / mb:.2f} MB of {max_bytes / mb:.0f} MB")
+    return '\n'.join(lines)
+
+
+def finish():
+    # End of a build: record this build's uses and bring the cache back under its caps
+    with _lock:
+        session = {kind: dict(counters) for kind, counters in _stats.items()}
+    for kind, counters in sorted(session.items()):
+        logging.debug(f"Cache {kind}: {counters.get('hits', 0)} hits, {counters.get('misses', 0)} misses")
+    removed, freed = prune()
+    if removed:
+        info(f"Evicted {removed} least recently used cache entries ({freed / 1048576:.2f} MB)")
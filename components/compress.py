@@ -3,55 +3,165 @@ import shutil
 import logging
 import pyzipper
 import subprocess
-import hashlib
+import json
 import time
 import stat
+import tempfile
+import threading
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from logging import info
+from components import cache, hashindex, iostats, links, manifest
 from components.download import install_upx
-
-
-def compress_folder_with_progress(folder_path, output_zip_path, password=None, compression_level=6, text='INFO: Zipping'):
-    total_size = sum(
-        os.path.getsize(os.path.join(root, file))
-        for root, _, files in os.walk(folder_path)
-        for file in files
-    )
-
+from components.profiler import span
+
+UPX_EXTENSIONS = (".exe", ".dll", ".pyd", ".so", ".bin")
+# input sha256 -> what UPX did with it last time, kept in upxcache so failures and bad ratios are never retried
+UPX_RESULTS_FILE = 'results.json'
+# Outputs saving less than this fraction aren't worth unpacking at every launch
+UPX_MIN_SAVING = 0.05
+# Estimated memory of one UPX run, see upx_memory(). Without --upx-memory the budget is most of the free RAM.
+UPX_MEMORY_BASE = 64 * 1024 * 1024
+UPX_MEMORY_PER_BYTE = 6
+UPX_MEMORY_SHARE = 0.8
+UPX_REPORTED_PATH = 6
+# Presets from the fastest to the slowest: UPX options, and a rough relative cost for inputs nothing was measured on
+UPX_STRATEGIES = {
+    'fast': (['-1'], 1),
+    'better': (['-9'], 4),
+    'best': (['--best'], 8),
+    'brute': (['--brute'], 40),
+}
+UPX_DEFAULT_STRATEGY = 'brute'
+# Seconds per input byte of the fast preset when no run was measured yet
+UPX_FAST_SECONDS_PER_BYTE = 1e-7
+
+
+# Below this much data the parallel parts cost more than they save
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+
+
+def _list_files(folder_path):
+    # Sorted so the archive comes out the same however the filesystem orders its entries
+    files = []
+    for root, dirs, names in os.walk(folder_path):
+        dirs.sort()
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            files.append((file_path, os.path.relpath(file_path, folder_path), os.path.getsize(file_path)))
+    return files
+
+
+def _write_part(output_path, files, password, compression_level, progress, policy=None):
+    # Returns the entries and where their data ends, so the part can be copied into a bigger archive
     encryption = pyzipper.WZ_AES if password else None
-
-    with tqdm(total=total_size, unit='B', unit_scale=True, desc=text) as pbar, \
-        pyzipper.AESZipFile(
-            output_zip_path,
-            'w',
-            compression=pyzipper.ZIP_DEFLATED,
-            compresslevel=compression_level,
-            encryption=encryption
-    ) as zipf:
-
+    with pyzipper.AESZipFile(output_path, 'w', compression=pyzipper.ZIP_DEFLATED, compresslevel=compression_level,
+                             encryption=encryption) as zipf:
         if password:
             zipf.setpassword(password.encode('utf-8'))
-
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, folder_path)
-
-                # Truncate and pad the name
-                display_name = file if len(file) <= 25 else f"...{file[-22:]}"
-                padded_name = f"{display_name:<25}"
-
-                pbar.set_postfix_str(f"File: {padded_name}")
-
+        for file_path, arcname, size in files:
+            if policy is not None:
+                zipf.write(file_path, arcname, *policy.choose(arcname, file_path))
+            else:
                 zipf.write(file_path, arcname)
-                pbar.update(os.path.getsize(file_path))
+            progress(file_path, size)
+        return list(zipf.filelist), zipf.start_dir
 
 
+def _merge_parts(output_zip_path, parts, password, compression_level):
+    # Copies the finished entries of every part in order and writes one central directory for all of them
+    encryption = pyzipper.WZ_AES if password else None
+    with pyzipper.AESZipFile(output_zip_path, 'w', compression=pyzipper.ZIP_DEFLATED,
+                             compresslevel=compression_level, encryption=encryption) as zipf:
+        for part_path, entries, data_end in parts:
+            offset = zipf.fp.tell()
+            with open(part_path, 'rb') as part:
+                remaining = data_end
+                while remaining:
+                    chunk = part.read(min(remaining, 1024 * 1024))
+                    zipf.fp.write(chunk)
+                    remaining -= len(chunk)
+            for zinfo in entries:
+                zinfo.header_offset += offset
+                zipf.filelist.append(zinfo)
+                zipf.NameToInfo[zinfo.filename] = zinfo
+            zipf.start_dir = zipf.fp.tell()
+        zipf._didModify = True
+
+
+def _split(files, count):
+    # Contiguous runs of about the same size, keeps the order of the archive
+    target = sum(size for _, _, size in files) / count
+    chunks, chunk, chunk_size = [], [], 0
+    for item in files:
+        chunk.append(item)
+        chunk_size += item[2]
+        if chunk_size >= target:
+            chunks.append(chunk)
+            chunk, chunk_size = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def compress_folder_with_progress(folder_path, output_zip_path, password=None, compression_level=6, text='INFO: Zipping',
+                                  workers=None, policy=None):
+    files = _list_files(folder_path)
+    total_size = sum(size for _, _, size in files)
+    workers = workers or os.cpu_count() or 1
+
+    with tqdm(total=total_size, unit='B', unit_scale=True, desc=text) as pbar:
+        lock = threading.Lock()
+
+        def progress(file_path, size):
+            file = os.path.basename(file_path)
+            # Truncate and pad the name
+            display_name = file if len(file) <= 25 else f"...{file[-22:]}"
+            with lock:
+                pbar.set_postfix_str(f"File: {display_name:<25}")
+                pbar.update(size)
+
+        if workers == 1 or len(files) < 2 or total_size < PARALLEL_MIN_BYTES:
+            _write_part(output_zip_path, files, password, compression_level, progress, policy)
+        else:
+            # zlib and the AES encryption let go of the GIL, so threads compress on every core
+            chunks = _split(files, workers * 4)
+            part_paths = [f"{output_zip_path}.part{i}" for i in range(len(chunks))]
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(
+                        lambda job: _write_part(job[0], job[1], password, compression_level, progress, policy),
+                        zip(part_paths, chunks)))
+                _merge_parts(output_zip_path, [(path, entries, data_end) for path, (entries, data_end)
+                                               in zip(part_paths, results)], password, compression_level)
+            finally:
+                for part_path in part_paths:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+
+    iostats.read(total_size, files=len(files))
+    iostats.wrote(os.path.getsize(output_zip_path))
+
+
+def _move_into(src, dst):
+    # Like shutil.move but merges into existing folders, keeping the build manifest up to date
+    if os.path.isdir(src) and os.path.isdir(dst):
+        for name in os.listdir(src):
+            _move_into(os.path.join(src, name), os.path.join(dst, name))
+        os.rmdir(src)
+        return
+    if os.path.isfile(dst):
+        os.remove(dst)
+    shutil.move(src, dst)
+    manifest.renamed(src, dst)
+
 
 def compress_top_level_pyc(lib_folder, output_name="lib_c"):
     lib_c_path = os.path.join(os.path.dirname(lib_folder), output_name)
-    if os.path.exists(lib_c_path):
+    if manifest.active is not None:
+        # Incremental builds keep the staged files between runs so only changes get moved in
+        lib_c_path = os.path.join(manifest.active.state_path, os.path.basename(output_name))
+    elif os.path.exists(lib_c_path):
         shutil.rmtree(lib_c_path)
     os.makedirs(lib_c_path, exist_ok=True)
 
@@ -59,7 +169,7 @@ def compress_top_level_pyc(lib_folder, output_name="lib_c"):
     for item in os.listdir(lib_folder):
         item_path = os.path.join(lib_folder, item)
         if os.path.isfile(item_path) and item_path.endswith((".pyc", ".py")):
-            shutil.move(item_path, lib_c_path)
+            _move_into(item_path, os.path.join(lib_c_path, item))
 
     # Move top-level folders containing only .pyc or py files
     for item in os.listdir(lib_folder):
@@ -71,8 +181,12 @@ def compress_top_level_pyc(lib_folder, output_name="lib_c"):
                 for f in files
                 if os.path.isfile(os.path.join(root, f))
             )
+            staged_path = os.path.join(lib_c_path, item)
             if only_pyc_or_py:
-                shutil.move(item_path, lib_c_path)
+                _move_into(item_path, staged_path)
+            elif os.path.isdir(staged_path):
+                # Used to be pure python but gained other files since the last build
+                _move_into(staged_path, item_path)
 
     # Remove empty folders in original lib
     for root, dirs, files in os.walk(lib_folder, topdown=False):
@@ -81,81 +195,363 @@ def compress_top_level_pyc(lib_folder, output_name="lib_c"):
             if not os.listdir(dir_path):
                 shutil.rmtree(dir_path)
 
-    compress_folder_with_progress(lib_c_path, f"{output_name}.zip", password=None, text='INFO: Compressing top-level python files')
-
-    shutil.rmtree(lib_c_path)
-
-
-def compress_with_upx(folder_path, threads, noconfirm):
-    max_workers = max(1, os.cpu_count() // 2) if threads == 'default' else threads
-    if max_workers <= 0:
+    zip_path = f"{output_name}.zip"
+    if manifest.active is None:
+        compress_folder_with_progress(lib_c_path, zip_path, password=None, text='INFO: Compressing top-level python files')
+        shutil.rmtree(lib_c_path)
         return
 
+    total = sum(len(files) for _, _, files in os.walk(lib_c_path))
+    changed = manifest.active.changed_under(lib_c_path)
+    if changed or not os.path.exists(zip_path):
+        compress_folder_with_progress(lib_c_path, zip_path, password=None, text='INFO: Compressing top-level python files')
+        manifest.active.count('lib_c', reused=max(0, total - changed), rebuilt=min(changed, total))
+    else:
+        info(f'Reusing {os.path.basename(zip_path)}, nothing changed')
+        manifest.active.count('lib_c', reused=total)
+
+
+def _upx_key(file_hash, strategy):
+    # Brute keeps the plain hash, so outputs cached before there were presets still count
+    return file_hash if strategy == 'brute' else f"{file_hash}-{strategy}"
+
+
+def _load_upx_results(results_path):
+    try:
+        with open(results_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_upx_results(results_path, results):
+    # Another build may have recorded files meanwhile, keep theirs too
+    merged = _load_upx_results(results_path)
+    merged.update(results)
+    try:
+        cache.write_atomic(results_path, json.dumps(merged).encode('utf-8'))
+        cache.stored(results_path)
+    except OSError as e:
+        logging.debug(f"Couldn't save the UPX results: {e}")
+
+
+def _upx_saving(record):
+    if record['status'] != 'packed' or not record['size']:
+        return 0.0
+    return 1 - record['packed'] / record['size']
+
+
+def _upx_failed(results, file_hash):
+    # UPX refuses a file for what it is (already packed, unsupported format...), whatever the preset
+    return any(results.get(_upx_key(file_hash, strategy), {}).get('status') == 'failed' for strategy in UPX_STRATEGIES)
+
+
+def _report_upx(totals):
+    mb = 1048576
+    parts = []
+    if totals['packed']:
+        parts.append(f"packed {totals['packed']} files in {totals['seconds']:.1f}s")
+    if totals['reused']:
+        parts.append(f"reused {totals['reused']} from the cache")
+    if totals['skipped']:
+        parts.append(f"skipped {totals['skipped']} that failed or barely shrank before")
+    if totals['rejected']:
+        parts.append(f"kept {totals['rejected']} unpacked, under the minimum saving")
+    if totals['failed']:
+        parts.append(f"{totals['failed']} failed")
+    if totals['downgraded']:
+        parts.append(f"{totals['downgraded']} fell back to faster presets to stay within the time budget")
+    if parts:
+        saved = f"{totals['bytes_saved'] / mb:.2f} MB"
+        if totals['seconds_saved']:
+            saved += f" and {totals['seconds_saved']:.1f}s of UPX runs the cache made unnecessary"
+        info(f"UPX: {', '.join(parts)}. Saved {saved}")
+
+
+def available_memory():
+    # Bytes of RAM that can be used without swapping, None when it can't be told
+    try:
+        if os.name == 'nt':
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(status)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return status.ullAvailPhys
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def upx_memory(size):
+    # Rough peak of one --brute run, it keeps a few copies of the file next to its LZMA dictionaries
+    return UPX_MEMORY_BASE + size * UPX_MEMORY_PER_BYTE
+
+
+class MemoryGate:
+    # Lets a job start once its estimated memory fits in the budget, one bigger than the whole budget runs alone
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        if self.budget is None:
+            return
+        with self.condition:
+            while self.running and self.used + amount > self.budget:
+                self.condition.wait()
+            self.used += amount
+            self.running += 1
+
+    def release(self, amount):
+        if self.budget is None:
+            return
+        with self.condition:
+            self.used -= amount
+            self.running -= 1
+            self.condition.notify_all()
+
+
+def _upx_rates(results):
+    # preset -> seconds per input byte, averaged over every earlier run
+    sums = {}
+    for record in results.values():
+        if record.get('seconds') and record.get('size'):
+            totals = sums.setdefault(record.get('strategy', 'brute'), [0.0, 0])
+            totals[0] += record['seconds']
+            totals[1] += record['size']
+    return {strategy: seconds / size for strategy, (seconds, size) in sums.items()}
+
+
+def _upx_estimate(file_hash, size, strategy, results, rates):
+    # Expected seconds: what this input took before, its size times what the preset averaged,
+    # or what another preset averaged scaled by their relative cost
+    record = results.get(_upx_key(file_hash, strategy))
+    if record is not None and record.get('seconds') is not None:
+        return record['seconds']
+    cost = UPX_STRATEGIES[strategy][1]
+    if strategy in rates:
+        return size * rates[strategy]
+    if rates:
+        other, rate = next(iter(rates.items()))
+        return size * rate * cost / UPX_STRATEGIES[other][1]
+    return size * UPX_FAST_SECONDS_PER_BYTE * cost
+
+
+def _report_schedule(timings, workers, stage_start):
+    # timings: (file path, thread, start, end, waited for memory). The critical path is the lane that finished last.
+    ran = [timing for timing in timings if timing[3] - timing[2] > 0.01]
+    if not ran:
+        return
+    makespan = max(end for _, _, _, end, _ in ran) - stage_start
+    busy = sum(end - start for _, _, start, end, _ in ran)
+    bound = max(max(end - start for _, _, start, end, _ in ran), busy / workers)
+    last = max(ran, key=lambda timing: timing[3])
+    lane = sorted((timing for timing in ran if timing[1] == last[1]), key=lambda timing: timing[2])
+    path = ' -> '.join(f"{os.path.basename(file_path)} ({end - start:.1f}s"
+                       + (f", waited {waited:.1f}s for memory)" if waited > 0.01 else ')')
+                       for file_path, _, start, end, waited in lane[:UPX_REPORTED_PATH])
+    rest = lane[UPX_REPORTED_PATH:]
+    if rest:
+        path += f" -> {len(rest)} more ({sum(end - start for _, _, start, end, _ in rest):.1f}s)"
+    info(f"UPX makespan {makespan:.1f}s for {busy:.1f}s of work on {workers} workers "
+         f"(lower bound {bound:.1f}s), critical path: {path}")
+
+
+def _upx_binary(noconfirm):
     is_windows = os.name == "nt"
-
-    extensions = (".exe", ".dll", ".pyd", ".so", ".bin")
-
-    base_cache = os.path.join(
-        os.environ.get("LOCALAPPDATA") if is_windows else os.path.expanduser("~/.cache"),
-        "PyCompyle.cache"
-    )
-
-    upx_path = os.path.join(base_cache, "upx.exe" if is_windows else "upx")
-    upx_cache = os.path.join(base_cache, "upxcache")
-    os.makedirs(upx_cache, exist_ok=True)
+    upx_path = cache.get_cache_path("upx.exe" if is_windows else "upx")
 
     if not os.path.exists(upx_path):
         info("UPX not found, downloading...")
         upx_path = install_upx(noconfirm)
         if upx_path is None:
             logging.error("Failed to install UPX. Compression will be skipped.")
-            return
+            return None
         if not os.path.exists(upx_path):
             logging.error("Failed to install UPX. Compression will be skipped.")
-            return
+            return None
+
+    cache.hit(upx_path)
 
     if not is_windows:
         st = os.stat(upx_path)
         if not (st.st_mode & stat.S_IXUSR):
             os.chmod(upx_path, st.st_mode | stat.S_IXUSR)
+    return upx_path
 
-    def hash_file(path):
-        h = hashlib.sha256()
-        with open(path, "rb") as f:
-            for chunk in iter(lambda: f.read(65536), b""):
-                h.update(chunk)
-        return h.hexdigest()
 
+def _upx_candidates(folder_path, count_reused=True):
+    extensions = UPX_EXTENSIONS
     files_to_compress = []
     for root, _, files in os.walk(folder_path):
         for file in files:
             if any(file.lower().endswith(ext) for ext in extensions or os.access(file, os.X_OK)):
                 if file.lower().startswith(("qwindows")):
                     continue
+                if manifest.active is not None and manifest.active.is_reused(os.path.join(root, file)):
+                    # Already compressed by an earlier incremental build
+                    if count_reused:
+                        manifest.active.count('upx', reused=1)
+                    continue
                 files_to_compress.append(os.path.join(root, file))
+    return files_to_compress
 
-    def compress_file(file_path):
-        file_hash = hash_file(file_path)
-        cached_file = os.path.join(upx_cache, f"{file_hash}.bin")
 
+def compress_with_upx(folder_path, threads, noconfirm, min_saving=UPX_MIN_SAVING, memory_budget=None,
+                      strategy=UPX_DEFAULT_STRATEGY, time_budget=None):
+    max_workers = max(1, os.cpu_count() // 2) if threads == 'default' else int(threads)
+    if max_workers <= 0:
+        return
+
+    upx_path = _upx_binary(noconfirm)
+    if upx_path is None:
+        return
+    upx_cache = cache.get_cache_path("upxcache")
+    os.makedirs(upx_cache, exist_ok=True)
+
+    files_to_compress = _upx_candidates(folder_path)
+
+    results_path = os.path.join(upx_cache, UPX_RESULTS_FILE)
+    results = _load_upx_results(results_path)
+    if results:
+        cache.hit(results_path)
+    else:
+        cache.miss(results_path)
+    new_results = {}
+    totals = dict.fromkeys(('packed', 'reused', 'skipped', 'rejected', 'failed', 'downgraded'), 0)
+    totals.update(seconds=0.0, bytes_saved=0, seconds_saved=0.0)
+    lock = threading.Lock()
+
+    def tally(kind, bytes_saved=0, seconds=0.0, seconds_saved=0.0):
+        with lock:
+            totals[kind] += 1
+            totals['bytes_saved'] += bytes_saved
+            totals['seconds'] += seconds
+            totals['seconds_saved'] += seconds_saved
+
+    # Hash first so earlier runs tell how long each file takes, then start the longest ones first
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        hashes = dict(zip(files_to_compress, executor.map(hashindex.digest, files_to_compress)))
+    sizes = {file_path: os.path.getsize(file_path) for file_path in files_to_compress}
+    rates = _upx_rates(results)
+
+    def estimate(file_path, preset):
+        if os.path.exists(os.path.join(upx_cache, f"{_upx_key(hashes[file_path], preset)}.bin")):
+            return 0.0
+        return _upx_estimate(hashes[file_path], sizes[file_path], preset, results, rates)
+
+    estimates = {file_path: estimate(file_path, strategy) for file_path in files_to_compress}
+    files_to_compress.sort(key=lambda file_path: -estimates[file_path])
+    # What the files nobody started yet would take at the fastest preset, the least the budget has to leave for them
+    presets = list(UPX_STRATEGIES)[:list(UPX_STRATEGIES).index(strategy) + 1]
+    pending = {file_path: estimate(file_path, presets[0]) for file_path in files_to_compress}
+
+    if memory_budget is None:
+        available = available_memory()
+        memory_budget = int(available * UPX_MEMORY_SHARE) if available else None
+    gate = MemoryGate(memory_budget)
+    timings = []
+    stage_start = time.perf_counter()
+
+    def pick_strategy(file_path):
+        # The slowest preset that still leaves room in the time budget for everything after this file
+        with lock:
+            pending.pop(file_path, None)
+            if time_budget is None:
+                return strategy
+            left = time_budget - (time.perf_counter() - stage_start)
+            # This file runs on one worker, only the queued ones are spread over all of them
+            rest = sum(pending.values()) / max_workers
+            for preset in reversed(presets):
+                if estimate(file_path, preset) + rest <= left:
+                    break
+            if preset != strategy:
+                totals['downgraded'] += 1
+            return preset
+
+    def compress_file(file_path):
+        preset = pick_strategy(file_path)
+        file_hash = hashes[file_path]
+        key = _upx_key(file_hash, preset)
+        cached_file = os.path.join(upx_cache, f"{key}.bin")
+        record = results.get(key)
+
+        if _upx_failed(results, file_hash) or record is not None and _upx_saving(record) < min_saving:
+            # Failed or barely shrank last time, UPX would do the same again
+            tally('skipped', seconds_saved=record['seconds'] if record else 0.0)
+            return
         if os.path.exists(cached_file):
-            os.utime(cached_file, None)  # refresh last access time
+            cache.hit(cached_file)
+            os.remove(file_path)  # don't write through a hardlink into the original file
             shutil.copy2(cached_file, file_path)
+            iostats.wrote(os.path.getsize(file_path))
+            tally('reused', record['size'] - record['packed'] if record else 0,
+                  seconds_saved=record['seconds'] if record else 0.0)
             return
+        cache.miss(cached_file)
 
         temp_compressed = file_path + ".tmp"
+        size = sizes[file_path]
+        memory = upx_memory(size)
+        queued = time.perf_counter()
+        gate.acquire(memory)
+        start = time.perf_counter()
+        failed = False
         try:
-            subprocess.run([upx_path, "--brute", "-o", temp_compressed, file_path],
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.DEVNULL,
-                           check=True)
-            shutil.move(temp_compressed, file_path)
-            shutil.copy2(file_path, cached_file)
+            with span(f"upx {os.path.basename(file_path)}", 'upx'):
+                subprocess.run([upx_path, *UPX_STRATEGIES[preset][0], "-o", temp_compressed, file_path],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL,
+                               check=True)
         except subprocess.CalledProcessError:
+            failed = True
             if os.path.exists(temp_compressed):
                 os.remove(temp_compressed)
+        finally:
+            end = time.perf_counter()
+            gate.release(memory)
+            with lock:
+                timings.append((file_path, threading.get_ident(), start, end, start - queued))
+        seconds = end - start
+        if failed:
+            with lock:
+                new_results[key] = {'status': 'failed', 'strategy': preset, 'size': size, 'seconds': seconds}
+            tally('failed', seconds=seconds)
+            return
 
-    logging.debug(f'Using {max_workers} threads for UPX compression')
+        record = {'status': 'packed', 'strategy': preset, 'size': size, 'packed': os.path.getsize(temp_compressed),
+                  'seconds': seconds}
+        with lock:
+            new_results[key] = record
+        if _upx_saving(record) < min_saving:
+            os.remove(temp_compressed)
+            tally('rejected', seconds=seconds)
+            return
+        shutil.move(temp_compressed, file_path)
+        iostats.wrote(record['packed'])
+        shutil.copy2(file_path, cached_file)
+        cache.stored(cached_file)
+        tally('packed', size - record['packed'], seconds)
+        if manifest.active is not None:
+            manifest.active.count('upx', rebuilt=1)
+
+    logging.debug(f'Using {max_workers} threads for UPX compression with the {strategy} preset'
+                  + (f', {memory_budget / 1048576:.0f} MB of memory' if memory_budget else '')
+                  + (f', {time_budget:.0f}s budget' if time_budget is not None else ''))
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = {executor.submit(compress_file, f): f for f in files_to_compress}
@@ -180,38 +576,104 @@ def compress_with_upx(folder_path, threads, noconfirm):
                 pbar.set_postfix_str(f"Last: {padded_name}")
                 pbar.update(1)
 
-    # Remove stale cache files
-    now = time.time()
-    max_age = 30 * 24 * 3600  # 30 days in seconds
-    for name in os.listdir(upx_cache):
-        path = os.path.join(upx_cache, name)
-        try:
-            if os.path.isfile(path):
-                last_used = os.path.getatime(path)
-                if now - last_used > max_age:
-                    os.remove(path)
-                    logging.debug(f"Removed stale cache file: {name}")
-        except Exception as e:
-            logging.warning(f"Failed to check/remove cache file {name}: {e}")
+    if new_results:
+        _save_upx_results(results_path, new_results)
+    _report_upx(totals)
+    _report_schedule(timings, max_workers, stage_start)
 
 
-def compress_file_with_upx(file_path):
-    is_windows = os.name == "nt"
-    base_cache = os.path.join(
-        os.environ.get("LOCALAPPDATA") if is_windows else os.path.expanduser("~/.cache"),
-        "PyCompyle.cache"
-    )
-
-    upx_path = os.path.join(base_cache, "upx.exe" if is_windows else "upx")
-    upx_cache = os.path.join(base_cache, "upxcache")
+def benchmark_upx(folder_path, base_path, noconfirm, strategies=None, min_saving=UPX_MIN_SAVING):
+    # Packs every candidate with every preset, one run at a time so the timings don't disturb each other.
+    # The tree isn't touched, the outputs go into the cache so the real run reuses the ones of its preset.
+    upx_path = _upx_binary(noconfirm)
+    if upx_path is None:
+        return None
+    upx_cache = cache.get_cache_path("upxcache")
     os.makedirs(upx_cache, exist_ok=True)
-
-    if not os.path.exists(upx_path):
-        info("UPX not found, downloading...")
-        upx_path = install_upx()
-        if not upx_path or not os.path.exists(upx_path):
-            logging.error("Failed to install UPX. Compression will be skipped.")
-            return
-
+    results_path = os.path.join(upx_cache, UPX_RESULTS_FILE)
+    strategies = strategies or list(UPX_STRATEGIES)
+    files_to_compress = _upx_candidates(folder_path, count_reused=False)
+
+    new_results = {}
+    rows = {strategy: {'strategy': strategy, 'files': 0, 'failed': 0, 'bytes': 0, 'packed': 0,
+                       'build_seconds': 0.0, 'launch_seconds': 0.0} for strategy in strategies}
+    runs = []
+    temp_dir = tempfile.mkdtemp(prefix='pycompyle-upx-')
+    try:
+        with tqdm(total=len(files_to_compress) * len(strategies), desc="INFO: UPX benchmark", unit="run") as pbar:
+            for file_path in files_to_compress:
+                file_hash = hashindex.digest(file_path)
+                size = os.path.getsize(file_path)
+                for strategy in strategies:
+                    key = _upx_key(file_hash, strategy)
+                    output = os.path.join(temp_dir, f"{key}.bin")
+                    start = time.perf_counter()
+                    result = subprocess.run([upx_path, *UPX_STRATEGIES[strategy][0], "-o", output, file_path],
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    seconds = time.perf_counter() - start
+                    row = rows[strategy]
+                    row['files'] += 1
+                    row['bytes'] += size
+                    row['build_seconds'] += seconds
+                    run = {'file': os.path.relpath(file_path, folder_path), 'strategy': strategy, 'bytes': size,
+                           'packed': size, 'build_seconds': seconds, 'launch_seconds': 0.0, 'failed': False}
+                    runs.append(run)
+                    pbar.update(1)
+                    if result.returncode or not os.path.exists(output):
+                        row['failed'] += 1
+                        row['packed'] += size
+                        run['failed'] = True
+                        new_results[key] = {'status': 'failed', 'strategy': strategy, 'size': size, 'seconds': seconds}
+                        continue
+
+                    # "upx -t" unpacks in memory like the loader does at every launch
+                    start = time.perf_counter()
+                    subprocess.run([upx_path, "-t", output], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    run['launch_seconds'] = time.perf_counter() - start
+                    run['packed'] = os.path.getsize(output)
+                    row['packed'] += run['packed']
+                    row['launch_seconds'] += run['launch_seconds']
+                    new_results[key] = {'status': 'packed', 'strategy': strategy, 'size': size, 'packed': run['packed'],
+                                        'seconds': seconds}
+                    if _upx_saving(new_results[key]) >= min_saving:
+                        cached_file = os.path.join(upx_cache, f"{key}.bin")
+                        shutil.move(output, cached_file)
+                        cache.stored(cached_file)
+                    else:
+                        os.remove(output)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    if new_results:
+        _save_upx_results(results_path, new_results)
+
+    report = {'strategies': list(rows.values()), 'runs': runs}
+    with open(base_path + '.upx.json', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    text = format_upx_benchmark(report)
+    with open(base_path + '.upx.txt', 'w', encoding='utf-8') as f:
+        f.write(text)
+    info(f"UPX benchmark written to {base_path}.upx.txt:\n" + text.rstrip())
+    return report
+
+
+def format_upx_benchmark(report):
+    mb = 1048576
+    rows = report['strategies']
+    total = rows[0]['bytes'] if rows else 0
+    lines = [f"{rows[0]['files'] if rows else 0} files, {total / mb:.2f} MB. "
+             "Launch is the time to unpack them all, measured with upx -t",
+             f"{'Preset':<8} {'Build (s)':>10} {'Packed (MB)':>12} {'Saved (MB)':>11} {'Launch (s)':>11} {'Failed':>7}"]
+    for row in rows:
+        lines.append(f"{row['strategy']:<8} {row['build_seconds']:10.1f} {row['packed'] / mb:12.2f} "
+                     f"{(row['bytes'] - row['packed']) / mb:11.2f} {row['launch_seconds']:11.2f} {row['failed']:7}")
+    return '\n'.join(lines) + '\n'
+
+
+def compress_file_with_upx(file_path, strategy=UPX_DEFAULT_STRATEGY):
+    upx_path = _upx_binary(False)
+    if upx_path is None:
+        return
     if os.path.isfile(file_path):
-        subprocess.run([upx_path, "--brute", '--force', file_path], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        links.break_link(file_path)
+        subprocess.run([upx_path, *UPX_STRATEGIES[strategy][0], '--force', file_path],
+                       stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
@@ -3,11 +3,22 @@ import os
 import logging
 import shutil
 import importlib.util
+import importlib.machinery
 import platform
 import configparser
+from components import exclude, manifest, profiler
 from components.plugins import get_special_cases
 from logging import info
 
+# __pycache__ folders are deleted before compiling anyway, no point copying them
+PYCACHE = shutil.ignore_patterns('__pycache__')
+MODULE_SUFFIXES = tuple(importlib.machinery.all_suffixes())
+# Packages that import their submodules by computed names, tree shaking can't see those
+SHAKE_KEEP_WHOLE = {'encodings'}
+
+# (module, bytes) left out by tree shaking in the last copy_dependencies
+excluded = []
+
 
 def find_python_home():
     python_exe = sys.executable
@@ -38,7 +49,7 @@ def find_dlls_with_phrase(directory, phrase):
 def copy_dlls_folder(folder_path, python_dir, disable_dll=False):
     if platform.system() == "Windows" and not disable_dll:
         try:
-            shutil.copytree(os.path.join(python_dir, "DLLs"), os.path.join(folder_path, "DLLs"))
+            manifest.stage_tree(os.path.join(python_dir, "DLLs"), os.path.join(folder_path, "DLLs"))
             info(f"Copied Python DLL folder to {folder_path}")
         except FileNotFoundError:
             logging.warning("Dlls folder not found")
@@ -54,13 +65,13 @@ def copy_python_executable(folder_path, disable_python_environment, disable_dll)
         copy_dlls_folder(folder_path, python_dir, disable_dll)
 
     if not disable_python_environment:
-        shutil.copy(python_executable, os.path.join(folder_path, "python.exe" if os.name == 'nt' else 'python'))
+        manifest.stage_copy(python_executable, os.path.join(folder_path, "python.exe" if os.name == 'nt' else 'python'))
         info(f"Copied Python executable to {folder_path}")
     python_dir = os.path.dirname(python_executable)
 
     for dll_phrase in ['python', 'vcruntime']:
         for dll in find_dlls_with_phrase(python_dir, dll_phrase):
-            shutil.copy(dll, folder_path)
+            manifest.stage_copy(dll, folder_path)
 
 
 def copy_tk(folder_path):
@@ -78,9 +89,7 @@ def copy_tk(folder_path):
                 if os.path.isdir(item_path) and phrase.lower() in item.lower():
                     destination_path = os.path.join(folder_path, 'lib', item)
                     try:
-                        if os.path.exists(destination_path):
-                            shutil.rmtree(destination_path)
-                        shutil.copytree(item_path, os.path.join(destination_path))
+                        manifest.stage_tree(item_path, destination_path)
                     except IOError as e:
                         logging.error(f"Error copying {item_path} to {destination_path}: {e}")
 
@@ -96,7 +105,7 @@ def copy_scripts(files, folder_path):
     for filename in files:
         file = os.path.join(os.path.dirname(sys.executable), "Scripts", filename)
         if os.path.exists(file):
-            shutil.copy2(file, os.path.join(folder_path, "Scripts", filename))
+            manifest.stage_copy(file, os.path.join(folder_path, "Scripts", filename))
             logging.debug(f"Copied {filename} to build")
         else:
             logging.warning(f"{filename} not found in Scripts dir")
@@ -104,16 +113,71 @@ def copy_scripts(files, folder_path):
 
 def copy_include(folder_path):
     include_path = os.path.join(os.path.dirname(sys.executable), "include")
-    shutil.copytree(include_path, os.path.join(folder_path, 'include'))
+    manifest.stage_tree(include_path, os.path.join(folder_path, 'include'))
     info('Copied include folder to build')
 
 
-def copy_dependencies(cleaned_modules, lib_path, folder_path, source_dir, disable_lib_compressing):
+def _module_of(package_name, rel_dir, filename):
+    # "foo.cpython-311-x86_64-linux-gnu.so" -> "foo", "__init__.py" -> the package itself
+    stem = filename.split('.')[0]
+    parts = [package_name] + ([part for part in rel_dir.split(os.sep) if part not in ('', '.')])
+    return '.'.join(parts if stem == '__init__' else parts + [stem])
+
+
+def _folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+def shaken_ignore(package_folder, reached):
+    # An ignore for stage_tree that drops the submodules that are never reached, data files stay.
+    # A subpackage that is never reached is left out with everything in it.
+    package_name = os.path.basename(package_folder)
+
+    def ignore(root, names):
+        rel_dir = os.path.relpath(root, package_folder)
+        ignored = {'__pycache__'}
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                module = _module_of(package_name, os.path.join(rel_dir, name), '__init__.py')
+                # Folders without an __init__ are data or namespace packages, they go with their parent
+                is_package = any(os.path.exists(os.path.join(path, f'__init__{suffix}')) for suffix in MODULE_SUFFIXES)
+                if name != '__pycache__' and is_package and module not in reached:
+                    excluded.append((module, _folder_size(path)))
+                    ignored.add(name)
+            elif name.endswith(MODULE_SUFFIXES) and not name.startswith('__init__.') and name.split('.')[0].isidentifier():
+                module = _module_of(package_name, rel_dir, name)
+                if module not in reached:
+                    excluded.append((module, os.path.getsize(path)))
+                    ignored.add(name)
+        return ignored
+    return ignore
+
+
+def write_excluded_report(report_path):
+    modules = {}
+    for module, size in excluded:
+        modules[module] = modules.get(module, 0) + size
+    total = sum(modules.values())
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write(f"# {len(modules)} modules left out by tree shaking ({total / 1048576:.2f} MB)\n")
+        f.write("# Add the top-level package with --package to copy it whole if one of them is needed\n")
+        for module in sorted(modules):
+            f.write(f"{module}\t{modules[module]}\n")
+    info(f"Tree shaking excluded {len(modules)} modules ({total / 1048576:.2f} MB), see {report_path}")
+
+
+def copy_dependencies(cleaned_modules, lib_path, folder_path, source_dir, disable_lib_compressing, reached=None,
+                      keep_whole=()):
+    # reached is every dotted module the import resolver found, only used for tree shaking
     special_cases = list(get_special_cases())
+    excluded.clear()
+    reached = set(reached) if reached is not None else None
 
     for module_name in cleaned_modules:
         if module_name == '__main__':
             continue
+        manifest.set_owner(module_name)
 
         ran_plugin = False
         for import_name, body, top, continue_after in special_cases:
@@ -121,7 +185,8 @@ def copy_dependencies(cleaned_modules, lib_path, folder_path, source_dir, disabl
             if module_name == import_name and import_name not in skip:
                 ran_plugin = True
                 if top:
-                    exec(body, globals(), locals())
+                    with profiler.span(f"special_case {import_name}", 'plugin'):
+                        exec(body, globals(), locals())
                     skip.append(import_name)
                 if not continue_after:
                     continue
@@ -135,7 +200,8 @@ def copy_dependencies(cleaned_modules, lib_path, folder_path, source_dir, disabl
                     # the python interpreter it doesn't find it for some reason
                     target_path = os.path.join(folder_path, "local" if not disable_lib_compressing else "lib", module_name)
                     try:
-                        shutil.copytree(local_folder, target_path)
+                        manifest.stage_tree(local_folder, target_path,
+                                            ignore=exclude.ignore_for(module_name, local_folder, PYCACHE))
                         if logging.DEBUG >= logging.root.level:
                             logging.debug(f"Copied local folder from {local_folder} to {target_path}")
                         else:
@@ -151,20 +217,23 @@ def copy_dependencies(cleaned_modules, lib_path, folder_path, source_dir, disabl
                 package_folder = os.path.dirname(origin_path)
                 target_path = os.path.join(lib_path, os.path.basename(package_folder))
                 try:
-                    if os.path.exists(target_path):
-                        shutil.rmtree(target_path)
-                    shutil.copytree(package_folder, target_path)
+                    shaking = reached is not None and module_name not in keep_whole and module_name not in SHAKE_KEEP_WHOLE
+                    ignore = shaken_ignore(package_folder, reached) if shaking else PYCACHE
+                    manifest.stage_tree(package_folder, target_path,
+                                        ignore=exclude.ignore_for(module_name, package_folder, ignore))
                     if logging.DEBUG >= logging.root.level:
                         logging.debug(f"Copied package from {package_folder} to {target_path}")
                     else:
                         info(f"Copied package folder: {os.path.basename(package_folder)}")
                 except Exception as e:
                     logging.error(f"Error copying package folder {package_folder}: {e}")
+            elif exclude.skip_file(module_name, origin_path):
+                logging.debug(f"Excluded module file {origin_path}")
             else:
                 if origin_path.endswith('.pyd'):
                     try:
-                        shutil.copy2(origin_path, os.path.join(os.path.join(os.path.dirname(lib_path), 'DLLs'),
-                                                               os.path.basename(origin_path)))
+                        manifest.stage_copy(origin_path, os.path.join(os.path.join(os.path.dirname(lib_path), 'DLLs'),
+                                                                      os.path.basename(origin_path)))
                         if logging.DEBUG >= logging.root.level:
                             logging.debug(
                                 f"Copied PYD from {origin_path} to {os.path.join(os.path.dirname(lib_path), 'DLLs')}")
@@ -174,7 +243,7 @@ def copy_dependencies(cleaned_modules, lib_path, folder_path, source_dir, disabl
                         logging.error(f"Error copying module PYD {origin_path}: {e}")
                 else:
                     try:
-                        shutil.copy2(origin_path, os.path.join(lib_path, os.path.basename(origin_path)))
+                        manifest.stage_copy(origin_path, os.path.join(lib_path, os.path.basename(origin_path)))
                         if logging.DEBUG >= logging.root.level:
                             logging.debug(f"Copied module file from {origin_path} to {lib_path}")
                         info(f"Copied package file: {os.path.basename(origin_path)}")
@@ -189,5 +258,7 @@ def copy_dependencies(cleaned_modules, lib_path, folder_path, source_dir, disabl
             skip = []
             for import_name, body, top, continue_after in special_cases:
                 if module_name == import_name and not top and import_name not in skip:
-                    exec(body, globals(), locals())
+                    with profiler.span(f"special_case {import_name}", 'plugin'):
+                        exec(body, globals(), locals())
                     skip.append(import_name)
+    manifest.set_owner(None)
@@ -8,6 +8,7 @@ import stat
 import tarfile
 from datetime import datetime, timezone
 from logging import info
+from components import cache
 
 
 def request_download(prompt, noconfirm):
@@ -44,6 +45,7 @@ def download_resourcehacker(cache_path, noconfirm):
         zip_ref.extractall(cache_path)
 
     os.remove(zip_filename)
+    cache.stored(cache_path)
     info(f"Files extracted to: {cache_path}")
 
 
@@ -66,12 +68,7 @@ def download_and_update_linked_imports(cache_file="linked_imports.json", timesta
 def install_upx(noconfirm):
     system = platform.system()
 
-    if system == "Windows":
-        base_dir = os.environ.get("LOCALAPPDATA", os.path.expanduser("~/appdata/local"))
-    else:
-        base_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
-
-    dest_folder = os.path.join(base_dir, "PyCompyle.cache")
+    dest_folder = cache.get_cache_path()
     os.makedirs(dest_folder, exist_ok=True)
 
     api_url = "https://api.github.com/repos/upx/upx/releases/latest"
@@ -165,6 +162,7 @@ def install_upx(noconfirm):
         st = os.stat(final_path)
         os.chmod(final_path, st.st_mode | stat.S_IEXEC)
 
+    cache.stored(final_path)
     logging.debug(f"UPX installed at {final_path}")
 
     return final_path
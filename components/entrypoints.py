@@ -0,0 +1,46 @@
+import os
+import logging
+from logging import info
+from components import bytecode
+
+# Picks the entry point by the name of the executable that started it (the bootloader sets sys.argv[0]),
+# PYCOMPYLE_ENTRY wins so batchfiles can choose too
+DISPATCHER = """import os
+import sys
+ENTRY_POINTS = {names!r}
+name = os.environ.get('PYCOMPYLE_ENTRY') or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+__import__('__main_%s__' % (name if name in ENTRY_POINTS else ENTRY_POINTS[0]))
+"""
+
+
+def entry_name(source_file):
+    return os.path.splitext(os.path.basename(source_file))[0]
+
+
+def module_file(folder_path, name):
+    return os.path.join(folder_path, f'__main_{name}__.py')
+
+
+def stage_entry_points(source_files, folder_path):
+    names = [entry_name(source_file) for source_file in source_files]
+    for source_file, name in zip(source_files, names):
+        with open(source_file, 'r') as f:
+            content = f.read()
+        # Same trick as compile_main, the entry runs as an imported module
+        with open(module_file(folder_path, name), 'w') as f:
+            f.write("__name__ = '__main__'\n" + content)
+        info(f"{os.path.basename(source_file)} copied")
+
+    with open(os.path.join(folder_path, '__main__.py'), 'w') as f:
+        f.write(DISPATCHER.format(names=names))
+    return names
+
+
+def compile_entry_points(folder_path, names):
+    for name in names:
+        py_file_path = module_file(folder_path, name)
+        try:
+            bytecode.compile_file(py_file_path, py_file_path + 'c', os.path.relpath(py_file_path, folder_path))
+            os.remove(py_file_path)
+        except Exception as e:
+            logging.error(f"Failed to compile entry point {name}: {e}")
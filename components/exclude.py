@@ -0,0 +1,150 @@
+import os
+import re
+import json
+import fnmatch
+from logging import info
+
+# Never needed at runtime. Matched against the path inside a package or local folder, single modules by their
+# file name. "dir/" only matches folders, a leading "/" anchors to the package root, "re:" patterns are regexes
+# on that path. Cython sources (*.pyx, *.pxd) stay, the cython plugin compiles them.
+DEFAULT_EXCLUDES = [
+    '__pycache__/',
+    '*.pyi',
+    'py.typed',
+    '*.h',
+    '*.hpp',
+]
+# Opt-in with --exclude-dev-folders, only at the package root: some packages import from their own tests
+# (e.g. numpy.testing's helpers), so deeper folders with these names are kept
+DEV_FOLDER_EXCLUDES = ['/tests/', '/docs/', '/doc/', '/examples/']
+
+# Set up by configure(), None means nothing is excluded
+active = None
+# package -> [files, bytes] left out
+saved = {}
+
+
+class Pattern:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.dir_only = pattern.endswith('/') and not pattern.startswith('re:')
+        if pattern.startswith('re:'):
+            self.regex = re.compile(pattern[3:])
+        else:
+            glob = pattern.rstrip('/')
+            # Without a slash it matches the name at any depth, like .gitignore
+            self.anchored = '/' in glob
+            self.regex = re.compile(fnmatch.translate(glob.lstrip('/')))
+
+    def matches(self, rel_path, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        if self.pattern.startswith('re:'):
+            return self.regex.search(rel_path + ('/' if is_dir else '')) is not None
+        return self.regex.match(rel_path if self.anchored else rel_path.rsplit('/', 1)[-1]) is not None
+
+
+class Rules:
+    def __init__(self, exclude=(), include=(), packages=None):
+        self.exclude = [Pattern(pattern) for pattern in exclude]
+        self.include = [Pattern(pattern) for pattern in include]
+        # package -> {'exclude': [...], 'include': [...]}
+        self.packages = {name: {kind: [Pattern(pattern) for pattern in rules.get(kind, [])]
+                                for kind in ('exclude', 'include')}
+                         for name, rules in (packages or {}).items()}
+
+    def excluded(self, package, rel_path, is_dir):
+        # Includes win over excludes, and the package's own rules over the global ones
+        own = self.packages.get(package, {})
+        if any(pattern.matches(rel_path, is_dir) for pattern in own.get('include', ())):
+            return False
+        if any(pattern.matches(rel_path, is_dir) for pattern in own.get('exclude', ())):
+            return True
+        if any(pattern.matches(rel_path, is_dir) for pattern in self.include):
+            return False
+        return any(pattern.matches(rel_path, is_dir) for pattern in self.exclude)
+
+
+def load_rules_file(path):
+    # {"exclude": [...], "include": [...], "packages": {"name": {"exclude": [...], "include": [...]}}}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected an object with exclude, include and packages")
+    return data
+
+
+def configure(exclude=(), rules_files=(), defaults=True, dev_folders=False):
+    global active
+    rules = {'exclude': list(DEFAULT_EXCLUDES) if defaults else [], 'include': [], 'packages': {}}
+    if dev_folders:
+        rules['exclude'].extend(DEV_FOLDER_EXCLUDES)
+    rules['exclude'].extend(exclude)
+    for rules_file in rules_files:
+        data = load_rules_file(rules_file)
+        rules['exclude'].extend(data.get('exclude', []))
+        rules['include'].extend(data.get('include', []))
+        for name, package_rules in data.get('packages', {}).items():
+            merged = rules['packages'].setdefault(name, {'exclude': [], 'include': []})
+            merged['exclude'].extend(package_rules.get('exclude', []))
+            merged['include'].extend(package_rules.get('include', []))
+    active = Rules(**rules) if rules['exclude'] or rules['packages'] else None
+    saved.clear()
+    return active
+
+
+def _size(path):
+    # Only stats, excluded files are never opened
+    if not os.path.isdir(path):
+        return 1, os.path.getsize(path)
+    files = total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(root, name))
+    return files, total
+
+
+def _record(package, path):
+    files, size = _size(path)
+    counts = saved.setdefault(package, [0, 0])
+    counts[0] += files
+    counts[1] += size
+
+
+def skip_file(module, path):
+    # Single-file modules and PYDs go through the same rules as the files of a package
+    if active is None or not active.excluded(module, os.path.basename(path), False):
+        return False
+    _record(module, path)
+    return True
+
+
+def ignore_for(package, package_folder, ignore=None):
+    # Wraps a stage_tree ignore so the exclusion rules are applied on the way
+    if active is None:
+        return ignore
+
+    def apply(root, names):
+        ignored = set(ignore(root, names)) if ignore else set()
+        rel_dir = os.path.relpath(root, package_folder).replace(os.sep, '/')
+        for name in names:
+            if name in ignored:
+                continue
+            path = os.path.join(root, name)
+            rel_path = name if rel_dir == '.' else f'{rel_dir}/{name}'
+            if active.excluded(package, rel_path, os.path.isdir(path)):
+                ignored.add(name)
+                _record(package, path)
+        return ignored
+    return apply
+
+
+def report():
+    if not saved:
+        return
+    total_files = sum(files for files, _ in saved.values())
+    total_bytes = sum(size for _, size in saved.values())
+    info(f"Exclusion rules skipped {total_files} files ({total_bytes / 1048576:.2f} MB)")
+    for package, (files, size) in sorted(saved.items(), key=lambda item: -item[1][1]):
+        info(f"  {package}: {files} files, {size / 1048576:.2f} MB")
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from components import cache, iostats
+
+try:
+    import xxhash
+    ALGORITHM = 'xxh3_128'
+except ImportError:  # optional, much faster than sha256 on big binaries
+    xxhash = None
+    ALGORITHM = 'sha256'
+
+INDEX_VERSION = 1
+# Digests are only cache keys, so the index holds the most recently used files and forgets the rest
+MAX_ENTRIES = 100000
+# A file written this close to when it was hashed can change again without its mtime moving, it isn't remembered
+RACY_SECONDS = 2
+
+_lock = threading.Lock()
+# file path -> [size, mtime_ns, inode, digest, day last used]
+_files = None
+_changed = {}
+stats = {'reused': 0, 'hashed': 0}
+
+
+def get_index_path():
+    return cache.get_cache_path('hashes.json')
+
+
+def hasher(data=b''):
+    return xxhash.xxh3_128(data) if xxhash is not None else hashlib.sha256(data)
+
+
+def _read_index():
+    try:
+        with open(get_index_path(), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION and index.get('algorithm') == ALGORITHM:
+            return index['files']
+    except (OSError, ValueError, AttributeError, KeyError):
+        pass
+    return None
+
+
+def _load():
+    # Runs under _lock
+    global _files
+    if _files is None:
+        _files = _read_index()
+        if _files is None:
+            cache.miss(get_index_path())
+            _files = {}
+        else:
+            cache.hit(get_index_path())
+    return _files
+
+
+def file_digest(path):
+    # Reads the whole file, without the index. Worker processes use this and hand the digest to remember().
+    h = hasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+        iostats.read(f.tell())
+    return h.hexdigest()
+
+
+def remember(path, st, digest):
+    if time.time() - st.st_mtime < RACY_SECONDS:
+        return
+    path = os.path.abspath(path)
+    entry = [st.st_size, st.st_mtime_ns, st.st_ino, digest, int(time.time() // 86400)]
+    with _lock:
+        _load()[path] = entry
+        _changed[path] = entry
+
+
+def digest(path, st=None):
+    # Hex digest of the file, only read again when its size, mtime or inode changed. None when it doesn't exist.
+    path = os.path.abspath(path)
+    try:
+        st = st or os.stat(path)
+    except OSError:
+        return None
+    today = int(time.time() // 86400)
+    with _lock:
+        entry = _load().get(path)
+        if entry is not None and entry[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+            stats['reused'] += 1
+            if entry[4] != today:
+                entry[4] = today
+                _changed[path] = entry
+            return entry[3]
+    try:
+        found = file_digest(path)
+    except OSError:
+        return None
+    with _lock:
+        stats['hashed'] += 1
+    remember(path, st, found)
+    return found
+
+
+def save():
+    # Merges this process' entries into the index on disk, another build may have saved in the meantime
+    with _lock:
+        if not _changed:
+            return
+        changed = dict(_changed)
+        _changed.clear()
+    files = _read_index() or {}
+    files.update(changed)
+    if len(files) > MAX_ENTRIES:
+        files = dict(sorted(files.items(), key=lambda item: -item[1][4])[:MAX_ENTRIES])
+    try:
+        cache.write_atomic(get_index_path(), json.dumps({'version': INDEX_VERSION, 'algorithm': ALGORITHM,
+                                                         'files': files}).encode('utf-8'))
+        cache.stored(get_index_path())
+    except OSError as e:
+        logging.debug(f"Couldn't save the hash index: {e}")
+    logging.debug(f"Hash index: {stats['reused']} files reused, {stats['hashed']} hashed")
+    stats.update(reused=0, hashed=0)
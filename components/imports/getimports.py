@@ -1,18 +1,56 @@
 import ast
 import os
+import json
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from components import cache, hashindex
+
+# Below this many files starting worker processes costs more than it saves
+MIN_PARALLEL_FILES = 64
+
+# file path -> (mtime_ns, size, module root, imports), so a resident --watch process only reparses changed files
+_parsed = {}
+# On disk between builds: file path -> [size, mtime_ns, digest, module root, imports]
+_index = None
+_index_dirty = False
+
+
+def get_scan_index_path():
+    return cache.get_cache_path('scan', 'index.json')
+
+
+def _load_index():
+    global _index
+    if _index is None:
+        try:
+            with open(get_scan_index_path(), 'r', encoding='utf-8') as f:
+                _index = json.load(f)
+            cache.hit(get_scan_index_path())
+        except (OSError, ValueError):
+            cache.miss(get_scan_index_path())
+            _index = {}
+    return _index
+
+
+def save_index():
+    global _index_dirty
+    if not _index_dirty:
+        return
+    # Forget files that were deleted or renamed since
+    index = {path: entry for path, entry in _load_index().items() if os.path.exists(path)}
+    try:
+        cache.write_atomic(get_scan_index_path(), json.dumps(index).encode('utf-8'))
+        cache.stored(get_scan_index_path())
+        _index_dirty = False
+    except OSError as e:
+        logging.debug(f"Couldn't save the import scan index: {e}")
 
 
-def get_imports_from_file(file_path, module_root):
-    imports = set()
-
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            tree = ast.parse(f.read(), filename=file_path)
-    except (OSError, IOError, SyntaxError) as e:
-        logging.error(f"Failed to parse {file_path}: {e}")
-        return imports
+def parse_imports(file_path, module_root):
+    with open(file_path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=file_path)
 
+    imports = set()
     rel_module_path = os.path.relpath(file_path, module_root).replace(os.sep, ".").rstrip(".py")
     rel_module_parts = rel_module_path.split(".")[:-1]  # remove filename
 
@@ -31,10 +69,93 @@ def get_imports_from_file(file_path, module_root):
                     imports.add(full_module)
             elif node.module:
                 imports.add(node.module)
-
     return imports
 
 
+def _scan_chunk(jobs):
+    results = []
+    for file_path, module_root in jobs:
+        try:
+            results.append((file_path, sorted(parse_imports(file_path, module_root)), hashindex.file_digest(file_path), None))
+        except (OSError, IOError, SyntaxError, ValueError) as e:
+            results.append((file_path, None, None, str(e)))
+    return results
+
+
+def _scan_files(jobs, workers=None):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) < MIN_PARALLEL_FILES:
+        return _scan_chunk(jobs)
+
+    chunk_size = max(1, len(jobs) // (workers * 4))
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return [result for chunk in executor.map(_scan_chunk, chunks) for result in chunk]
+    except (OSError, RuntimeError) as e:
+        logging.warning(f"Parallel import scanning unavailable ({e}), scanning in a single process")
+        return _scan_chunk(jobs)
+
+
+def _cached_imports(file_path, module_root, st):
+    global _index_dirty
+    cached = _parsed.get(file_path)
+    if cached is not None and cached[:3] == (st.st_mtime_ns, st.st_size, module_root):
+        return set(cached[3])
+
+    entry = _load_index().get(file_path)
+    if entry is None or entry[0] != st.st_size or entry[3] != module_root:
+        return None
+    if entry[1] != st.st_mtime_ns:
+        # Touched but maybe not changed, e.g. by a checkout
+        if hashindex.digest(file_path, st) != entry[2]:
+            return None
+        entry[1] = st.st_mtime_ns
+        _index_dirty = True
+    _parsed[file_path] = (st.st_mtime_ns, st.st_size, module_root, frozenset(entry[4]))
+    return set(entry[4])
+
+
+def get_imports_from_files(file_paths, module_root, workers=None):
+    # Reuses the imports of unchanged files and parses the rest in parallel
+    global _index_dirty
+    found = {}
+    stats = {}
+    jobs = []
+    for file_path in file_paths:
+        try:
+            st = os.stat(file_path)
+        except OSError as e:
+            logging.error(f"Failed to parse {file_path}: {e}")
+            found[file_path] = set()
+            continue
+        imports = _cached_imports(file_path, module_root, st)
+        if imports is None:
+            stats[file_path] = st
+            jobs.append((file_path, module_root))
+        else:
+            found[file_path] = imports
+
+    if jobs:
+        logging.debug(f"Scanning {len(jobs)} files for imports ({len(found)} unchanged)")
+    for file_path, imports, file_hash, failure in _scan_files(jobs, workers) if jobs else ():
+        if failure is not None:
+            logging.error(f"Failed to parse {file_path}: {failure}")
+            found[file_path] = set()
+            continue
+        st = stats[file_path]
+        _parsed[file_path] = (st.st_mtime_ns, st.st_size, module_root, frozenset(imports))
+        _load_index()[file_path] = [st.st_size, st.st_mtime_ns, file_hash, module_root, imports]
+        hashindex.remember(file_path, st, file_hash)
+        _index_dirty = True
+        found[file_path] = set(imports)
+    return found
+
+
+def get_imports_from_file(file_path, module_root):
+    return get_imports_from_files([file_path], module_root, workers=1)[file_path]
+
+
 def resolve_local_path(module_name, base_dir):
     parts = module_name.split('.')
     py_file = os.path.join(base_dir, *parts) + ".py"
@@ -52,28 +173,35 @@ def resolve_local_path(module_name, base_dir):
     return results
 
 
-def recursive_imports(entry_file, visited=None, base_dir=None):
+def recursive_imports(entry_file, visited=None, base_dir=None, workers=None, dotted=None):
+    # Returns the top-level names, dotted collects the full names every local file imports
     if visited is None:
         visited = set()
     if base_dir is None:
         base_dir = os.path.dirname(os.path.abspath(entry_file))
 
+    # Breadth first, so every level of the local import tree is scanned as one parallel batch
     to_process = [entry_file]
     top_level = set()
+    local_paths = {}  # the same packages are imported from many files, walk their folders once
 
     while to_process:
-        current_file = to_process.pop()
-        if current_file in visited:
-            continue
-        visited.add(current_file)
-
-        imports = get_imports_from_file(current_file, base_dir)
-        for imp in imports:
-            top = imp.split('.')[0]
-            top_level.add(top)
-
-            for path in resolve_local_path(imp, base_dir):
-                if path not in visited:
-                    to_process.append(path)
-
+        batch = [file for file in dict.fromkeys(to_process) if file not in visited]
+        visited.update(batch)
+        to_process = []
+
+        for imports in get_imports_from_files(batch, base_dir, workers).values():
+            if dotted is not None:
+                dotted.update(imports)
+            for imp in imports:
+                top = imp.split('.')[0]
+                top_level.add(top)
+
+                if imp not in local_paths:
+                    local_paths[imp] = resolve_local_path(imp, base_dir)
+                for path in local_paths[imp]:
+                    if path not in visited:
+                        to_process.append(path)
+
+    save_index()
     return top_level
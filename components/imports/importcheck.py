@@ -4,22 +4,95 @@ import logging
 import sys
 import ast
 import json
-import shutil
+import time
 from datetime import datetime, timedelta, timezone
 from logging import info
-from components.imports import getimports
-from components import download
+from components.imports import getimports, modulegraph
+from components import cache, download, hashindex
+
+LINKED_INDEX_VERSION = 1
+# What --force-refresh throws away
+FORCE_REFRESH_KINDS = ['linked_imports', 'imports', 'scan']
+
+# (raw imports, packages) -> modules, reused by --watch until the environment changes
+_checked = {}
+
+
+def get_import_cache_path():
+    return cache.get_cache_path('imports')
+
+
+def environment_fingerprint(source_dir):
+    # Installing, upgrading or removing a distribution changes the dist-info names or the folder mtimes
+    fingerprint = []
+    for path in sys.path:
+        path = os.path.abspath(path or '.')
+        if path == source_dir or not os.path.isdir(path):
+            continue
+        try:
+            entries = os.listdir(path)
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        dists = sorted(entry for entry in entries if entry.endswith(('.dist-info', '.egg-info', '.pth', '.egg-link')))
+        fingerprint.append([path, mtime, dists])
+    return fingerprint
+
+
+def results_cache_key(raw_imports, packages, resolver, source_dir, linked_imports, submodules=False, dotted_imports=()):
+    h = hashindex.hasher()
+    h.update(json.dumps([
+        sys.executable,
+        sys.version,
+        source_dir,
+        resolver,
+        submodules,
+        sorted(raw_imports),
+        sorted(dotted_imports),
+        sorted(packages),
+        environment_fingerprint(source_dir),
+        linked_imports,
+    ], sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_cached_results(cache_key):
+    cache_file = os.path.join(get_import_cache_path(), f"{cache_key}.json")
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        cache.hit(cache_file)
+        return data['modules'], data.get('submodules')
+    except (OSError, ValueError, KeyError):
+        cache.miss(cache_file)
+        return None
+
+
+def save_cached_results(cache_key, modules, submodules=None):
+    cache_dir = get_import_cache_path()
+    data = {'modules': modules, 'submodules': submodules}
+    try:
+        cache_file = os.path.join(cache_dir, f"{cache_key}.json")
+        cache.write_atomic(cache_file, json.dumps(data).encode('utf-8'))
+        cache.stored(cache_file)
+    except OSError as e:
+        logging.warning(f"Failed to cache the import results: {e}")
 
 
 def load_linked_imports(force_refresh=False):
-    local_appdata = os.environ.get("LOCALAPPDATA") if os.name == 'nt' else os.path.expanduser('~/.cache')
-    cache_dir = os.path.join(local_appdata, "PyCompyle.cache")
+    return _read_linked_imports(force_refresh)[1]
+
+
+def _read_linked_imports(force_refresh=False):
+    # -> (the file that was used or None, its contents)
+    cache_dir = cache.get_cache_path()
     cache_file = os.path.join(cache_dir, "linked_imports.json")
     timestamp_file = os.path.join(cache_dir, "linked_imports.timestamp")
     refresh_interval = timedelta(hours=24)
     local_json = os.path.join(os.path.dirname(sys.modules["__main__"].__file__), "linked_imports.json")  # type: ignore
     if force_refresh:
-        shutil.rmtree(cache_dir, ignore_errors=True)
+        # Only what can go stale, the compiled bytecode, UPX output and tools are keyed by their contents
+        cache.clear(FORCE_REFRESH_KINDS)
 
     os.makedirs(cache_dir, exist_ok=True)
 
@@ -36,7 +109,11 @@ def load_linked_imports(force_refresh=False):
             needs_refresh = True
 
     if needs_refresh:
+        cache.miss(cache_file)
         download.download_and_update_linked_imports(cache_file, timestamp_file)
+        if os.path.exists(timestamp_file):
+            cache.stored(cache_file)
+            cache.stored(timestamp_file)
 
     # type: ignore
     if os.path.exists(local_json) and os.path.exists(
@@ -44,7 +121,7 @@ def load_linked_imports(force_refresh=False):
         try:
             with open(local_json, "r", encoding="utf-8") as f:
                 logging.info("Using local linked_imports.json")
-                return json.load(f)
+                return local_json, json.load(f)
         except Exception as e:
             logging.warning(f"Local linked_imports.json invalid: {e}")
 
@@ -52,7 +129,11 @@ def load_linked_imports(force_refresh=False):
         try:
             with open(cache_file, "r", encoding="utf-8") as f:
                 logging.info("Using cached linked_imports.json (from cache directory)")
-                return json.load(f)
+                linked_map = json.load(f)
+            if not needs_refresh:
+                cache.hit(cache_file)
+                cache.hit(timestamp_file)
+            return cache_file, linked_map
         except Exception as e:
             logging.warning(f"Cached linked_imports.json invalid: {e}")
 
@@ -60,24 +141,96 @@ def load_linked_imports(force_refresh=False):
         try:
             with open(local_json, "r", encoding="utf-8") as f:
                 logging.info("Using local linked_imports.json (same folder as script)")
-                return json.load(f)
+                return local_json, json.load(f)
         except Exception as e:
             logging.warning(f"Local linked_imports.json invalid: {e}")
     logging.warning("No valid linked_imports.json could be loaded from local or cache.")
-    return {}
+    return None, {}
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+        return [path, st.st_mtime_ns, st.st_size]
+    except (OSError, TypeError):
+        return [path, None, None]
+
+
+def load_hint_files(linked_map, hint_files):
+    # Hint files look like linked_imports.json, their links are added to the ones already there
+    merged = {module: list(linked) for module, linked in linked_map.items()}
+    for hint_file in hint_files:
+        try:
+            with open(hint_file, 'r', encoding='utf-8') as f:
+                hints = json.load(f)
+            if not isinstance(hints, dict) or not all(isinstance(linked, list) for linked in hints.values()):
+                raise ValueError('expected an object of module names to lists of module names')
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring import hints {hint_file}: {e}")
+            continue
+        for module, linked in hints.items():
+            merged[module] = sorted(set(merged.get(module, [])).union(linked))
+        logging.debug(f"Loaded {len(hints)} import hints from {hint_file}")
+    return merged
+
+
+def compile_linked_closure(linked_map):
+    # module -> every module it links to, directly or through other links
+    closure = {}
+    for module in linked_map:
+        resolved = set()
+        queue = list(linked_map[module])
+        while queue:
+            linked = queue.pop()
+            if linked not in resolved:
+                resolved.add(linked)
+                queue.extend(linked_map.get(linked, ()))
+        closure[module] = sorted(resolved)
+    return closure
 
 
-def resolve_linked_imports_recursive(base_modules, linked_map):
-    resolved = set()
-    queue = list(base_modules)
+def load_linked_index(force_refresh=False, hint_files=()):
+    # -> (linked map with the hints merged in, its transitive closure).
+    # The closure is kept next to the cached linked_imports.json until that file, its timestamp or a hint file changes.
+    source, linked_map = _read_linked_imports(force_refresh)
+    cache_dir = cache.get_cache_path()
+    index_file = os.path.join(cache_dir, 'linked_imports.index.json')
+    try:
+        with open(os.path.join(cache_dir, 'linked_imports.timestamp'), 'r') as tf:
+            timestamp = tf.read().strip()
+    except OSError:
+        timestamp = None
+    hint_files = [os.path.abspath(hint_file) for hint_file in hint_files]
+    stamp = [LINKED_INDEX_VERSION, _file_stamp(source), timestamp, [_file_stamp(path) for path in hint_files]]
+
+    try:
+        with open(index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index['stamp'] == stamp:
+            cache.hit(index_file)
+            return index['linked'], index['closure']
+    except (OSError, ValueError, KeyError):
+        pass
+    cache.miss(index_file)
 
-    while queue:
-        module = queue.pop()
-        if module not in resolved:
-            resolved.add(module)
-            linked = linked_map.get(module, [])
-            logging.debug(f"Module '{module}' links to: {linked}")
-            queue.extend(linked)
+    linked_map = load_hint_files(linked_map, hint_files)
+    closure = compile_linked_closure(linked_map)
+    if source is not None:
+        try:
+            cache.write_atomic(index_file, json.dumps({'stamp': stamp, 'linked': linked_map,
+                                                       'closure': closure}).encode('utf-8'))
+            cache.stored(index_file)
+        except OSError as e:
+            logging.debug(f"Couldn't save the linked imports index: {e}")
+    logging.debug(f"Compiled the linked imports index for {len(closure)} modules")
+    return linked_map, closure
+
+
+def resolve_linked_imports(base_modules, closure):
+    resolved = set(base_modules)
+    for module in base_modules:
+        resolved.update(closure.get(module, ()))
+    logging.debug(f"Linked imports added {len(resolved) - len(set(base_modules))} modules")
     return resolved
 
 
@@ -89,12 +242,8 @@ def run_import_checker(imports, source_dir, tmp_script_path, tmp_output_path):
         tmp_file.write(f"\nwith open(r'{tmp_output_path}', 'w') as out_file:")
         tmp_file.write('\n    out_file.write(str([m.__name__ for m in sys.modules.values() if m]))')
 
-    original_dir = os.getcwd()
-    try:
-        os.chdir(source_dir)
-        subprocess.run([sys.executable, tmp_script_path], check=True)
-    finally:
-        os.chdir(original_dir)
+    # cwd instead of os.chdir, other build stages run alongside this one
+    subprocess.run([sys.executable, tmp_script_path], check=True, cwd=source_dir)
 
     with open(tmp_output_path, "r") as out_file:
         output = out_file.read().strip()
@@ -109,7 +258,34 @@ def run_import_checker(imports, source_dir, tmp_script_path, tmp_output_path):
     return modules
 
 
-def process_imports(source_file_path, packages, keepfile, force_refresh=False):
+def resolve_statically(imports, packages, source_dir, linked_closure, submodules=False, entry_files=()):
+    # The PyCompyle folder is on sys.path too, the built app won't have it
+    pycompyle_dir = os.path.dirname(os.path.abspath(sys.modules["__main__"].__file__))  # type: ignore
+    graph = modulegraph.ModuleGraph([path for path in sys.path if os.path.abspath(path or '.') != pycompyle_dir])
+    graph.add(set(imports).union(modulegraph.startup_modules(source_dir)))
+    if submodules:
+        # The raw imports are top-level names only, tree shaking needs the submodules the scripts import
+        for entry_file in entry_files:
+            graph.add_script(entry_file)
+    while True:
+        modules = graph.top_level()
+        linked = resolve_linked_imports(modules.union(packages), linked_closure)
+        # Linked modules can import more modules themselves
+        new_modules = linked - modules - graph.found - graph.missing
+        if not new_modules:
+            break
+        graph.add(new_modules)
+
+    logging.debug(f"Unresolved imports: {sorted(name for name in graph.missing if '.' not in name)}")
+    if submodules:
+        graph.add_lazy(linked)
+        return sorted(linked), sorted(graph.found)
+    return sorted(linked), None
+
+
+def process_imports(source_file_path, packages, keepfile, force_refresh=False, entry_files=None,
+                    resolver='static', submodules=False, hint_files=()):
+    # With submodules=True (static resolver only) this returns (top-level modules, every reached module)
     source_dir = os.path.dirname(source_file_path)
     if source_dir not in sys.path:
         sys.path.insert(0, source_dir)
@@ -122,18 +298,48 @@ def process_imports(source_file_path, packages, keepfile, force_refresh=False):
             os.remove(tmp_path)
 
     info('Getting raw imports')
-    linked_imports = load_linked_imports(force_refresh)
-    raw_imports = getimports.recursive_imports(source_file_path)
+    linked_imports, linked_closure = load_linked_index(force_refresh, hint_files)
+    # Several entry points share one runtime, so they get one import closure
+    raw_imports = set()
+    # Tree shaking follows the submodules the local files import, so those decide whether a result can be reused
+    dotted_imports = set() if submodules else None
+    for entry_file in entry_files or [source_file_path]:
+        raw_imports |= getimports.recursive_imports(entry_file, dotted=dotted_imports)
     logging.debug(f"Raw imports from file: {raw_imports}")
 
-    info('Running import checker with raw imports')
+    key = (frozenset(raw_imports), frozenset(dotted_imports or ()), tuple(sorted(packages)), resolver, submodules)
+    if key in _checked and not force_refresh:
+        info('Imports unchanged, reusing the import checker results')
+        return _result(*_checked[key], submodules)
+
+    start = time.perf_counter()
+    cache_key = results_cache_key(raw_imports, packages, resolver, source_dir, linked_imports, submodules,
+                                  dotted_imports or ())
+    # --force-refresh already cleared the linked_imports, imports and scan caches
+    cached = load_cached_results(cache_key)
+    if cached is not None:
+        info(f"Imports and environment unchanged, using cached results ({len(cached[0])} modules, "
+             f"{time.perf_counter() - start:.2f}s)")
+        _checked[key] = cached
+        return _result(*cached, submodules)
+
     combined_imports = raw_imports.union(packages)
+    if resolver == 'static':
+        info('Resolving imports statically')
+        cleaned_modules, reached = resolve_statically(combined_imports, packages, source_dir, linked_closure,
+                                                      submodules, entry_files or [source_file_path])
+        info(f"Resolved {len(cleaned_modules)} modules in {time.perf_counter() - start:.2f}s (static resolver)")
+        _checked[key] = (cleaned_modules, reached)
+        save_cached_results(cache_key, cleaned_modules, reached)
+        return _result(cleaned_modules, reached, submodules)
+
+    info('Running import checker with raw imports')
     raw_modules = run_import_checker(combined_imports, source_dir, tmp_script_path, tmp_output_path)
-    raw_modules = resolve_linked_imports_recursive(raw_modules, linked_imports)
+    raw_modules = resolve_linked_imports(raw_modules, linked_closure)
     logging.debug(f"Modules from raw imports: {raw_modules}")
 
     cleaned_modules = set(mod.split('.')[0] for mod in raw_modules if mod and isinstance(mod, str))
-    cleaned_modules = resolve_linked_imports_recursive(cleaned_modules.union(packages), linked_imports)
+    cleaned_modules = resolve_linked_imports(cleaned_modules.union(packages), linked_closure)
     cleaned_modules = sorted(cleaned_modules)
     logging.debug(f"First cleaned modules (with linked deps): {cleaned_modules}")
 
@@ -142,7 +348,7 @@ def process_imports(source_file_path, packages, keepfile, force_refresh=False):
     logging.debug(f"Modules from cleaned imports: {cleaned_modules_result}")
 
     cleaned_modules = set(mod.split('.')[0] for mod in cleaned_modules_result if mod and isinstance(mod, str))
-    cleaned_modules = resolve_linked_imports_recursive(cleaned_modules.union(packages), linked_imports)
+    cleaned_modules = resolve_linked_imports(cleaned_modules.union(packages), linked_closure)
     cleaned_modules = sorted(cleaned_modules)
     logging.debug(f"Final cleaned modules (with linked deps): {cleaned_modules}")
 
@@ -150,4 +356,17 @@ def process_imports(source_file_path, packages, keepfile, force_refresh=False):
         os.remove(tmp_script_path)
         os.remove(tmp_output_path)
 
+    info(f"Resolved {len(cleaned_modules)} modules in {time.perf_counter() - start:.2f}s (import checker)")
+    _checked[key] = (cleaned_modules, None)
+    save_cached_results(cache_key, cleaned_modules)
     return cleaned_modules
+
+
+def _result(modules, reached, submodules):
+    return (list(modules), list(reached)) if submodules else list(modules)
+
+
+def clear_results():
+    # The fingerprint doesn't see files edited in place inside site-packages, so drop the cached results too
+    _checked.clear()
+    cache.clear(['imports'])
@@ -0,0 +1,174 @@
+import ast
+import dis
+import sys
+import types
+import marshal
+import logging
+import subprocess
+import importlib.util
+import importlib.machinery
+
+SOURCE_SUFFIXES = tuple(importlib.machinery.SOURCE_SUFFIXES)
+BYTECODE_SUFFIXES = tuple(importlib.machinery.BYTECODE_SUFFIXES)
+DYNAMIC_IMPORTS = {'__import__', 'import_module'}
+
+
+def startup_modules(source_dir):
+    # What the interpreter imports before the script runs, e.g. encodings and zipimport.
+    # This only starts the interpreter, none of the user's code runs.
+    try:
+        result = subprocess.run([sys.executable, '-c', 'import sys; print(list(sys.modules))'], cwd=source_dir,
+                                stdout=subprocess.PIPE, check=True, text=True)
+        return ast.literal_eval(result.stdout.strip())
+    except (OSError, subprocess.CalledProcessError, ValueError, SyntaxError) as e:
+        logging.warning(f"Couldn't list the interpreter startup modules: {e}")
+        return ['encodings', 'site', 'zipimport']
+
+
+def _skipped_branch(test, main=False):
+    # "if TYPE_CHECKING:" never runs, "if __name__ == '__main__':" only runs in the entry script (main)
+    if isinstance(test, ast.Name) and test.id == 'TYPE_CHECKING':
+        return True
+    if isinstance(test, ast.Attribute) and test.attr == 'TYPE_CHECKING':
+        return True
+    return (not main and isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == '__name__'
+            and len(test.comparators) == 1 and isinstance(test.comparators[0], ast.Constant)
+            and test.comparators[0].value == '__main__')
+
+
+def _imports_from_tree(tree, main=False):
+    # Yields (module, level, fromlist, lazy), lazy imports sit in function bodies and only run when called
+    stack = [(tree, False)]
+    while stack:
+        node, lazy = stack.pop()
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield alias.name, 0, (), lazy
+        elif isinstance(node, ast.ImportFrom):
+            yield node.module or '', node.level, tuple(alias.name for alias in node.names), lazy
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            stack.extend((decorator, lazy) for decorator in node.decorator_list)
+            stack.extend((child, True) for child in node.body)
+        elif isinstance(node, ast.Lambda):
+            stack.append((node.body, True))
+        elif isinstance(node, ast.If) and _skipped_branch(node.test, main):
+            stack.extend((child, lazy) for child in node.orelse)
+        else:
+            if (isinstance(node, ast.Call) and node.args and isinstance(node.args[0], ast.Constant)
+                    and isinstance(node.args[0].value, str)):
+                func = node.func
+                name = func.id if isinstance(func, ast.Name) else getattr(func, 'attr', None)
+                if name in DYNAMIC_IMPORTS:
+                    yield node.args[0].value, 0, (), lazy
+            stack.extend((child, lazy) for child in ast.iter_child_nodes(node))
+
+
+def _imports_from_code(code, lazy=False):
+    # Nested code objects are functions and class bodies, treated as lazy
+    instructions = list(dis.get_instructions(code))
+    for i, instruction in enumerate(instructions):
+        if instruction.opname == 'IMPORT_NAME' and i >= 2:
+            level, fromlist = instructions[i - 2].argval, instructions[i - 1].argval
+            yield instruction.argval, level if isinstance(level, int) else 0, tuple(fromlist or ()), lazy
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _imports_from_code(const, True)
+
+
+class ModuleGraph:
+    def __init__(self, path=None):
+        self.path = list(sys.path if path is None else path)
+        self.specs = {}
+        self.found = set()
+        self.missing = set()
+        self.lazy = {}  # module -> imports from its function bodies
+
+    def find_spec(self, name):
+        # Like importlib.util.find_spec, but never imports the parent packages
+        if name in self.specs:
+            return self.specs[name]
+        spec = None
+        parent = name.rpartition('.')[0]
+        try:
+            if name in sys.builtin_module_names:
+                spec = importlib.machinery.BuiltinImporter.find_spec(name)
+            elif not parent:
+                spec = (importlib.machinery.PathFinder.find_spec(name, self.path)
+                        or importlib.machinery.FrozenImporter.find_spec(name))
+            else:
+                parent_spec = self.find_spec(parent)
+                if parent_spec is not None and parent_spec.submodule_search_locations:
+                    spec = importlib.machinery.PathFinder.find_spec(name, list(parent_spec.submodule_search_locations))
+        except (ImportError, ValueError, OSError) as e:
+            logging.debug(f"Can't find {name}: {e}")
+        self.specs[name] = spec
+        return spec
+
+    def imports_of(self, name, spec, main=False):
+        origin = spec.origin or ''
+        try:
+            if origin.endswith(SOURCE_SUFFIXES):
+                with open(origin, 'rb') as f:
+                    found = list(_imports_from_tree(ast.parse(f.read(), filename=origin), main))
+            elif origin.endswith(BYTECODE_SUFFIXES):
+                with open(origin, 'rb') as f:
+                    found = list(_imports_from_code(marshal.loads(f.read()[16:])))
+            else:
+                return []  # extension modules have to be covered by linked_imports.json
+        except (OSError, SyntaxError, ValueError, EOFError, TypeError) as e:
+            logging.debug(f"Can't read the imports of {name} from {origin}: {e}")
+            return []
+
+        package = name if spec.submodule_search_locations is not None else name.rpartition('.')[0]
+        names = []
+        for module, level, fromlist, lazy in found:
+            if level:
+                try:
+                    module = importlib.util.resolve_name('.' * level + module, package)
+                except (ImportError, ValueError):
+                    continue
+            if not module:
+                continue
+            names.append((module, lazy))
+            # "from package import name" may import a submodule
+            names.extend((f"{module}.{item}", lazy) for item in fromlist if item != '*')
+        return names
+
+    def add(self, names):
+        queue = list(names)
+        while queue:
+            name = queue.pop()
+            if name in self.found or name in self.missing:
+                continue
+            spec = self.find_spec(name)
+            if spec is None:
+                self.missing.add(name)
+                continue
+            self.found.add(name)
+            parent = name.rpartition('.')[0]
+            if parent:
+                queue.append(parent)  # importing a submodule runs its parents first
+            if spec.has_location:
+                imports = self.imports_of(name, spec)
+                queue.extend(module for module, lazy in imports if not lazy)
+                self.lazy[name] = [module for module, lazy in imports if lazy]
+        return self.found
+
+    def add_script(self, path):
+        # Entry scripts aren't importable by name, add what they import
+        spec = importlib.util.spec_from_file_location('__main__', path)
+        return self.add(module for module, lazy in self.imports_of('__main__', spec, True) if not lazy)
+
+    def add_lazy(self, top_level):
+        # Follow imports from function bodies too, but only into packages that are already included.
+        # Whole packages don't need this, dropping single submodules does.
+        while True:
+            pending = sorted({module for name in self.found for module in self.lazy.get(name, ())
+                              if module.split('.')[0] in top_level
+                              and module not in self.found and module not in self.missing})
+            if not pending:
+                return self.found
+            self.add(pending)
+
+    def top_level(self):
+        return {name.split('.')[0] for name in self.found}
@@ -0,0 +1,174 @@
+import os
+import ast
+import sys
+import json
+import glob
+import shlex
+import shutil
+import logging
+import tempfile
+import subprocess
+import importlib.machinery
+from logging import info
+
+# Loaded through PYTHONPATH as sitecustomize, before the traced program runs.
+# It only imports builtin modules so it doesn't add anything to the trace itself.
+HOOK = """import os
+import sys
+import time
+import atexit
+import _thread
+
+_output = os.environ['PYCOMPYLE_TRACE']
+_opened = set()
+_written = None
+
+
+def _audit(event, args):
+    # Catches importlib.resources, pkgutil.get_data and plain open() alike
+    if event == 'open' and isinstance(args[0], (str, bytes)) and not (args[2] or 0) & (os.O_WRONLY | os.O_RDWR):
+        if args[1] is None or 'r' in args[1] and '+' not in args[1]:
+            _opened.add(os.path.abspath(os.fsdecode(args[0])))
+
+
+def _write():
+    global _written
+    modules = {}
+    for name, module in list(sys.modules.items()):
+        if getattr(module, '__spec__', None) is None:
+            continue  # made up at runtime (e.g. Cython's shared module) or __main__, nothing to copy
+        file = getattr(module, '__file__', None)
+        modules[name] = file if isinstance(file, str) else None
+    state = (len(modules), len(_opened))
+    if state == _written:
+        return
+    _written = state
+    tmp_path = '%s.%d.tmp' % (_output, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(repr({'modules': modules, 'opened': sorted(_opened)}))
+    os.replace(tmp_path, '%s.%d' % (_output, os.getpid()))
+
+
+def _flush_forever():
+    # The traced program may be killed on the timeout, atexit never runs then
+    while True:
+        time.sleep(1)
+        try:
+            _write()
+        except Exception:
+            pass
+
+
+sys.addaudithook(_audit)
+atexit.register(_write)
+_thread.start_new_thread(_flush_forever, ())
+"""
+
+IGNORED_MODULES = {'__main__', 'sitecustomize'}
+MODULE_SUFFIXES = tuple(importlib.machinery.all_suffixes())
+
+
+def manifest_path(source_file):
+    return os.path.splitext(source_file)[0] + '.imports.json'
+
+
+def run_traced(commands, source_dir, timeout=None):
+    # Runs every command with the hook installed and merges what all their processes loaded
+    hook_dir = tempfile.mkdtemp(prefix='pycompyle-trace-')
+    output = os.path.join(hook_dir, 'trace')
+    modules = {}
+    opened = set()
+    try:
+        with open(os.path.join(hook_dir, 'sitecustomize.py'), 'w', encoding='utf-8') as f:
+            f.write(HOOK)
+        env = dict(os.environ, PYCOMPYLE_TRACE=output)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [hook_dir, os.environ.get('PYTHONPATH')]))
+
+        for command in commands:
+            info(f"Tracing imports of: {command if isinstance(command, str) else shlex.join(command)}")
+            try:
+                result = subprocess.run(command, cwd=source_dir, env=env, timeout=timeout,
+                                        shell=isinstance(command, str))
+                if result.returncode:
+                    logging.warning(f"Traced command exited with code {result.returncode}, "
+                                    f"the trace only covers what ran until then")
+            except subprocess.TimeoutExpired:
+                logging.warning(f"Traced command still running after {timeout}s, stopped it")
+
+        # Subprocesses of the command write their own file, so a test runner's workers count too
+        for trace_file in glob.glob(output + '.*'):
+            if trace_file.endswith('.tmp'):
+                continue
+            try:
+                with open(trace_file, 'r', encoding='utf-8') as f:
+                    data = ast.literal_eval(f.read())
+            except (OSError, ValueError, SyntaxError) as e:
+                logging.warning(f"Couldn't read trace {trace_file}: {e}")
+                continue
+            for name, file in data['modules'].items():
+                if modules.get(name) is None:
+                    modules[name] = file
+            opened.update(data['opened'])
+    finally:
+        shutil.rmtree(hook_dir, ignore_errors=True)
+
+    for name in IGNORED_MODULES:
+        modules.pop(name, None)
+    return modules, opened
+
+
+def data_files(modules, opened):
+    # Files opened from inside a loaded package, e.g. through importlib.resources: package -> files
+    package_dirs = {}
+    for name, file in modules.items():
+        if file and os.path.basename(file).startswith('__init__.'):
+            package_dirs[os.path.dirname(file)] = name
+
+    found = {}
+    for path in sorted(opened):
+        if path.endswith(MODULE_SUFFIXES) or not os.path.isfile(path):
+            continue
+        folder = os.path.dirname(path)
+        while folder not in package_dirs and os.path.dirname(folder) != folder:
+            folder = os.path.dirname(folder)
+        if folder in package_dirs:
+            found.setdefault(package_dirs[folder], []).append(path)
+    return found
+
+
+def write_manifest(path, commands, modules, opened):
+    data = {
+        'commands': commands,
+        'modules': dict(sorted(modules.items())),
+        'data_files': data_files(modules, opened),
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    return data
+
+
+def load_manifest(path, packages=()):
+    # -> (top-level modules to copy, every module that was loaded), what copy_dependencies takes
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    reached = set(data['modules']) | set(data.get('data_files', {}))
+    modules = {name.split('.')[0] for name in reached}.union(packages)
+    return sorted(modules), sorted(reached)
+
+
+def trace_imports(source_file_path, entry_files, command=None, timeout=None, packages=()):
+    source_dir = os.path.dirname(source_file_path)
+    if command:
+        commands = [command]
+    else:
+        commands = [[sys.executable, entry_file] for entry_file in entry_files or [source_file_path]]
+    modules, opened = run_traced(commands, source_dir, timeout)
+    if not modules:
+        logging.critical("The trace didn't record any modules, is the command running this Python?")
+        sys.exit(1)
+
+    path = manifest_path(source_file_path)
+    data = write_manifest(path, commands, modules, opened)
+    info(f"Traced {len(modules)} modules and {sum(len(files) for files in data['data_files'].values())} "
+         f"data files, manifest written to {path}")
+    return load_manifest(path, packages)
@@ -0,0 +1,27 @@
+import threading
+from logging import info
+
+_lock = threading.Lock()
+counters = {'bytes_read': 0, 'bytes_written': 0, 'files_read': 0, 'files_written': 0}
+
+
+def read(nbytes, files=1):
+    with _lock:
+        counters['bytes_read'] += nbytes
+        counters['files_read'] += files
+
+
+def wrote(nbytes, files=1):
+    with _lock:
+        counters['bytes_written'] += nbytes
+        counters['files_written'] += files
+
+
+def snapshot():
+    with _lock:
+        return dict(counters)
+
+
+def report():
+    info(f"Disk traffic: read {counters['bytes_read'] / 1048576:.1f} MB from {counters['files_read']} files, "
+         f"wrote {counters['bytes_written'] / 1048576:.1f} MB to {counters['files_written']} files")
@@ -0,0 +1,90 @@
+import os
+import shutil
+import logging
+import threading
+from logging import info
+from components import iostats
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409
+
+# How staged files are created: 'copy', 'reflink' or 'hardlink' (reflink first, hardlink as a fallback)
+mode = 'copy'
+stats = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+_unsupported = set()  # (method, src device, dst device) combinations that already failed
+_lock = threading.Lock()
+
+
+def _devices(src, dst):
+    return os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def _try(method, func, src, dst):
+    key = (method, *_devices(src, dst))
+    if key in _unsupported:
+        return False
+    try:
+        func(src, dst)
+    except OSError as e:
+        logging.debug(f"Can't {method} {src}, falling back: {e}")
+        _unsupported.add(key)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        return False
+    with _lock:
+        stats[method] += 1
+    iostats.wrote(0)
+    return True
+
+
+def stage_file(src, dst, *, follow_symlinks=True):
+    # Never write through an existing link into the original environment
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if mode != 'copy':
+        if follow_symlinks:
+            # os.link would link the symlink itself, e.g. a venv's python
+            src = os.path.realpath(src)
+        if fcntl is not None and _try('reflink', _reflink, src, dst):
+            return dst
+        if mode == 'hardlink' and _try('hardlink', os.link, src, dst):
+            return dst
+
+    shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
+    with _lock:
+        stats['copy'] += 1
+    size = os.path.getsize(dst)
+    iostats.read(size)
+    iostats.wrote(size)
+    return dst
+
+
+def break_link(path):
+    # Give a hardlinked staged file its own data before something rewrites it in place
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_nlink <= 1:
+        return False
+    tmp_path = f"{path}.{os.getpid()}.unlink"
+    shutil.copy2(path, tmp_path)
+    os.replace(tmp_path, path)
+    return True
+
+
+def report():
+    if mode != 'copy':
+        info(f"Staged {stats['reflink']} files as reflinks, {stats['hardlink']} as hardlinks "
+             f"and copied {stats['copy']}")
@@ -1,6 +1,5 @@
 import os
 import subprocess
-import py_compile
 import shutil
 import logging
 import time
@@ -8,9 +7,14 @@ import tempfile
 import sys
 import platform
 import stat
+from components import bytecode, cache, iostats, manifest, packager, sizereport, zippolicy
 from components.download import download_resourcehacker
-from components.compress import compress_folder_with_progress, compress_top_level_pyc, compress_with_upx
+from components.entrypoints import compile_entry_points, entry_name
+from components.compress import (
+    benchmark_upx, compress_folder_with_progress, compress_top_level_pyc, compress_with_upx
+)
 from components.plugins import run_end_code
+from components.profiler import span
 from logging import info, error
 
 MAX_RETRIES = 5
@@ -23,6 +27,7 @@ def zip_embeder(output, bootloader, zip_file):
             output.write(f_exe.read())
         with open(zip_file, 'rb') as f_zip:
             output.write(f_zip.read())
+        iostats.wrote(output.tell())
 
 
 def delete_pycache(start_dir):
@@ -70,33 +75,7 @@ def create_executable(output_file, bootloader, no_console, zip_path=None):
 
 
 def compile_and_replace_py_to_pyc(folder, name="lib"):
-    directory = os.path.join(folder, name)
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.py'):
-                py_file_path = os.path.join(root, file)
-
-                temp_dir = r'C:\Windows\Temp' if os.name == 'nt' else '/tmp'
-
-                temp_dir = tempfile.mkdtemp(dir=temp_dir)
-                try:
-                    temp_file_path = os.path.join(temp_dir, file)
-
-                    shutil.copy2(py_file_path, temp_file_path)
-                    pyc_file_path = py_file_path + 'c'
-
-                    try:
-                        display_file_path = os.path.relpath(py_file_path, directory)
-                        py_compile.compile(temp_file_path, cfile=pyc_file_path, dfile=display_file_path, doraise=True)
-                        os.remove(py_file_path)
-
-                    except py_compile.PyCompileError as compile_error:
-                        logging.error(f"Failed to compile {py_file_path}: {compile_error}")
-                    except Exception as e:
-                        error(f"An error occurred with {py_file_path}: {e}")
-
-                finally:
-                    shutil.rmtree(temp_dir)
+    bytecode.compile_directory(os.path.join(folder, name))
 
 
 def compile_main(folder_path):
@@ -111,15 +90,14 @@ def compile_main(folder_path):
 
     pyc_file_path = main_file.replace('__main__', '__init__') + 'c'
     display_file_path = os.path.relpath(main_file, folder_path)
-    py_compile.compile(main_file, cfile=pyc_file_path, dfile=display_file_path, doraise=True)
+    bytecode.compile_file(main_file, pyc_file_path, display_file_path)
 
     with open(main_file, 'w') as f:
         f.write('import __init__')
 
 
 def add_icon_to_executable(exe_path, icon_path, noconfirm):
-    cache_path = os.path.expandvars(
-        '%LOCALAPPDATA%\\PyCompyle.cache') if os.name == 'nt' else os.path.expanduser('~/.cache/PyCompyle.cache')
+    cache_path = cache.get_cache_path()
     os.makedirs(cache_path, exist_ok=True)
     logging.debug(f'Cache path: {cache_path}')
 
@@ -130,6 +108,7 @@ def add_icon_to_executable(exe_path, icon_path, noconfirm):
             return
 
     r_hacker_path = os.path.join(cache_path, 'resource_hacker', 'ResourceHacker.exe')
+    cache.hit(r_hacker_path)
     command = [
         r_hacker_path,
         "-open", exe_path,
@@ -160,11 +139,7 @@ def add_uac(file_path, noconfirm):
     with open(manifest_path, "w", encoding="utf-8") as f:
         f.write(manifest_content)
 
-    cache_path = (
-        os.path.expandvars("%LOCALAPPDATA%\\PyCompyle.cache")
-        if os.name == "nt"
-        else os.path.expanduser("~/.cache/PyCompyle.cache")
-    )
+    cache_path = cache.get_cache_path()
     os.makedirs(cache_path, exist_ok=True)
     logging.debug(f"Cache path: {cache_path}")
     r_hacker_path = os.path.join(cache_path, "resource_hacker", "ResourceHacker.exe")
@@ -174,6 +149,7 @@ def add_uac(file_path, noconfirm):
         if download_resourcehacker(cache_path, noconfirm) is None:
             logging.info("Skipping UAC...")
             return
+    cache.hit(r_hacker_path)
     command = [
         r_hacker_path,
         "-open", file_path,
@@ -194,15 +170,25 @@ def write_pth(folder_path):
 def main(folder_path, args):
     folder_name = os.path.basename(folder_path).removesuffix('.build')
     zip_path = f"{folder_name}.zip"
+    staged_folder = folder_path
+    within_budget = True
 
     info('Removing __pycache__ directories...')
-    delete_pycache(folder_path)
+    with span('delete_pycache'):
+        delete_pycache(folder_path)
 
     if not args.disable_compile:
         info("Generating byte-code")
-        compile_and_replace_py_to_pyc(folder_path)
-        compile_and_replace_py_to_pyc(folder_path, "local")
-        compile_main(folder_path)
+        bytecode.use_cache = not args.disable_pyc_cache
+        with span('compile lib'):
+            compile_and_replace_py_to_pyc(folder_path)
+        with span('compile local'):
+            compile_and_replace_py_to_pyc(folder_path, "local")
+        with span('compile_main'):
+            compile_main(folder_path)
+            if len(args.entry_points) > 1:
+                compile_entry_points(folder_path, [entry_name(entry) for entry in args.entry_points])
+        bytecode.report_cache()
 
     if not args.disable_python_environment:
         info('Writing python args')
@@ -214,21 +200,52 @@ def main(folder_path, args):
             with open(os.path.join(folder_path, 'pyargs'), 'w') as file:
                 file.write('\n'.join(pyargs) + '\n')
 
-    if not args.disable_lib_compressing:
-        compress_top_level_pyc(
-            os.path.join(folder_path, "lib"),
-            output_name=os.path.join(folder_path, "lib_c"),
-        )
+    if not args.disable_lib_compressing and packager.active is None:
+        with span('compress_top_level_pyc'):
+            compress_top_level_pyc(
+                os.path.join(folder_path, "lib"),
+                output_name=os.path.join(folder_path, "lib_c"),
+            )
+
+    if args.upx_benchmark:
+        with span('upx benchmark'):
+            benchmark_upx(folder_path, os.path.splitext(args.source_file)[0], args.noconfirm,
+                          min_saving=args.upx_min_saving / 100)
 
     if args.upx_threads not in (0, None, "0"):
-        compress_with_upx(folder_path, args.upx_threads, args.noconfirm)
-
-    if not args.folder:
-        compress_folder_with_progress(
-            folder_path,
-            zip_path,
-            password=None if args.disable_password else 'PyCompyle'
-        )
+        with span('compress_with_upx'):
+            compress_with_upx(folder_path, args.upx_threads, args.noconfirm, args.upx_min_saving / 100,
+                              args.upx_memory, args.upx_strategy, args.upx_time_budget)
+
+    if manifest.active is not None:
+        manifest.active.save()
+
+    if args.compression_report and not args.folder:
+        with span('compression report'):
+            streamed = packager.active.entries.items() if packager.active is not None else ()
+            zippolicy.write_report(os.path.splitext(args.source_file)[0],
+                                   zippolicy.payload_files(folder_path, streamed), zippolicy.active)
+
+    if not args.folder and packager.active is not None:
+        with span('write_payload'):
+            packager.active.write_payload(zip_path, password=None if args.disable_password else 'PyCompyle',
+                                          policy=zippolicy.active)
+    elif not args.folder:
+        with span('compress_folder_with_progress'):
+            compress_folder_with_progress(
+                folder_path,
+                zip_path,
+                password=None if args.disable_password else 'PyCompyle',
+                policy=zippolicy.active
+            )
+    elif manifest.active is not None:
+        # Keep the build folder for the next incremental build
+        new_path = os.path.abspath(os.path.splitext(folder_name)[0])
+        info(f'Syncing build to {new_path}')
+        with span('mirror build folder'):
+            manifest.mirror(folder_path, new_path)
+        folder_path = new_path
+        zip_path = None
     else:
         for attempt in range(1, MAX_RETRIES + 1):
             try:
@@ -247,38 +264,57 @@ def main(folder_path, args):
                     sys.exit(1)
                 time.sleep(RETRY_DELAY)
 
-    exe_path = os.path.join(folder_path, f'{folder_name}.exe') if args.folder else f'{folder_name}.exe'
-
-
-    if args.bat:
+    if args.size_report:
+        with span('size report'):
+            within_budget = sizereport.write(os.path.splitext(args.source_file)[0], staged_folder, folder_path, zip_path,
+                                             None if args.disable_password else 'PyCompyle', args.size_budget)
+
+    # Every entry point gets its own executable, they all share the staged runtime and payload
+    exe_names = [entry_name(entry) for entry in args.entry_points] if len(args.entry_points) > 1 else [folder_name]
+    exe_paths = [os.path.join(folder_path, f'{name}.exe') if args.folder else f'{name}.exe' for name in exe_names]
+    exe_path = exe_paths[0]
+
+    if args.bat and len(exe_names) > 1:
+        info('Creating Batchfiles...')
+        for name in exe_names:
+            with open(os.path.join(folder_path, f'{name}.bat'), 'w') as file:
+                file.write(f'@echo off\nset PYCOMPYLE_ENTRY={name}\n"%~dp0\\python.exe" "%~dp0\\__main__.py" %*')
+    elif args.bat:
         info('Creating Batchfile...')
         bat_path = os.path.join(folder_path, f'{folder_name}.bat')
         with open(bat_path, 'w') as file:
             file.write(f'@echo off\n"%~dp0\\python.exe" {args} "%~dp0\\__main__.py"')
     elif not args.disable_bootloader:
-        info('Creating executable...')
-        create_executable(
-            exe_path,
-            args.bootloader,
-            args.windowed,
-            zip_path,
-        )
+        info('Creating executable...' if len(exe_paths) == 1 else f'Creating {len(exe_paths)} executables...')
+        with span('create_executable'):
+            for path in exe_paths:
+                create_executable(
+                    path,
+                    args.bootloader,
+                    args.windowed,
+                    zip_path,
+                )
 
     if args.icon:
         if os.path.exists(args.icon):
             if args.icon.endswith(".ico"):
                 info(f'Adding icon: {args.icon}')
-                add_icon_to_executable(exe_path, args.icon, args.noconfirm)
+                with span('add_icon_to_executable'):
+                    for path in exe_paths:
+                        add_icon_to_executable(path, args.icon, args.noconfirm)
             else:
                 error(f"Not an icon file: {args.icon}")
         else:
             error(f'Icon file not found: {args.icon}')
 
     if args.uac:
-        add_uac(exe_path, args.noconfirm)
+        with span('add_uac'):
+            for path in exe_paths:
+                add_uac(path, args.noconfirm)
 
     if args.zip:
-        compress_folder_with_progress(folder_path, folder_name)
+        with span('zip output folder'):
+            compress_folder_with_progress(folder_path, folder_name)
 
     end_code = run_end_code()
     if end_code:
@@ -286,10 +322,18 @@ def main(folder_path, args):
 
     if not args.keepfiles and not args.folder:
         info('Cleaning up...')
-        shutil.rmtree(folder_path, ignore_errors=True)
-        if os.path.exists(folder_path):  # this is redundant
-            shutil.rmtree(folder_path)
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-
+        with span('cleanup'):
+            if manifest.active is None:
+                shutil.rmtree(folder_path, ignore_errors=True)
+                if os.path.exists(folder_path):  # this is redundant
+                    shutil.rmtree(folder_path)
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+
+    if manifest.active is not None:
+        manifest.active.report()
+    iostats.report()
+
+    if not within_budget:
+        sys.exit(1)
     info("Done!")
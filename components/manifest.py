@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from logging import info
+from components import hashindex, iostats, links
+
+MANIFEST_VERSION = 1
+
+# The manifest of the current build, None unless --incremental is used
+active = None
+# Set by the streaming packager, files get recorded instead of staged
+planner = None
+# Staged path -> what it was staged for (a module name or a "(...)" label), used by the size report
+owners = {}
+_owner = threading.local()
+
+
+def get_state_path(folder_path):
+    return os.path.splitext(folder_path)[0] + '.buildstate'
+
+
+def build_fingerprint(args):
+    # Anything that changes what ends up in the staged or packed files invalidates the whole manifest
+    return [
+        sys.version,
+        sys.executable,
+        bool(args.disable_compile),
+        bool(args.disable_lib_compressing),
+        bool(args.disable_python_environment),
+        bool(args.disable_dll),
+        args.upx_threads not in (0, None, "0"),
+        args.upx_strategy,
+        args.upx_min_saving,
+        args.upx_time_budget,
+        bool(args.link_staging),
+        args.compress_rule,
+        [[path, hashindex.digest(path)] for path in args.compression_policy],
+        args.compression_level,
+        bool(args.no_default_compress_rules),
+        sorted(args.plugin),
+    ]
+
+
+class BuildManifest:
+    def __init__(self, folder_path, fingerprint):
+        self.folder_path = os.path.abspath(folder_path)
+        self.base = os.path.dirname(self.folder_path)
+        self.state_path = get_state_path(self.folder_path)
+        self.manifest_file = os.path.join(self.state_path, 'manifest.json')
+        self.fingerprint = fingerprint
+        self.files = {}
+        self.owners = {}  # artifact -> staged path it was built from
+        self.seen = set()
+        self.reused = set()
+        self.changed = set()
+        self.stats = {}
+        # Gathering stages stage files from several threads at once
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('version') != MANIFEST_VERSION or data.get('fingerprint') != self.fingerprint:
+            logging.debug('Build manifest does not match the current build options')
+            return False
+
+        self.files = data.get('files', {})
+        for key, entry in self.files.items():
+            for artifact in entry['artifacts']:
+                self.owners[artifact] = key
+        return True
+
+    def save(self):
+        os.makedirs(self.state_path, exist_ok=True)
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'fingerprint': self.fingerprint, 'files': self.files}, f)
+        os.replace(tmp_file, self.manifest_file)
+        logging.debug(f'Saved build manifest with {len(self.files)} files to {self.manifest_file}')
+
+    def rel(self, path):
+        return os.path.relpath(os.path.abspath(path), self.base)
+
+    def abs(self, rel_path):
+        return os.path.join(self.base, rel_path)
+
+    def count(self, stage, reused=0, rebuilt=0):
+        with self.lock:
+            counts = self.stats.setdefault(stage, [0, 0])
+            counts[0] += reused
+            counts[1] += rebuilt
+
+    def _unchanged(self, entry, src, st):
+        if entry['source'] != src or entry['size'] != st.st_size:
+            return False
+        if not all(os.path.exists(self.abs(artifact)) for artifact in entry['artifacts']):
+            return False
+        if entry['mtime'] == st.st_mtime:
+            return True
+        # Touched but maybe not modified, e.g. a fresh checkout
+        if entry['hash'] == hashindex.digest(src, st):
+            entry['mtime'] = st.st_mtime
+            return True
+        return False
+
+    def _remove_artifacts(self, entry):
+        for artifact in entry['artifacts']:
+            path = self.abs(artifact)
+            if os.path.isfile(path):
+                os.remove(path)
+            self.owners.pop(artifact, None)
+            self.reused.discard(artifact)
+            self.changed.add(artifact)
+        entry['artifacts'] = []
+
+    def stage(self, src, dst, copy_function):
+        src = os.path.abspath(src)
+        key = self.rel(dst)
+        self.seen.add(key)
+        st = os.stat(src)
+
+        entry = self.files.get(key)
+        if entry and self._unchanged(entry, src, st):
+            with self.lock:
+                self.reused.update(entry['artifacts'])
+            self.count('copy', reused=1)
+            return dst
+
+        if entry:
+            with self.lock:
+                self._remove_artifacts(entry)
+        copy_function(src, dst)
+        file_hash = hashindex.digest(src, st)
+        with self.lock:
+            self.files[key] = {
+                'source': src,
+                'hash': file_hash,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'artifacts': [key],
+            }
+            self.owners[key] = key
+            self.changed.add(key)
+        self.count('copy', rebuilt=1)
+        return dst
+
+    def renamed(self, old_path, new_path):
+        old_rel, new_rel = self.rel(old_path), self.rel(new_path)
+        if old_rel in self.owners:
+            moves = [(old_rel, new_rel)]
+        else:
+            # A whole directory was moved
+            prefix = old_rel + os.sep
+            moves = [(a, new_rel + a[len(old_rel):]) for a in self.owners if a.startswith(prefix)]
+
+        for old, new in moves:
+            key = self.owners.pop(old)
+            artifacts = self.files[key]['artifacts']
+            artifacts[artifacts.index(old)] = new
+            self.owners[new] = key
+            if old in self.reused:
+                self.reused.discard(old)
+                self.reused.add(new)
+            self.changed.update((old, new))
+
+    def remove_stale(self):
+        stale = [key for key in self.files if key not in self.seen]
+        for key in stale:
+            self._remove_artifacts(self.files.pop(key))
+            logging.debug(f'Removed stale staged file: {key}')
+        self.count('removed', rebuilt=len(stale))
+        return len(stale)
+
+    def is_reused(self, path):
+        return self.rel(path) in self.reused
+
+    def changed_under(self, folder):
+        prefix = self.rel(folder) + os.sep
+        return sum(1 for artifact in self.changed if artifact.startswith(prefix))
+
+    def report(self):
+        reused_pyc = sum(1 for artifact in self.reused if artifact.endswith('.pyc'))
+        self.count('compile', reused=reused_pyc)
+        for stage in ('copy', 'compile', 'lib_c', 'upx'):
+            if stage in self.stats:
+                reused, rebuilt = self.stats[stage]
+                info(f'Incremental build: {stage} reused {reused} files, rebuilt {rebuilt}')
+        if 'removed' in self.stats:
+            info(f'Incremental build: {self.stats["removed"][1]} stale files removed')
+
+
+def start(folder_path, fingerprint):
+    global active
+    active = BuildManifest(folder_path, fingerprint)
+    if active.load():
+        return True
+    shutil.rmtree(active.state_path, ignore_errors=True)
+    return False
+
+
+def set_owner(name):
+    # Everything staged from this thread from now on is recorded as staged for name
+    previous = getattr(_owner, 'name', None)
+    _owner.name = name
+    return previous
+
+
+@contextmanager
+def owned_by(name):
+    previous = set_owner(name)
+    try:
+        yield
+    finally:
+        set_owner(previous)
+
+
+def _record_owner(dst):
+    name = getattr(_owner, 'name', None)
+    if name is not None:
+        owners[os.path.abspath(dst)] = name
+
+
+def stage_copy(src, dst, *, follow_symlinks=True):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    _record_owner(dst)
+    if planner is not None:
+        return planner.add(src, dst)
+    if active is None:
+        return links.stage_file(src, dst, follow_symlinks=follow_symlinks)
+    return active.stage(src, dst, links.stage_file)
+
+
+def stage_tree(src, dst, ignore=None):
+    _record_owner(dst)
+    if planner is not None:
+        return planner.add_tree(src, dst, ignore)
+    return shutil.copytree(src, dst, ignore=ignore, copy_function=stage_copy, dirs_exist_ok=True)
+
+
+def renamed(old_path, new_path):
+    if active is not None:
+        active.renamed(old_path, new_path)
+
+
+def mirror(src_folder, dst_folder):
+    # Bring dst_folder in line with src_folder, only copying what differs
+    def copy_if_changed(src, dst):
+        if os.path.isfile(dst):
+            src_st, dst_st = os.stat(src), os.stat(dst)
+            if src_st.st_size == dst_st.st_size and src_st.st_mtime_ns == dst_st.st_mtime_ns:
+                return dst
+        iostats.wrote(os.path.getsize(src))
+        return shutil.copy2(src, dst)
+
+    shutil.copytree(src_folder, dst_folder, copy_function=copy_if_changed, dirs_exist_ok=True)
+
+    for root, dirs, files in os.walk(dst_folder, topdown=False):
+        src_root = os.path.join(src_folder, os.path.relpath(root, dst_folder))
+        for file in files:
+            if not os.path.exists(os.path.join(src_root, file)):
+                os.remove(os.path.join(root, file))
+        for d in dirs:
+            if not os.path.exists(os.path.join(src_root, d)):
+                shutil.rmtree(os.path.join(root, d), ignore_errors=True)
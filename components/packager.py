@@ -0,0 +1,149 @@
+import io
+import os
+import logging
+import pyzipper
+from tqdm import tqdm
+from logging import info
+from components import bytecode, iostats, links, manifest
+
+PYTHON_SUFFIXES = (".pyc", ".py")
+
+# The plan of the current build, None unless --stream is used
+active = None
+
+
+class StreamPlan:
+    def __init__(self, folder_path, compile_lib=True, compress_lib=True, materialize=()):
+        self.folder_path = os.path.abspath(folder_path)
+        self.compile_lib = compile_lib
+        self.compress_lib = compress_lib
+        # Files with these extensions still get staged, e.g. so UPX can work on them
+        self.materialize = tuple(materialize)
+        self.entries = {}  # arcname -> source path
+
+    def add(self, src, dst):
+        if dst.lower().endswith(self.materialize):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            return links.stage_file(src, dst)
+        arcname = os.path.relpath(os.path.abspath(dst), self.folder_path)
+        self.entries[arcname] = os.path.abspath(src)
+        return dst
+
+    def add_tree(self, src, dst, ignore=None):
+        for root, dirs, files in os.walk(src, followlinks=True):
+            ignored = ignore(root, dirs + files) if ignore else set()
+            dirs[:] = [d for d in dirs if d not in ignored]
+            target = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+            for file in files:
+                if file not in ignored:
+                    self.add(os.path.join(root, file), os.path.join(target, file))
+        return dst
+
+    def _lib_c_items(self):
+        # Same rule as compress_top_level_pyc: top-level modules and folders that only hold python files
+        lib_prefix = 'lib' + os.sep
+        items = {}
+        for arcname in self.entries:
+            if arcname.startswith(lib_prefix):
+                item = arcname[len(lib_prefix):].split(os.sep)[0]
+                items[item] = items.get(item, True) and arcname.endswith(PYTHON_SUFFIXES)
+
+        lib_folder = os.path.join(self.folder_path, 'lib')
+        for item, pure in items.items():
+            staged = os.path.join(lib_folder, item)
+            if pure and os.path.isdir(staged) and any(files for _, _, files in os.walk(staged)):
+                items[item] = False  # holds staged binaries
+        return {item for item, pure in items.items() if pure}
+
+    def _compile(self):
+        compiled = {}
+        if not self.compile_lib:
+            return compiled
+        jobs = []
+        arcnames = []
+        for arcname, src in sorted(self.entries.items()):
+            top = arcname.split(os.sep)[0]
+            if arcname.endswith('.py') and top in ('lib', 'local'):
+                arcnames.append(arcname)
+                jobs.append((src, os.path.relpath(arcname, top)))
+
+        info(f"Compiling {len(jobs)} files in memory")
+        for arcname, (_, data, failure, _) in zip(arcnames, bytecode.compile_to_bytes(jobs)):
+            if failure is None:
+                compiled[arcname] = data
+        return compiled
+
+    @staticmethod
+    def _write_entry(zipf, arcname, src, data, policy=None):
+        # Returns how many bytes had to be read from disk
+        if data is not None:
+            zipf.writestr(arcname + 'c', data, *(policy.choose(arcname + 'c') if policy else ()))
+            return 0
+        zipf.write(src, arcname, *(policy.choose(arcname, src) if policy else ()))
+        return os.path.getsize(src)
+
+    def write_payload(self, output_zip_path, password=None, compression_level=6, policy=None):
+        compiled = self._compile()
+
+        lib_c_items = self._lib_c_items() if self.compress_lib else set()
+        lib_c_entries, other_entries = [], []
+        for arcname, src in sorted(self.entries.items()):
+            parts = arcname.split(os.sep)
+            if parts[0] == 'lib' and len(parts) > 1 and parts[1] in lib_c_items:
+                lib_c_entries.append((arcname, src))
+            else:
+                other_entries.append((arcname, src))
+
+        bytes_read = 0
+        lib_c_data = None
+        if lib_c_entries:
+            buffer = io.BytesIO()
+            with pyzipper.AESZipFile(buffer, 'w', compression=pyzipper.ZIP_DEFLATED, compresslevel=6) as zipf:
+                for arcname, src in lib_c_entries:
+                    bytes_read += self._write_entry(zipf, os.path.relpath(arcname, 'lib'), src, compiled.get(arcname))
+            lib_c_data = buffer.getvalue()
+            logging.debug(f"Built lib_c.zip in memory from {len(lib_c_entries)} files")
+
+        staged_files = [
+            os.path.join(root, file)
+            for root, _, files in os.walk(self.folder_path)
+            for file in files
+        ]
+        total_size = sum(os.path.getsize(path) for path in staged_files)
+        total_size += sum(os.path.getsize(src) for _, src in other_entries)
+
+        encryption = pyzipper.WZ_AES if password else None
+        with tqdm(total=total_size, unit='B', unit_scale=True, desc='INFO: Streaming payload') as pbar, \
+            pyzipper.AESZipFile(
+                output_zip_path,
+                'w',
+                compression=pyzipper.ZIP_DEFLATED,
+                compresslevel=compression_level,
+                encryption=encryption
+        ) as zipf:
+            if password:
+                zipf.setpassword(password.encode('utf-8'))
+
+            for file_path in staged_files:
+                bytes_read += self._write_entry(zipf, os.path.relpath(file_path, self.folder_path), file_path, None,
+                                                policy)
+                pbar.update(os.path.getsize(file_path))
+
+            for arcname, src in other_entries:
+                bytes_read += self._write_entry(zipf, arcname, src, compiled.get(arcname), policy)
+                pbar.update(os.path.getsize(src))
+
+            if lib_c_data is not None:
+                zipf.writestr('lib_c.zip', lib_c_data, *(policy.choose('lib_c.zip') if policy else ()))
+
+        iostats.read(bytes_read, files=len(self.entries) - len(compiled) + len(staged_files))
+        iostats.wrote(os.path.getsize(output_zip_path))
+        info(f"Streamed {len(self.entries)} files from their original locations "
+             f"({len(lib_c_entries)} into lib_c.zip)")
+
+
+def start(folder_path, compile_lib=True, compress_lib=True, materialize=()):
+    global active
+    active = StreamPlan(folder_path, compile_lib, compress_lib, materialize)
+    manifest.planner = active
+    return active
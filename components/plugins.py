@@ -6,6 +6,7 @@ import textwrap
 import importlib.machinery
 import importlib.util
 from logging import info
+from components import profiler
 
 plugins = []
 
@@ -137,6 +138,12 @@ def _create_code(plugin_path, func_name):
         f"plugin = importlib.machinery.SourceFileLoader(r'{plugin_path}', r'{plugin_path}').load_module()\n"
     )
 
+    if profiler.enabled:
+        # The span is closed even when the hook raises, the nested exec runs in the same globals and locals
+        name = f"{os.path.basename(plugin_path)} {func_name}"
+        body = (f"with __import__('components.profiler', fromlist=['span']).span({name!r}, 'plugin'):\n"
+                f"    exec({body!r})\n")
+
     return header + body
 
 
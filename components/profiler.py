@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from logging import info
+from components import iostats
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+enabled = False
+output_path = None
+spans = []
+_start = time.perf_counter()
+_local = threading.local()
+# cpu, peak_rss and the IO counters are read process-wide: spans running at the same time (scheduler stages,
+# UPX threads) count each other's work, and peak_rss is the highest the process got so far, not the span's own
+PROCESS_WIDE_NOTE = ("* process-wide: overlapping stages count each other's CPU and IO, "
+                     "peak RSS is the process maximum so far. Thread CPU is the stage's own thread only.")
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _peak_rss():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports KiB
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+    except Exception:
+        return 0
+
+
+def _cpu_time():
+    # Process-wide, includes finished child processes like the import checker and UPX
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def begin(name, category='stage'):
+    if not enabled:
+        return
+    stack = _stack()
+    stack.append((name, category, len(stack), iostats.snapshot(), _cpu_time(), time.thread_time(),
+                  time.perf_counter()))
+
+
+def end():
+    if not enabled or not _stack():
+        return
+    name, category, depth, io_before, cpu_before, thread_cpu_before, wall_before = _stack().pop()
+    wall = time.perf_counter() - wall_before
+    io_after = iostats.snapshot()
+    spans.append({
+        'name': name,
+        'category': category,
+        'depth': depth,
+        'thread': threading.get_ident(),
+        'start': wall_before - _start,
+        'wall': wall,
+        'cpu': _cpu_time() - cpu_before,
+        'thread_cpu': time.thread_time() - thread_cpu_before,
+        'peak_rss': _peak_rss(),
+        'bytes_read': io_after['bytes_read'] - io_before['bytes_read'],
+        'bytes_written': io_after['bytes_written'] - io_before['bytes_written'],
+        'files': (io_after['files_read'] - io_before['files_read']
+                  + io_after['files_written'] - io_before['files_written']),
+    })
+
+
+@contextmanager
+def span(name, category='stage'):
+    begin(name, category)
+    try:
+        yield
+    finally:
+        end()
+
+
+def write_trace(path):
+    pid = os.getpid()
+    # Stages run by the scheduler get their own rows, numbered in the order they started
+    tids = {}
+    for s in sorted(spans, key=lambda s: s['start']):
+        tids.setdefault(s['thread'], len(tids))
+    events = [{
+        'name': s['name'],
+        'cat': s['category'],
+        'ph': 'X',
+        'ts': round(s['start'] * 1e6),
+        'dur': round(s['wall'] * 1e6),
+        'pid': pid,
+        'tid': tids[s['thread']],
+        'args': {k: s[k] for k in ('thread_cpu', 'cpu', 'peak_rss', 'bytes_read', 'bytes_written', 'files')},
+    } for s in spans]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                   'otherData': {'process_wide_args': 'cpu, peak_rss, bytes_read, bytes_written, files',
+                                 'note': PROCESS_WIDE_NOTE}}, f, indent=1)
+
+
+def summary():
+    lines = [f"{'Stage':<40} {'Wall':>9} {'Thread CPU':>11} {'CPU*':>9} {'Peak RSS*':>10} {'Read*':>10} "
+             f"{'Written*':>10} {'Files*':>7}"]
+    for s in sorted(spans, key=lambda s: s['wall'], reverse=True):
+        lines.append(
+            f"{s['name'][:40]:<40} {s['wall']:>8.2f}s {s['thread_cpu']:>10.2f}s {s['cpu']:>8.2f}s "
+            f"{s['peak_rss'] / 1048576:>8.1f}MB {s['bytes_read'] / 1048576:>8.1f}MB "
+            f"{s['bytes_written'] / 1048576:>8.1f}MB {s['files']:>7}")
+    lines.append(PROCESS_WIDE_NOTE)
+    return '\n'.join(lines)
+
+
+def finish():
+    if not enabled or not spans:
+        return
+    try:
+        write_trace(output_path)
+        info(f"Build profile written to {output_path} (open it in chrome://tracing or ui.perfetto.dev)")
+    except OSError as e:
+        logging.error(f"Failed to write build profile: {e}")
+    info("Build profile summary:\n" + summary())
+
+
+def start(path):
+    global enabled, output_path
+    enabled = True
+    output_path = os.path.abspath(path)
+    # Also write the profile when a stage exits the build early
+    atexit.register(finish)
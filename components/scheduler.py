@@ -0,0 +1,94 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from components import profiler
+
+_local = threading.local()
+
+
+class Stage:
+    def __init__(self, name, func, after=()):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+
+
+class _StageLogFilter(logging.Filter):
+    # Holds back records logged from inside a stage so they can be replayed in stage order
+    def __init__(self, buffers):
+        super().__init__()
+        self.buffers = buffers
+
+    def filter(self, record):
+        stage = getattr(_local, 'stage', None)
+        if stage is None:
+            return True
+        buffer = self.buffers[stage]
+        if not buffer or buffer[-1] is not record:  # every handler sees the same record
+            buffer.append(record)
+        return False
+
+
+def _flush(records):
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+    records.clear()
+
+
+def _run_stage(stage):
+    _local.stage = stage.name
+    try:
+        with profiler.span(stage.name):
+            stage.func()
+    finally:
+        _local.stage = None
+
+
+def run(stages, workers=None):
+    # Runs every stage as soon as the stages it comes after are done.
+    # Logs come out in the order the stages were given, however the stages interleave.
+    order = [stage.name for stage in stages]
+    buffers = {name: [] for name in order}
+    unknown = {dep for stage in stages for dep in stage.after} - set(order)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    log_filter = _StageLogFilter(buffers)
+    handlers = list(logging.root.handlers)
+    for handler in handlers:
+        handler.addFilter(log_filter)
+
+    done = set()
+    failed = {}
+    running = {}
+    flushed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers or len(stages) or 1) as executor:
+            while True:
+                if not failed:
+                    for stage in stages:
+                        if (stage.name not in done and stage.name not in running.values()
+                                and all(dep in done for dep in stage.after)):
+                            running[executor.submit(_run_stage, stage)] = stage.name
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        failed[name] = future.exception()
+                    done.add(name)
+                while flushed < len(order) and order[flushed] in done:
+                    _flush(buffers[order[flushed]])
+                    flushed += 1
+    finally:
+        for handler in handlers:
+            handler.removeFilter(log_filter)
+        for name in order[flushed:]:
+            _flush(buffers[name])
+
+    if failed:
+        raise next(failed[name] for name in order if name in failed)
+    if len(done) != len(order):
+        raise ValueError(f"Stages depend on each other: {', '.join(name for name in order if name not in done)}")
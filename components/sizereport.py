@@ -0,0 +1,205 @@
+import io
+import os
+import re
+import sys
+import json
+import logging
+import zipfile
+from collections import deque
+from logging import info
+import pyzipper
+from components import manifest
+from components.imports import getimports, modulegraph
+
+SIZE_UNITS = {'': 1, 'B': 1, 'K': 1024, 'KB': 1024, 'M': 1024 ** 2, 'MB': 1024 ** 2, 'G': 1024 ** 3, 'GB': 1024 ** 3}
+MAIN_FILES = re.compile(r'^(__main__\.py|__init__\.pyc?|__main_.+__\.pyc?)$')
+
+# Top-level module -> [(step, how it was pulled in)], set up by build() before packaging
+chains = {}
+
+
+def parse_size(text):
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMG]?B?)\s*', text.upper())
+    if match is None:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def import_chains(entry_files, modules, packages, linked_map, source_dir):
+    # Breadth first from the scripts, so every module gets the shortest chain that pulls it in
+    pycompyle_dir = os.path.dirname(os.path.abspath(sys.modules["__main__"].__file__))  # type: ignore
+    graph = modulegraph.ModuleGraph([path for path in sys.path if os.path.abspath(path or '.') != pycompyle_dir])
+    parents = {}
+    queue = deque()
+
+    def visit(node, parent, how):
+        if node not in parents:
+            parents[node] = (parent, how)
+            queue.append(node)
+        # Importing a submodule runs its package first
+        top = node.split('.')[0] if not os.path.isabs(node) else node
+        if top != node and top not in parents:
+            parents[top] = (parent, how)
+            queue.append(top)
+
+    for entry_file in entry_files:
+        visit(entry_file, None, '__main__')
+    for package in packages:
+        visit(package, None, '--package')
+    for module in modulegraph.startup_modules(source_dir):
+        visit(module, None, 'interpreter startup')
+
+    while queue:
+        node = queue.popleft()
+        if os.path.isabs(node):
+            for module in sorted(getimports.get_imports_from_file(node, source_dir)):
+                visit(module, node, 'import')
+            continue
+        spec = graph.find_spec(node)
+        if spec is not None and spec.has_location:
+            for module, lazy in graph.imports_of(node, spec):
+                if not lazy:
+                    visit(module, node, 'import')
+        for module in linked_map.get(node, ()):
+            visit(module, node, 'linked_imports')
+
+    found = {}
+    for module in modules:
+        chain = []
+        node = module
+        while node in parents and len(chain) < 64:
+            parent, how = parents[node]
+            chain.append((os.path.basename(node) if os.path.isabs(node) else node, how))
+            node = parent
+        found[module] = chain[::-1]
+    return found
+
+
+def format_chain(chain):
+    if not chain:
+        return '(found by the resolver)'
+    steps = []
+    for step, how in chain:
+        if how in ('linked_imports', '--package', 'interpreter startup'):
+            steps.append(f"{step} [{how}]")
+        else:
+            steps.append(step)
+    return ' -> '.join(steps)
+
+
+def _owner(rel_path, folder_owners):
+    # The longest staged path that holds this file, .pyc files were staged as .py
+    candidates = [rel_path]
+    if rel_path.endswith('.pyc'):
+        candidates.append(rel_path[:-1])
+    path = rel_path
+    while os.sep in path:
+        path = path.rsplit(os.sep, 1)[0]
+        candidates.append(path)
+    for candidate in candidates:
+        if candidate in folder_owners:
+            return folder_owners[candidate]
+    if MAIN_FILES.match(rel_path):
+        return '__main__'
+    return '(build files)'
+
+
+def _nested(data, prefix):
+    with zipfile.ZipFile(io.BytesIO(data)) as nested:
+        for item in nested.infolist():
+            if not item.is_dir():
+                yield os.path.join(prefix, *item.filename.split('/')), item.file_size, item.compress_size
+
+
+def collect_zip(zip_path, password=None):
+    # arcname -> (bytes, compressed bytes), the modules in lib_c.zip are listed as lib/...
+    with pyzipper.AESZipFile(zip_path) as zipf:
+        if password:
+            zipf.setpassword(password.encode('utf-8'))
+        for item in zipf.infolist():
+            name = os.path.join(*item.filename.split('/'))
+            if name == 'lib_c.zip':
+                yield from _nested(zipf.read(item), 'lib')
+            elif not item.is_dir():
+                yield name, item.file_size, item.compress_size
+
+
+def collect_folder(folder_path):
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            path = os.path.join(root, file)
+            rel_path = os.path.relpath(path, folder_path)
+            if rel_path == 'lib_c.zip':
+                with open(path, 'rb') as f:
+                    yield from _nested(f.read(), 'lib')
+            else:
+                size = os.path.getsize(path)
+                yield rel_path, size, None
+
+
+def build_report(entries, staged_folder):
+    staged_folder = os.path.abspath(staged_folder)
+    folder_owners = {os.path.relpath(path, staged_folder): name for path, name in manifest.owners.items()
+                     if path.startswith(staged_folder + os.sep)}
+    modules = {}
+    files = []
+    for rel_path, size, compressed in entries:
+        owner = _owner(rel_path, folder_owners)
+        files.append({'path': rel_path.replace(os.sep, '/'), 'module': owner, 'bytes': size, 'compressed': compressed})
+        module = modules.setdefault(owner, {'module': owner, 'files': 0, 'bytes': 0, 'compressed': 0,
+                                            'chain': format_chain(chains.get(owner)) if owner in chains else None})
+        module['files'] += 1
+        module['bytes'] += size
+        if compressed is None or module['compressed'] is None:
+            module['compressed'] = None
+        else:
+            module['compressed'] += compressed
+
+    # Folder builds have nothing compressed except lib_c.zip
+    key = 'compressed' if all(module['compressed'] is not None for module in modules.values()) else 'bytes'
+    ordered = sorted(modules.values(), key=lambda module: (-(module[key] or 0), module['module']))
+    return {
+        'total': {'files': len(files), 'bytes': sum(file['bytes'] for file in files),
+                  'compressed': sum(file['compressed'] or 0 for file in files) if key == 'compressed' else None},
+        'sorted_by': key,
+        'modules': ordered,
+        'files': sorted(files, key=lambda file: file['path']),
+    }
+
+
+def format_report(report):
+    mb = 1048576
+    total = report['total']
+    lines = [f"Payload: {total['files']} files, {total['bytes'] / mb:.2f} MB"
+             + (f", {total['compressed'] / mb:.2f} MB compressed" if total['compressed'] is not None else ''),
+             '',
+             f"{'Size (MB)':>10} {'Zipped':>10} {'Files':>6}  Module and what pulled it in"]
+    for module in report['modules']:
+        compressed = f"{module['compressed'] / mb:10.2f}" if module['compressed'] is not None else f"{'-':>10}"
+        chain = f"  ({module['chain']})" if module['chain'] else ''
+        lines.append(f"{module['bytes'] / mb:10.2f} {compressed} {module['files']:6}  {module['module']}{chain}")
+    return '\n'.join(lines) + '\n'
+
+
+def write(base_path, staged_folder, output_folder, zip_path=None, password=None, budget=None):
+    # Writes <script>.size.json and <script>.size.txt, returns False when the payload is over the budget.
+    # Folder builds are measured in output_folder, onefile builds in their payload zip.
+    try:
+        entries = list(collect_zip(zip_path, password) if zip_path else collect_folder(output_folder))
+    except (OSError, zipfile.BadZipFile, RuntimeError) as e:
+        logging.error(f"Couldn't measure the payload: {e}")
+        return True
+    report = build_report(entries, staged_folder)
+
+    with open(base_path + '.size.json', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    text = format_report(report)
+    with open(base_path + '.size.txt', 'w', encoding='utf-8') as f:
+        f.write(text)
+    info(f"Size report written to {base_path}.size.txt, largest:\n" + '\n'.join(text.splitlines()[2:8]))
+
+    size = report['total']['compressed'] if report['total']['compressed'] is not None else report['total']['bytes']
+    if budget is not None and size > budget:
+        logging.critical(f"Payload is {size / 1048576:.2f} MB, over the size budget of {budget / 1048576:.2f} MB")
+        return False
+    return True
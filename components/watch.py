@@ -0,0 +1,113 @@
+import os
+import site
+import time
+import logging
+import importlib
+from logging import info
+from components import bytecode, iostats, links
+from components.imports import importcheck
+
+POLL_INTERVAL = 0.5
+IGNORED_DIRS = {'__pycache__', 'node_modules'}
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _build_outputs(source_file):
+    # Everything the build writes next to the script, watching it would rebuild forever
+    base = os.path.splitext(source_file)[0]
+    source_dir = os.path.dirname(source_file)
+    return {base, base + '.build', base + '.buildstate', base + '.exe', base + '.zip', base + '.trace.json',
+            base + '.excluded.txt', base + '.imports.json', base + '.size.json', base + '.size.txt',
+            base + '.compression.json', base + '.compression.txt', base + '.upx.json', base + '.upx.txt',
+            os.path.join(source_dir, 'temp_script.py'), os.path.join(source_dir, 'temp_output.txt')}
+
+
+def _site_packages():
+    try:
+        folders = site.getsitepackages()
+    except AttributeError:  # old virtualenv
+        folders = []
+    if site.ENABLE_USER_SITE:
+        folders.append(site.getusersitepackages())
+    return [folder for folder in folders if os.path.isdir(folder)]
+
+
+def snapshot(source_file):
+    # path -> (True if it is part of the source tree, stat)
+    source_dir = os.path.dirname(source_file)
+    skip = _build_outputs(source_file)
+    state = {}
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = [d for d in dirs if d not in IGNORED_DIRS and not d.startswith('.')
+                   and os.path.join(root, d) not in skip]
+        for file in files:
+            path = os.path.join(root, file)
+            if path not in skip:
+                state[path] = (True, _stat(path))
+
+    # Only the tree holding the entry scripts is polled, the staged dependencies are looked at again when
+    # the imports change. Installing or removing a distribution changes the site-packages folder itself.
+    for folder in _site_packages():
+        state[folder] = (False, _stat(folder))
+    return state
+
+
+def wait_for_changes(source_file, previous):
+    while True:
+        time.sleep(POLL_INTERVAL)
+        current = snapshot(source_file)
+        if current == previous:
+            continue
+        # Let editors and installers finish writing first
+        while True:
+            time.sleep(POLL_INTERVAL)
+            settled = snapshot(source_file)
+            if settled == current:
+                break
+            current = settled
+        changed = sorted(path for path in set(previous) | set(current) if previous.get(path) != current.get(path))
+        return current, changed
+
+
+def _reset_counters():
+    for counters in (iostats.counters, links.stats, bytecode.cache_stats):
+        for key in counters:
+            counters[key] = 0
+
+
+def run(args, build):
+    source_file = args.source_file
+    state = snapshot(source_file)
+    info(f"Watching {os.path.dirname(source_file)} for changes, press Ctrl+C to stop")
+    try:
+        while True:
+            previous = state
+            state, changed = wait_for_changes(source_file, previous)
+            for path in changed[:10]:
+                info(f"Changed: {path}")
+            if len(changed) > 10:
+                info(f"... and {len(changed) - 10} more")
+
+            # Local files only affect the import checker through the imports they contain, which are part of its
+            # cache key (dotted ones too under --tree-shake). A changed site-packages may change anything.
+            if any(not (state.get(path) or previous[path])[0] for path in changed):
+                importcheck.clear_results()
+            importlib.invalidate_caches()
+            _reset_counters()
+
+            start = time.perf_counter()
+            try:
+                build(args)
+                info(f"Rebuilt in {time.perf_counter() - start:.2f}s after {len(changed)} changed files")
+            except (Exception, SystemExit) as e:
+                logging.error(f"Rebuild failed after {time.perf_counter() - start:.2f}s: {e}")
+            state = snapshot(source_file)
+    except KeyboardInterrupt:
+        info("Stopped watching")
@@ -0,0 +1,187 @@
+import io
+import os
+import json
+import time
+import pyzipper
+from logging import info
+from components.exclude import Pattern
+
+# Codecs the bootloader's zip crate can extract. lib_c.zip is read by zipimport and always stays deflated.
+CODECS = {
+    'store': pyzipper.ZIP_STORED,
+    'deflate': pyzipper.ZIP_DEFLATED,
+    'bzip2': pyzipper.ZIP_BZIP2,
+    'lzma': pyzipper.ZIP_LZMA,
+}
+CODEC_NAMES = {value: name for name, value in CODECS.items()}
+LEVELS = {'store': None, 'deflate': range(0, 10), 'bzip2': range(1, 10), 'lzma': None}
+
+# Already compressed, deflating them again costs time at build and at every launch for next to nothing
+STORED_TYPES = [
+    '*.zip', '*.whl', '*.egg', '*.jar', '*.gz', '*.tgz', '*.bz2', '*.xz', '*.zst', '*.7z',
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.mp3', '*.mp4', '*.ogg', '*.woff', '*.woff2',
+]
+# UPX writes this into the first header of everything it packs
+UPX_MAGIC = b'UPX!'
+UPX_HEADER_BYTES = 4096
+
+# What --compression-report measures every extension with
+CANDIDATES = [('store', None), ('deflate', 1), ('deflate', 6), ('deflate', 9), ('bzip2', 9), ('lzma', None)]
+# Bigger extensions are measured on their first files and scaled up
+REPORT_SAMPLE_BYTES = 16 * 1024 * 1024
+
+# Set up by configure(), None means everything is deflated at level 6 like before
+active = None
+
+
+def parse_rule(text):
+    # "PATTERN=CODEC[:LEVEL]", e.g. "*.dat=lzma" or "assets/*=deflate:9"
+    pattern, sep, policy = text.rpartition('=')
+    codec, _, level = policy.partition(':')
+    if not sep or not pattern:
+        raise ValueError(f"Invalid compression rule: {text}, expected PATTERN=CODEC[:LEVEL]")
+    return {'pattern': pattern, 'codec': codec, 'level': int(level) if level else None}
+
+
+def _check(codec, level, where):
+    if codec not in CODECS:
+        raise ValueError(f"{where}: unknown codec {codec}, expected one of {', '.join(CODECS)}")
+    if level is not None and (LEVELS[codec] is None or level not in LEVELS[codec]):
+        raise ValueError(f"{where}: {codec} doesn't take level {level}")
+
+
+def _upx_packed(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return UPX_MAGIC in f.read(UPX_HEADER_BYTES)
+    except OSError:
+        return False
+
+
+class Policy:
+    def __init__(self, rules=(), level=6, defaults=True):
+        _check('deflate', level, '--compression-level')
+        self.level = level
+        self.defaults = defaults
+        self.rules = []
+        for rule in list(rules) + ([{'pattern': p, 'codec': 'store'} for p in STORED_TYPES] if defaults else []):
+            _check(rule['codec'], rule.get('level'), rule['pattern'])
+            self.rules.append((Pattern(rule['pattern']), rule['codec'], rule.get('level')))
+
+    def choose(self, arcname, file_path=None):
+        # -> (compress_type, compresslevel), the first matching rule wins and the user's come first
+        rel_path = arcname.replace(os.sep, '/')
+        for pattern, codec, level in self.rules:
+            if pattern.matches(rel_path, False):
+                return CODECS[codec], level if level is not None else (self.level if codec == 'deflate' else None)
+        if self.defaults and file_path is not None and _upx_packed(file_path):
+            return pyzipper.ZIP_STORED, None
+        return pyzipper.ZIP_DEFLATED, self.level
+
+
+def load_policy_file(path):
+    # {"level": 6, "rules": [{"pattern": "*.dat", "codec": "lzma"}, {"pattern": "*.json", "codec": "deflate", "level": 9}]}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get('rules', []), list):
+        raise ValueError(f"{path}: expected an object with a list of rules")
+    return data
+
+
+def configure(rules=(), policy_files=(), level=6, defaults=True):
+    global active
+    merged = [parse_rule(rule) for rule in rules]
+    for policy_file in policy_files:
+        data = load_policy_file(policy_file)
+        merged.extend(data.get('rules', []))
+        level = data.get('level', level)
+    active = Policy(merged, level, defaults)
+    return active
+
+
+def describe(compress_type, level):
+    name = CODEC_NAMES[compress_type]
+    return name if level is None else f"{name}:{level}"
+
+
+def payload_files(folder_path, extra=()):
+    # (file path, arcname) of everything going into the payload, extra holds streamed entries
+    files = [(os.path.join(root, name), os.path.relpath(os.path.join(root, name), folder_path))
+             for root, _, names in os.walk(folder_path) for name in names]
+    files.extend((src, arcname) for arcname, src in extra)
+    return sorted(files, key=lambda item: item[1])
+
+
+def _extension(arcname):
+    return os.path.splitext(arcname)[1].lower() or '(none)'
+
+
+def _measure(samples, codec, level):
+    # Writes the samples into a zip in memory and reads them back, the same code paths the payload goes through
+    buffer = io.BytesIO()
+    start = time.perf_counter()
+    with pyzipper.AESZipFile(buffer, 'w') as zipf:
+        for i, data in enumerate(samples):
+            zipf.writestr(str(i), data, compress_type=CODECS[codec], compresslevel=level)
+    build = time.perf_counter() - start
+    with pyzipper.AESZipFile(buffer) as zipf:
+        compressed = sum(item.compress_size for item in zipf.infolist())
+        start = time.perf_counter()
+        for item in zipf.infolist():
+            zipf.read(item)
+        launch = time.perf_counter() - start
+    return compressed, build, launch
+
+
+def build_report(files, policy):
+    groups = {}
+    for file_path, arcname in files:
+        groups.setdefault(_extension(arcname), []).append((file_path, arcname))
+
+    extensions = []
+    for extension, members in groups.items():
+        total = sum(os.path.getsize(file_path) for file_path, _ in members)
+        samples, sampled = [], 0
+        for file_path, _ in members:
+            if sampled >= REPORT_SAMPLE_BYTES:
+                break
+            with open(file_path, 'rb') as f:
+                samples.append(f.read())
+            sampled += len(samples[-1])
+        scale = total / sampled if sampled else 0
+
+        chosen = {}
+        for file_path, arcname in members:
+            name = describe(*policy.choose(arcname, file_path))
+            chosen[name] = chosen.get(name, 0) + 1
+        results = []
+        for codec, level in CANDIDATES:
+            compressed, build, launch = _measure(samples, codec, level)
+            results.append({'policy': codec if level is None else f"{codec}:{level}", 'compressed': int(compressed * scale),
+                            'build_seconds': build * scale, 'launch_seconds': launch * scale})
+        extensions.append({'extension': extension, 'files': len(members), 'bytes': total, 'sampled_bytes': sampled,
+                           'chosen': chosen, 'results': results})
+    return {'extensions': sorted(extensions, key=lambda item: (-item['bytes'], item['extension']))}
+
+
+def format_report(report):
+    mb = 1048576
+    lines = ["Per extension: zipped size, build time and launch (extract) time of every policy, * is what this build used",
+             "Timed with Python's codecs on up to the first "
+             f"{REPORT_SAMPLE_BYTES // mb} MB of each extension, bigger ones are scaled up", '']
+    for extension in report['extensions']:
+        lines.append(f"{extension['extension']}: {extension['files']} files, {extension['bytes'] / mb:.2f} MB")
+        for result in extension['results']:
+            mark = '*' if result['policy'] in extension['chosen'] else ' '
+            lines.append(f"  {mark} {result['policy']:<10} {result['compressed'] / mb:10.2f} MB "
+                         f"{result['build_seconds']:8.3f}s build {result['launch_seconds']:8.3f}s launch")
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(base_path, files, policy):
+    report = build_report(files, policy)
+    with open(base_path + '.compression.json', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    with open(base_path + '.compression.txt', 'w', encoding='utf-8') as f:
+        f.write(format_report(report))
+    info(f"Compression report written to {base_path}.compression.txt")
@@ -0,0 +1,24 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from components import cache, hashindex  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    # PyCompyle.cache lives under HOME (LOCALAPPDATA on Windows), keep the real one out of the tests
+    home = tmp_path / 'home'
+    home.mkdir()
+    monkeypatch.setenv('HOME', str(home))
+    monkeypatch.setenv('LOCALAPPDATA', str(home))
+    monkeypatch.setattr(cache, 'max_bytes', cache.DEFAULT_MAX_BYTES)
+    cache._used.clear()
+    cache._stats.clear()
+    monkeypatch.setattr(hashindex, '_files', None)
+    hashindex._changed.clear()
+    yield cache.get_cache_path()
+    cache._used.clear()
+    cache._stats.clear()
@@ -0,0 +1,111 @@
+import os
+import types
+import pytest
+from components import cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # cache.time.time() advances one second per call, so every use is later than the one before
+    now = [1000000.0]
+
+    def tick():
+        now[0] += 1
+        return now[0]
+    monkeypatch.setattr(cache, 'time', types.SimpleNamespace(time=tick))
+    return now
+
+
+def _store(*parts, size=1000):
+    path = cache.get_cache_path(*parts)
+    cache.write_atomic(path, b'x' * size)
+    cache.stored(path)
+    return path
+
+
+def test_prune_evicts_the_least_recently_used_first(clock, monkeypatch):
+    old = _store('upxcache', 'old.bin')
+    used = _store('upxcache', 'used.bin')
+    new = _store('upxcache', 'new.bin')
+    cache.hit(old)  # used last, so it stays
+    monkeypatch.setattr(cache, 'max_bytes', 2000)
+    assert cache.prune() == (1, 1000)
+    assert os.path.exists(old) and os.path.exists(new)
+    assert not os.path.exists(used)
+
+
+def test_kinds_have_caps_of_their_own(clock, monkeypatch):
+    monkeypatch.setitem(cache.KIND_MAX_BYTES, 'pyc', 1500)
+    first = _store('pyccache', 'ab', 'first.bin')
+    second = _store('pyccache', 'cd', 'second.bin')
+    upx = _store('upxcache', 'out.bin', size=5000)
+    cache.prune()
+    assert not os.path.exists(first)
+    assert os.path.exists(second) and os.path.exists(upx)
+
+
+def test_prune_trusts_the_index_instead_of_walking_the_cache(clock, monkeypatch):
+    _store('upxcache', 'a.bin')
+    cache.prune()
+
+    def walked():
+        raise AssertionError('the cache folder was scanned')
+    monkeypatch.setattr(cache, '_scan', walked)
+    _store('upxcache', 'b.bin')
+    cache.prune()
+    assert cache.stats()['upx']['entries'] == 2
+
+
+def test_missing_index_is_rebuilt_from_the_disk(clock):
+    path = _store('upxcache', 'a.bin')
+    cache._used.clear()
+    assert not os.path.exists(cache.get_cache_path(cache.INDEX_FILE))
+    cache.prune()
+    assert cache.stats()['upx']['entries'] == 1
+    assert os.path.exists(path)
+
+
+def test_verify_drops_entries_deleted_behind_the_index(clock):
+    kept = _store('upxcache', 'kept.bin')
+    gone = _store('upxcache', 'gone.bin')
+    cache.prune()
+    os.remove(gone)
+    assert cache.verify() == (1, 1000)
+    assert os.path.exists(kept)
+
+
+def test_eviction_skips_over_entries_already_deleted(clock, monkeypatch):
+    gone = _store('upxcache', 'gone.bin')
+    _store('upxcache', 'kept.bin')
+    cache.prune()
+    os.remove(gone)
+    monkeypatch.setattr(cache, 'max_bytes', 1000)
+    assert cache.prune() == (1, 1000)
+    assert cache.stats()['upx']['entries'] == 1
+
+
+def test_clear_only_the_given_kinds(clock):
+    pyc = _store('pyccache', 'ab', 'x.bin')
+    upx = _store('upxcache', 'x.bin')
+    cache.clear(['pyc'])
+    assert not os.path.exists(pyc)
+    assert os.path.exists(upx)
+    assert 'pyc' not in {kind for kind, counters in cache.stats().items() if counters['entries']}
+
+
+def test_counters_add_up_across_builds(clock):
+    path = _store('imports', 'key.json')
+    cache.hit(path)
+    cache.miss(path)
+    cache.finish()
+    cache.hit(path)
+    cache.finish()
+    counters = cache.stats()['imports']
+    assert (counters['hits'], counters['misses'], counters['written']) == (2, 1, 1000)
+
+
+def test_entries_outside_the_cache_are_ignored(tmp_path):
+    assert cache.entry_of(str(tmp_path / 'elsewhere.bin')) is None
+    assert cache.entry_of(cache.get_cache_path('pyccache', 'ab', 'c.bin')) == 'pyccache/ab/c.bin'
+    assert cache.entry_of(cache.get_cache_path('resource_hacker', 'x.exe')) == 'resource_hacker'
+    assert cache.kind_of('linked_imports.index.json') == 'linked_imports'
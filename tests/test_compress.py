@@ -0,0 +1,73 @@
+import os
+import zipfile
+import pyzipper
+import pytest
+from components import compress, zippolicy
+
+
+def _tree(root, count=40):
+    # Files of different sizes and compressibility in nested folders, -> arcname -> bytes
+    files = {}
+    for i in range(count):
+        arcname = os.path.join(f'pkg{i % 3}', 'sub' if i % 2 else '', f'file{i}.dat')
+        data = (f'{i} '.encode() * (i * 500)) + os.urandom(i * 100)
+        path = root / arcname
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        files[os.path.normpath(arcname).replace(os.sep, '/')] = data
+    return files
+
+
+@pytest.fixture
+def parallel(monkeypatch):
+    monkeypatch.setattr(compress, 'PARALLEL_MIN_BYTES', 0)
+
+
+def test_merged_parts_form_one_valid_archive(tmp_path, parallel):
+    files = _tree(tmp_path / 'src')
+    output = tmp_path / 'out.zip'
+    compress.compress_folder_with_progress(str(tmp_path / 'src'), str(output), workers=4)
+    assert not [name for name in os.listdir(tmp_path) if '.part' in name]
+    with zipfile.ZipFile(output) as zipf:
+        assert zipf.testzip() is None
+        assert sorted(zipf.namelist()) == sorted(files)
+        for name, data in files.items():
+            assert zipf.read(name) == data
+
+
+def test_merged_archive_matches_the_serial_order(tmp_path, parallel):
+    _tree(tmp_path / 'src')
+    compress.compress_folder_with_progress(str(tmp_path / 'src'), str(tmp_path / 'serial.zip'), workers=1)
+    compress.compress_folder_with_progress(str(tmp_path / 'src'), str(tmp_path / 'parallel.zip'), workers=4)
+    with zipfile.ZipFile(tmp_path / 'serial.zip') as serial, zipfile.ZipFile(tmp_path / 'parallel.zip') as merged:
+        assert merged.namelist() == serial.namelist()
+
+
+def test_merged_encrypted_archive(tmp_path, parallel):
+    files = _tree(tmp_path / 'src', count=12)
+    output = tmp_path / 'out.zip'
+    compress.compress_folder_with_progress(str(tmp_path / 'src'), str(output), password='secret', workers=3)
+    with pyzipper.AESZipFile(output) as zipf:
+        zipf.setpassword(b'secret')
+        assert zipf.testzip() is None
+        assert {name: zipf.read(name) for name in zipf.namelist()} == files
+
+
+def test_merged_parts_keep_the_policy_codecs(tmp_path, parallel):
+    files = _tree(tmp_path / 'src', count=12)
+    policy = zippolicy.Policy([{'pattern': 'pkg1/*', 'codec': 'store'}, {'pattern': '*.dat', 'codec': 'lzma'}])
+    output = tmp_path / 'out.zip'
+    compress.compress_folder_with_progress(str(tmp_path / 'src'), str(output), workers=3, policy=policy)
+    with zipfile.ZipFile(output) as zipf:
+        assert zipf.testzip() is None
+        for item in zipf.infolist():
+            expected = zipfile.ZIP_STORED if item.filename.startswith('pkg1/') else zipfile.ZIP_LZMA
+            assert item.compress_type == expected, item.filename
+        assert {name: zipf.read(name) for name in zipf.namelist()} == files
+
+
+def test_split_keeps_order_and_every_file():
+    files = [(f'f{i}', f'f{i}', size) for i, size in enumerate([5, 1, 1, 8, 2, 2, 2, 9, 1])]
+    chunks = compress._split(files, 4)
+    assert [item for chunk in chunks for item in chunk] == files
+    assert all(chunks)
@@ -0,0 +1,91 @@
+import shutil
+import pytest
+from components import exclude
+from components.exclude import Pattern, Rules
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    yield
+    exclude.active = None
+    exclude.saved.clear()
+
+
+def test_name_patterns_match_at_any_depth():
+    assert Pattern('*.pyi').matches('a/b/c.pyi', False)
+    assert Pattern('*.pyi').matches('c.pyi', False)
+    assert not Pattern('*.pyi').matches('c.py', False)
+
+
+def test_patterns_with_a_slash_match_the_whole_path():
+    assert Pattern('data/*.csv').matches('data/x.csv', False)
+    assert not Pattern('data/*.csv').matches('sub/data/x.csv', False)
+
+
+def test_leading_slash_anchors_to_the_package_root():
+    assert Pattern('/tests/').matches('tests', True)
+    assert not Pattern('/tests/').matches('testing/tests', True)
+    assert Pattern('tests/').matches('testing/tests', True)
+
+
+def test_trailing_slash_only_matches_folders():
+    assert Pattern('build/').matches('build', True)
+    assert not Pattern('build/').matches('build', False)
+
+
+def test_regex_patterns():
+    assert Pattern(r're:^_vendor/.*\.txt$').matches('_vendor/a/b.txt', False)
+    assert Pattern('re:/$').matches('folder', True)
+
+
+def test_includes_win_and_package_rules_win_over_global_ones():
+    rules = Rules(exclude=['*.txt'], include=['keep.txt'],
+                  packages={'pkg': {'include': ['*.txt'], 'exclude': ['*.json']}})
+    assert rules.excluded('other', 'notes.txt', False)
+    assert not rules.excluded('other', 'keep.txt', False)
+    assert not rules.excluded('pkg', 'notes.txt', False)
+    assert rules.excluded('pkg', 'conf.json', False)
+    assert not rules.excluded('other', 'conf.json', False)
+
+
+def test_defaults_keep_cython_sources_and_nested_test_packages():
+    rules = exclude.configure()
+    assert rules.excluded('pkg', 'module.pyi', False)
+    assert rules.excluded('pkg', 'sub/__pycache__', True)
+    assert not rules.excluded('pkg', 'fast.pyx', False)
+    assert not rules.excluded('pkg', 'fast.pxd', False)
+    assert not rules.excluded('pkg', 'tests', True)
+
+
+def test_dev_folders_are_opt_in_and_only_at_the_root():
+    rules = exclude.configure(dev_folders=True)
+    assert rules.excluded('numpy', 'tests', True)
+    assert rules.excluded('numpy', 'docs', True)
+    assert not rules.excluded('numpy', 'testing/tests', True)
+
+
+def test_no_rules_without_defaults():
+    assert exclude.configure(defaults=False) is None
+
+
+def test_ignore_for_leaves_files_out_of_a_copy_and_counts_them(tmp_path):
+    package = tmp_path / 'pkg'
+    (package / 'sub').mkdir(parents=True)
+    (package / '__init__.py').write_text('')
+    (package / 'types.pyi').write_text('x: int\n')
+    (package / 'sub' / 'mod.py').write_text('')
+    (package / 'sub' / 'mod.pyi').write_text('y: int\n')
+    exclude.configure()
+    shutil.copytree(package, tmp_path / 'out', ignore=exclude.ignore_for('pkg', str(package)))
+    copied = sorted(str(path.relative_to(tmp_path / 'out')) for path in (tmp_path / 'out').rglob('*'))
+    assert copied == ['__init__.py', 'sub', 'sub/mod.py'.replace('/', exclude.os.sep)]
+    assert exclude.saved['pkg'] == [2, len('x: int\n') + len('y: int\n')]
+
+
+def test_single_module_files(tmp_path):
+    module = tmp_path / 'helper.pyi'
+    module.write_text('z: int\n')
+    exclude.configure()
+    assert exclude.skip_file('helper', str(module))
+    assert not exclude.skip_file('helper', str(tmp_path / 'helper.py'))
+    assert exclude.saved['helper'] == [1, len('z: int\n')]
@@ -0,0 +1,61 @@
+import os
+import json
+from datetime import datetime, timezone
+import pytest
+from components import cache
+from components.imports import importcheck
+
+
+@pytest.fixture
+def linked_cache():
+    # A fresh cached linked_imports.json, so nothing is downloaded
+    cache_dir = cache.get_cache_path()
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'linked_imports.json'), 'w', encoding='utf-8') as f:
+        json.dump({'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': ['e']}, f)
+    with open(os.path.join(cache_dir, 'linked_imports.timestamp'), 'w') as f:
+        f.write(datetime.now(timezone.utc).isoformat())
+    return cache_dir
+
+
+def test_closure_follows_links_through_cycles():
+    closure = importcheck.compile_linked_closure({'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': ['e']})
+    assert closure == {'a': ['a', 'b', 'c'], 'b': ['a', 'b', 'c'], 'c': ['a', 'b', 'c'], 'd': ['e']}
+
+
+def test_resolve_is_a_union_over_the_closure():
+    closure = {'a': ['b', 'c'], 'd': ['e']}
+    assert importcheck.resolve_linked_imports({'a', 'x'}, closure) == {'a', 'b', 'c', 'x'}
+
+
+def test_index_is_compiled_once_and_reused(linked_cache):
+    linked, closure = importcheck.load_linked_index()
+    assert closure['a'] == ['a', 'b', 'c']
+    index_file = os.path.join(linked_cache, 'linked_imports.index.json')
+    assert os.path.exists(index_file)
+
+    # Reused as is while nothing changed, even if the compiled closure is edited
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    index['closure']['a'] = ['marker']
+    with open(index_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    assert importcheck.load_linked_index()[1]['a'] == ['marker']
+
+
+def test_hint_files_are_merged_and_invalidate_the_index(linked_cache, tmp_path):
+    hints = tmp_path / 'hints.json'
+    hints.write_text(json.dumps({'d': ['f'], 'f': ['g']}))
+    linked, closure = importcheck.load_linked_index(hint_files=[str(hints)])
+    assert linked['d'] == ['e', 'f']
+    assert closure['d'] == ['e', 'f', 'g']
+
+    hints.write_text(json.dumps({'d': ['h', 'i']}))
+    os.utime(hints, ns=(0, 0))
+    assert importcheck.load_linked_index(hint_files=[str(hints)])[1]['d'] == ['e', 'h', 'i']
+
+
+def test_invalid_hint_files_are_ignored(linked_cache, tmp_path):
+    hints = tmp_path / 'hints.json'
+    hints.write_text('["not", "a", "map"]')
+    assert importcheck.load_linked_index(hint_files=[str(hints)])[1]['d'] == ['e']
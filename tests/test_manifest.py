@@ -0,0 +1,107 @@
+import os
+import time
+import argparse
+from components import manifest
+
+
+def _args(**overrides):
+    args = dict(disable_compile=False, disable_lib_compressing=False, disable_python_environment=False,
+                disable_dll=False, upx_threads=0, upx_strategy='brute', upx_min_saving=5.0, upx_time_budget=None,
+                link_staging=False, compress_rule=[], compression_policy=[], compression_level=6,
+                no_default_compress_rules=False, plugin=[])
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def _build(tmp_path, fingerprint, sources):
+    # One incremental build: stages every source into app.build and saves the manifest
+    folder = tmp_path / 'app.build'
+    reused = manifest.start(str(folder), fingerprint)
+    folder.mkdir(exist_ok=True)
+    for src in sources:
+        manifest.stage_copy(str(src), str(folder / src.name))
+    manifest.active.remove_stale()
+    manifest.active.save()
+    stats = manifest.active.stats
+    manifest.active = None
+    return reused, stats.get('copy', [0, 0])
+
+
+def _touch(path, seconds_ago):
+    then = time.time() - seconds_ago
+    os.utime(path, (then, then))
+
+
+def test_fingerprint_covers_packing_options():
+    base = manifest.build_fingerprint(_args())
+    assert manifest.build_fingerprint(_args()) == base
+    for option, value in [('upx_strategy', 'fast'), ('upx_min_saving', 10.0), ('link_staging', True),
+                          ('compress_rule', ['*.dat=lzma']), ('compression_level', 9)]:
+        assert manifest.build_fingerprint(_args(**{option: value})) != base, option
+
+
+def test_fingerprint_covers_policy_file_contents(tmp_path):
+    policy = tmp_path / 'policy.json'
+    policy.write_text('{"rules": []}')
+    _touch(policy, 60)
+    before = manifest.build_fingerprint(_args(compression_policy=[str(policy)]))
+    policy.write_text('{"rules": [{"pattern": "*.dat", "codec": "lzma"}]}')
+    assert manifest.build_fingerprint(_args(compression_policy=[str(policy)])) != before
+
+
+def test_changed_fingerprint_starts_over(tmp_path):
+    src = tmp_path / 'mod.py'
+    src.write_text('x = 1\n')
+    assert _build(tmp_path, ['a'], [src])[0] is False
+    assert _build(tmp_path, ['a'], [src])[0] is True
+    reused, (copied_again, rebuilt) = _build(tmp_path, ['b'], [src])
+    assert reused is False
+    assert (copied_again, rebuilt) == (0, 1)
+
+
+def test_unchanged_source_is_reused(tmp_path):
+    src = tmp_path / 'mod.py'
+    src.write_text('x = 1\n')
+    _touch(src, 60)
+    _build(tmp_path, ['a'], [src])
+    assert _build(tmp_path, ['a'], [src])[1] == [1, 0]
+
+
+def test_modified_source_is_copied_again(tmp_path):
+    src = tmp_path / 'mod.py'
+    src.write_text('x = 1\n')
+    _touch(src, 60)
+    _build(tmp_path, ['a'], [src])
+    # Same size, only the content and mtime differ
+    src.write_text('x = 2\n')
+    _touch(src, 30)
+    assert _build(tmp_path, ['a'], [src])[1] == [0, 1]
+    assert (tmp_path / 'app.build' / 'mod.py').read_text() == 'x = 2\n'
+
+
+def test_touched_source_with_same_content_is_reused(tmp_path):
+    src = tmp_path / 'mod.py'
+    src.write_text('x = 1\n')
+    _touch(src, 60)
+    _build(tmp_path, ['a'], [src])
+    _touch(src, 30)
+    assert _build(tmp_path, ['a'], [src])[1] == [1, 0]
+
+
+def test_missing_artifact_is_staged_again(tmp_path):
+    src = tmp_path / 'mod.py'
+    src.write_text('x = 1\n')
+    _build(tmp_path, ['a'], [src])
+    os.remove(tmp_path / 'app.build' / 'mod.py')
+    assert _build(tmp_path, ['a'], [src])[1] == [0, 1]
+    assert (tmp_path / 'app.build' / 'mod.py').exists()
+
+
+def test_stale_files_are_removed(tmp_path):
+    first, second = tmp_path / 'a.py', tmp_path / 'b.py'
+    first.write_text('a = 1\n')
+    second.write_text('b = 1\n')
+    _build(tmp_path, ['a'], [first, second])
+    _build(tmp_path, ['a'], [first])
+    assert not (tmp_path / 'app.build' / 'b.py').exists()
+    assert (tmp_path / 'app.build' / 'a.py').exists()
@@ -0,0 +1,17 @@
+import sys
+from components.imports import modulegraph
+
+
+def test_entry_script_main_guard(tmp_path):
+    script = tmp_path / 'app.py'
+    script.write_text("import xml\n\nif __name__ == '__main__':\n    import xml.dom.minidom\n")
+    graph = modulegraph.ModuleGraph(sys.path)
+    found = graph.add_script(str(script))
+    assert 'xml.dom.minidom' in found
+
+
+def test_imported_module_main_guard(tmp_path):
+    (tmp_path / 'helper.py').write_text("if __name__ == '__main__':\n    import xml.dom.minidom\n")
+    graph = modulegraph.ModuleGraph([str(tmp_path)] + sys.path)
+    found = graph.add(['helper'])
+    assert 'xml.dom.minidom' not in found
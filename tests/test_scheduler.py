@@ -0,0 +1,107 @@
+import logging
+import threading
+import pytest
+from components import scheduler
+from components.scheduler import Stage
+
+
+class _Collect(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+@pytest.fixture
+def collected():
+    handler = _Collect()
+    root = logging.getLogger()
+    level = root.level
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    yield handler.messages
+    root.removeHandler(handler)
+    root.setLevel(level)
+
+
+def test_stages_wait_for_their_dependencies():
+    finished = []
+    lock = threading.Lock()
+
+    def stage(name):
+        def run():
+            with lock:
+                finished.append(name)
+        return run
+
+    scheduler.run([
+        Stage('package', stage('package'), after=['compile', 'copy']),
+        Stage('compile', stage('compile'), after=['copy']),
+        Stage('copy', stage('copy')),
+        Stage('imports', stage('imports')),
+    ])
+    assert sorted(finished) == ['compile', 'copy', 'imports', 'package']
+    assert finished.index('copy') < finished.index('compile') < finished.index('package')
+
+
+def test_independent_stages_run_at_the_same_time():
+    # Each waits for the other to start, this only finishes when both run at once
+    barrier = threading.Barrier(2, timeout=5)
+    scheduler.run([Stage('a', barrier.wait), Stage('b', barrier.wait)])
+
+
+def test_logs_are_replayed_in_stage_order(collected):
+    first_may_finish = threading.Event()
+
+    def first():
+        logging.info('first: start')
+        assert first_may_finish.wait(5)
+        logging.info('first: done')
+
+    def second():
+        logging.info('second: start')
+        logging.info('second: done')
+        first_may_finish.set()
+
+    scheduler.run([Stage('first', first), Stage('second', second)])
+    assert collected == ['first: start', 'first: done', 'second: start', 'second: done']
+
+
+def test_logs_outside_stages_pass_straight_through(collected):
+    logging.info('before')
+    scheduler.run([Stage('only', lambda: logging.info('inside'))])
+    logging.info('after')
+    assert collected == ['before', 'inside', 'after']
+
+
+def test_failure_is_raised_and_dependents_never_run():
+    ran = []
+
+    def broken():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError, match='boom'):
+        scheduler.run([Stage('broken', broken), Stage('later', lambda: ran.append('later'), after=['broken'])])
+    assert ran == []
+
+
+def test_logs_of_a_failed_run_are_still_flushed(collected):
+    def broken():
+        logging.info('broken: about to fail')
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        scheduler.run([Stage('broken', broken)])
+    assert collected == ['broken: about to fail']
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError, match='Unknown stages: missing'):
+        scheduler.run([Stage('a', lambda: None, after=['missing'])])
+
+
+def test_dependency_cycle():
+    with pytest.raises(ValueError, match='depend on each other'):
+        scheduler.run([Stage('a', lambda: None, after=['b']), Stage('b', lambda: None, after=['a'])])
@@ -0,0 +1,41 @@
+import sys
+from components.imports import tracer
+
+
+def _project(tmp_path):
+    package = tmp_path / 'mypkg'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    (package / 'helpers.py').write_text('import json\n')
+    (package / 'table.txt').write_text('data')
+    script = tmp_path / 'app.py'
+    script.write_text("import importlib\n"
+                      "importlib.import_module('mypkg.helpers')\n"
+                      "from importlib import resources\n"
+                      "resources.files('mypkg').joinpath('table.txt').read_text()\n")
+    return script
+
+
+def test_trace_records_dynamic_imports_and_data_files(tmp_path):
+    script = _project(tmp_path)
+    modules, opened = tracer.run_traced([[sys.executable, str(script)]], str(tmp_path))
+    assert 'mypkg.helpers' in modules and 'json' in modules
+    assert modules['mypkg.helpers'] == str(tmp_path / 'mypkg' / 'helpers.py')
+    assert 'sitecustomize' not in modules and '__main__' not in modules
+    assert tracer.data_files(modules, opened) == {'mypkg': [str(tmp_path / 'mypkg' / 'table.txt')]}
+
+
+def test_manifest_lists_what_copy_dependencies_takes(tmp_path):
+    script = _project(tmp_path)
+    top_level, reached = tracer.trace_imports(str(script), [str(script)], packages=['extra'])
+    assert tracer.manifest_path(str(script)) == str(tmp_path / 'app.imports.json')
+    assert 'mypkg' in top_level and 'json' in top_level and 'extra' in top_level
+    assert all('.' not in name for name in top_level)
+    assert 'mypkg.helpers' in reached
+
+
+def test_failing_command_still_keeps_its_trace(tmp_path):
+    script = tmp_path / 'app.py'
+    script.write_text('import json\nraise SystemExit(3)\n')
+    modules, _ = tracer.run_traced([[sys.executable, str(script)]], str(tmp_path))
+    assert 'json' in modules
@@ -0,0 +1,63 @@
+import json
+import pyzipper
+import pytest
+from components import zippolicy
+
+
+def test_default_is_deflate_at_the_policy_level():
+    assert zippolicy.Policy().choose('pkg/module.pyc') == (pyzipper.ZIP_DEFLATED, 6)
+    assert zippolicy.Policy(level=9).choose('pkg/module.pyc') == (pyzipper.ZIP_DEFLATED, 9)
+
+
+def test_already_compressed_types_are_stored():
+    policy = zippolicy.Policy()
+    assert policy.choose('assets/icon.png') == (pyzipper.ZIP_STORED, None)
+    assert policy.choose('wheels/dep.whl') == (pyzipper.ZIP_STORED, None)
+    assert zippolicy.Policy(defaults=False).choose('assets/icon.png') == (pyzipper.ZIP_DEFLATED, 6)
+
+
+def test_user_rules_come_first_and_the_first_match_wins():
+    policy = zippolicy.Policy([zippolicy.parse_rule('assets/*.png=deflate:9'), zippolicy.parse_rule('*.png=lzma'),
+                               zippolicy.parse_rule('*.dat=bzip2:5')])
+    assert policy.choose('assets/icon.png') == (pyzipper.ZIP_DEFLATED, 9)
+    assert policy.choose('other/icon.png') == (pyzipper.ZIP_LZMA, None)
+    assert policy.choose('data/table.dat') == (pyzipper.ZIP_BZIP2, 5)
+
+
+def test_upx_packed_files_are_stored(tmp_path):
+    packed = tmp_path / 'packed.pyd'
+    packed.write_bytes(b'MZ' + b'\0' * 500 + b'UPX!' + b'\0' * 100)
+    plain = tmp_path / 'plain.pyd'
+    plain.write_bytes(b'MZ' + b'\0' * 600)
+    policy = zippolicy.Policy()
+    assert policy.choose('packed.pyd', str(packed)) == (pyzipper.ZIP_STORED, None)
+    assert policy.choose('plain.pyd', str(plain)) == (pyzipper.ZIP_DEFLATED, 6)
+
+
+@pytest.mark.parametrize('text', ['*.dat', '=lzma', '*.dat=zstd', '*.dat=lzma:5', '*.dat=deflate:12'])
+def test_invalid_rules(text):
+    with pytest.raises(ValueError):
+        zippolicy.Policy([zippolicy.parse_rule(text)])
+
+
+def test_configure_merges_rules_and_policy_files(tmp_path):
+    policy_file = tmp_path / 'policy.json'
+    policy_file.write_text(json.dumps({'level': 3, 'rules': [{'pattern': '*.json', 'codec': 'store'}]}))
+    policy = zippolicy.configure(['*.dat=lzma'], [str(policy_file)])
+    assert zippolicy.active is policy
+    assert policy.choose('x.dat') == (pyzipper.ZIP_LZMA, None)
+    assert policy.choose('x.json') == (pyzipper.ZIP_STORED, None)
+    assert policy.choose('x.pyc') == (pyzipper.ZIP_DEFLATED, 3)
+    zippolicy.active = None
+
+
+def test_report_marks_the_chosen_policy(tmp_path):
+    (tmp_path / 'a.txt').write_text('hello ' * 1000)
+    (tmp_path / 'b.png').write_bytes(b'\x89PNG' + bytes(range(256)) * 4)
+    report = zippolicy.build_report(zippolicy.payload_files(str(tmp_path)), zippolicy.Policy())
+    by_extension = {item['extension']: item for item in report['extensions']}
+    assert by_extension['.txt']['chosen'] == {'deflate:6': 1}
+    assert by_extension['.png']['chosen'] == {'store': 1}
+    stored = next(r for r in by_extension['.txt']['results'] if r['policy'] == 'store')
+    deflated = next(r for r in by_extension['.txt']['results'] if r['policy'] == 'deflate:9')
+    assert deflated['compressed'] < stored['compressed']